@@ -8,6 +8,15 @@ import os
 # AWS_SECRET_ACCESS_KEY
 
 # These variables are not part of the configuration since they are sensitive. The remaining variables should be added as necessary.
+#
+# The following environment variables are OPTIONAL, they point the script to other servers such as local stand-ins
+#
+# SKETCH_DB_HOST, SKETCH_DB_PORT, SKETCH_DB_SSLMODE
+# SKETCH_S3_DOMAIN, SKETCH_S3_ENDPOINT_URL, SKETCH_S3_ADDRESSING_STYLE
+#
+# and these ones select the storage of the buckets, AWS_ACCESS_KEY_ID and AWS_SECRET_ACCESS_KEY are not required with the local storage
+#
+# SKETCH_STORAGE, SKETCH_STORAGE_ROOT, SKETCH_STORAGE_COPY
 
 ### Exit codes
 
@@ -16,14 +25,39 @@ E_ERR = 1
 
 ### Database related variables
 
-DB_HOST = 'sketch-production-db-do-user-7447558-0.c.db.ondigitalocean.com'
-DB_PORT = 25060
+DB_HOST = os.getenv('SKETCH_DB_HOST', 'sketch-production-db-do-user-7447558-0.c.db.ondigitalocean.com')
+DB_PORT = int(os.getenv('SKETCH_DB_PORT', 25060))
 DB_NAME = 'proddatabase'
 
+DB_SSLMODE = os.getenv('SKETCH_DB_SSLMODE', 'require')
+
 DB_USER = os.getenv('SKETCH_DB_USER')
 DB_PASS = os.getenv('SKETCH_DB_PASS')
 
-DB_CONN_STRING = f"postgresql://{DB_USER}:{DB_PASS}@{DB_HOST}:{DB_PORT}/{DB_NAME}?sslmode=require"
+DB_CONN_STRING = f"postgresql://{DB_USER}:{DB_PASS}@{DB_HOST}:{DB_PORT}/{DB_NAME}?sslmode={DB_SSLMODE}"
+
+# percentage of the table pages that are sampled to estimate the database status with --approximate
+DB_STATUS_SAMPLE_PCT = 1
+
+# an UPDATE waiting longer than this for a lock fails instead of stalling its worker, and its rows are retried later
+DB_LOCK_TIMEOUT = '5s'
+
+# error codes with which the database tells us that it is contended: lock_not_available, query_canceled (timeouts),
+# deadlock_detected and serialization_failure
+DB_CONTENTION_ERROR_CODES = [ '55P03', '57014', '40P01', '40001' ]
+
+### Storage related variables
+
+# where the buckets are: s3 for the S3 compatible service configured below, or local to keep each bucket
+# in a directory of STORAGE_LOCAL_ROOT, which needs no network and no credentials (see the README)
+STORAGE_BACKEND = os.getenv('SKETCH_STORAGE', 's3')
+
+# directory of the buckets of the local storage, which must be on a single file system
+STORAGE_LOCAL_ROOT = os.getenv('SKETCH_STORAGE_ROOT', '/var/tmp/sketch-storage')
+
+# how the local storage copies an object: hardlink, reflink (a copy-on-write clone, on file systems that support it,
+# otherwise a regular copy) or copy
+STORAGE_LOCAL_COPY = os.getenv('SKETCH_STORAGE_COPY', 'hardlink')
 
 ### S3 related variables
 
@@ -32,18 +66,132 @@ S3_BUCKET_NAME_LEG = 'sketch-legacy-s3'
 S3_BUCKET_NAME     = 'sketch-production-s3'
 
 # S3 connection details
-S3_BUCKET_DOMAIN    = 'fra1.digitaloceanspaces.com'
-S3_ENDPOINT_URL_LEG = f"https://{S3_BUCKET_DOMAIN}"
+S3_BUCKET_DOMAIN    = os.getenv('SKETCH_S3_DOMAIN', 'fra1.digitaloceanspaces.com')
+S3_ENDPOINT_URL_LEG = os.getenv('SKETCH_S3_ENDPOINT_URL', f"https://{S3_BUCKET_DOMAIN}")
+
+# servers that do not have a DNS name per bucket, such as a local MinIO, need the path addressing style
+S3_ADDRESSING_STYLE = os.getenv('SKETCH_S3_ADDRESSING_STYLE', 'virtual')
 
 # maximum objects we are requesting at once (anything above 1000 is floored to 1000)
 # lower this value only to debug pagination
 S3_MAX_OBJECTS_REQ = 1000
 
+# size of the connection pool of an S3 client (this is the botocore default)
+S3_DEFAULT_POOL_CONNECTIONS = 10
+
+# default number of threads listing a bucket at the same time when checking its status
+S3_LIST_FAN_OUT = 8
+
+# the keyspace of a bucket is split for parallel listing at these prefixes followed by every
+# combination of S3_LIST_PARTITION_DIGITS digits, which suits the zero padded avatar numbers
+S3_LIST_PARTITION_PREFIXES = [ 'image/avatar-', 'avatar/avatar-' ]
+S3_LIST_PARTITION_DIGITS   = 3
+
+# default number of copies kept in flight by each worker process when using the async engine
+S3_MAX_IN_FLIGHT = 200
+
+# error codes with which S3 compatible services ask their clients to slow down, besides the HTTP 503 status
+S3_THROTTLING_ERROR_CODES = [ 'SlowDown', 'ServiceUnavailable', 'Throttling', 'ThrottlingException', 'RequestLimitExceeded', 'TooManyRequests' ]
+
 AWS_DEFAULT_REGION  = 'us-east-1'
 
 AWS_ACCESS_KEY_ID     = os.getenv('AWS_ACCESS_KEY_ID')
 AWS_SECRET_ACCESS_KEY = os.getenv('AWS_SECRET_ACCESS_KEY')
 
+### Multi-node coordination related variables
+
+# default number of ids per range leased to a worker node
+COORD_RANGE_SIZE = 100000
+
+# default number of seconds after which a lease that has not been renewed expires
+COORD_LEASE_DURATION = 300
+
+# number of times a range is leased while its worker nodes meet errors, before it is given up
+COORD_RANGE_ATTEMPTS = 3
+
+# seconds between the polls of a worker node waiting for a lease and between the progress reports of the coordinator
+COORD_POLL_INTERVAL     = 2
+COORD_PROGRESS_INTERVAL = 30
+
+# timeout in seconds and number of attempts of the requests to the coordinator
+COORD_REQUEST_TIMEOUT = 10
+COORD_REQUEST_RETRIES = 5
+
+### Adaptive concurrency related variables
+
+# default lower bounds of the batches in flight and of the batch size with --adaptive, -p and -b are the upper bounds
+ADAPTIVE_MIN_IN_FLIGHT  = 1
+ADAPTIVE_MIN_BATCH_SIZE = 10
+
+# rows added to the batch size for each window of batches completed without congestion
+ADAPTIVE_BATCH_SIZE_STEP = 10
+
+# factor applied to the batches in flight and to the batch size on congestion
+ADAPTIVE_DECREASE_FACTOR = 0.5
+
+# the latency per row is considered congested above this multiple of the best latency seen
+ADAPTIVE_LATENCY_FACTOR = 2
+
+# weight of each new batch in the smoothed latency per row, and growth of the best latency per batch
+ADAPTIVE_SMOOTHING      = 0.3
+ADAPTIVE_BASELINE_DRIFT = 0.01
+
+### Rate limiting related variables
+
+# default maximum S3 copies, S3 LIST requests and database rows updated per second, 0 means unlimited
+# the limits are shared by all the worker processes of an execution
+S3_COPY_RATE_LIMIT = 0
+S3_LIST_RATE_LIMIT = 0
+DB_ROWS_RATE_LIMIT = 0
+
+### Metrics related variables
+
+# upper bounds in seconds of the buckets of the latency histograms
+METRICS_LATENCY_BUCKETS = [ 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60 ]
+
+# prefix of the names of the metrics exposed in the Prometheus format
+METRICS_PREFIX = 'sketch_migration_'
+
+### Progress stream related variables
+
+# seconds over which the throughput of the progress stream is measured
+PROGRESS_RATE_WINDOW = 60
+
+### Profiling related variables
+
+# number of functions listed in each section of the profiling report
+PROFILE_REPORT_LINES = 50
+
+### Key index related variables
+
+# age in seconds after which a key index built from a listing of the production bucket is treated as partial, as keys
+# may have been created since by other processes, so that the keys that are not in it are checked live (0 means never)
+KEY_INDEX_MAX_AGE = 86400
+
+### Inventory related variables
+
+# number of keys sorted in memory at once when the key index is built from an inventory
+# the sorted runs are merged from temporary files next to the index
+INVENTORY_SORT_CHUNK_SIZE = 1000000
+
+# number of rows read at once from the Parquet files of an inventory
+INVENTORY_PARQUET_BATCH_SIZE = 65536
+
+### Verification related variables
+
+# number of rows fetched at once by the server side cursors of the verification
+VERIFY_DB_FETCH_SIZE = 10000
+
+# number of findings a worker process keeps before appending them to the report
+VERIFY_REPORT_FLUSH_SIZE = 1000
+
+### Logging related variables
+
+# detail of the lines about single files with -v: full (one line for each file), sampled (one line for one file out
+# of LOG_OBJECT_SAMPLE_RATE) or compact (one line for each batch), the errors are always logged for each file
+LOG_OBJECT_DETAIL      = 'full'
+LOG_OBJECT_SAMPLE_RATE = 100
+
 ### Other variables
 
 LOG_DIR = '/tmp'
@@ -0,0 +1,119 @@
+import math
+import logging
+
+from lib.config import *
+
+
+# we obtain the logger declared in main for use within this module
+logger = logging.getLogger("miglogger")
+
+
+# The adaptive controller tunes the number of batches in flight and the batch size while the migration runs.
+#
+# It follows the AIMD rule used for TCP congestion control:
+#   * while the batches complete without throttling and without a rise in latency, both values grow additively,
+#     by about one batch in flight and ADAPTIVE_BATCH_SIZE_STEP rows for each window of batches in flight
+#   * when S3 asks us to slow down, the database reports lock timeouts, or the latency per row rises well above
+#     the best one seen so far, both values are multiplied by ADAPTIVE_DECREASE_FACTOR
+#
+# After a decrease the batches that were already in flight are not taken into account, because they were
+# submitted with the previous values. Both values always stay within the bounds given by the user.
+
+
+# this function creates the state of the controller, which starts from the lower bounds and ramps up
+def create_adaptive_controller(min_in_flight, max_in_flight, min_batch_size, max_batch_size):
+
+    return { 'min_in_flight':        min_in_flight,
+             'max_in_flight':        max_in_flight,
+             'min_batch_size':       min_batch_size,
+             'max_batch_size':       max_batch_size,
+             'in_flight':            float(min_in_flight),
+             'batch_size':           float(min_batch_size),
+             'row_latency':          None,
+             'baseline_row_latency': None,
+             'nr_batches':           0,
+             'cooldown_until':       0,
+             'nr_increases':         0,
+             'nr_decreases':         0 }
+
+
+# this function returns the number of batches that may be in flight at the moment
+def get_adaptive_in_flight(controller):
+
+    return int(controller['in_flight'])
+
+
+# this function returns the size of the next batch
+def get_adaptive_batch_size(controller):
+
+    return int(controller['batch_size'])
+
+
+# this function updates the controller with a completed batch
+# batch_time is the wall time between the submission of the batch and its completion
+def adaptive_batch_completed(controller, batch_time, batch_len, nr_throttles):
+
+    controller['nr_batches'] += 1
+
+    old_in_flight  = get_adaptive_in_flight(controller)
+    old_batch_size = get_adaptive_batch_size(controller)
+
+    # the latency per row is smoothed, so that a single slow batch does not trigger a decrease
+    # the baseline is the best smoothed latency, and it creeps up slowly to follow lasting changes of the environment
+    congested_by_latency = False
+    if batch_len > 0:
+        row_latency = batch_time / batch_len
+        if controller['row_latency'] is None:
+            controller['row_latency'] = row_latency
+        else:
+            controller['row_latency'] += ADAPTIVE_SMOOTHING * (row_latency - controller['row_latency'])
+
+        if controller['baseline_row_latency'] is None:
+            controller['baseline_row_latency'] = controller['row_latency']
+        else:
+            controller['baseline_row_latency'] = min(controller['baseline_row_latency'] * (1 + ADAPTIVE_BASELINE_DRIFT), controller['row_latency'])
+
+        congested_by_latency = controller['row_latency'] > ADAPTIVE_LATENCY_FACTOR * controller['baseline_row_latency']
+
+    if nr_throttles > 0:
+        reason = f"{nr_throttles} throttled requests"
+    elif congested_by_latency:
+        reason = f"latency per row {controller['row_latency']:.4f}s above {ADAPTIVE_LATENCY_FACTOR}x the baseline {controller['baseline_row_latency']:.4f}s"
+    else:
+        reason = None
+
+    if reason is not None:
+        # the batches already in flight were submitted before the last decrease and do not count
+        if controller['nr_batches'] < controller['cooldown_until']:
+            return
+
+        controller['in_flight']  = max(controller['min_in_flight'],  controller['in_flight']  * ADAPTIVE_DECREASE_FACTOR)
+        controller['batch_size'] = max(controller['min_batch_size'], controller['batch_size'] * ADAPTIVE_DECREASE_FACTOR)
+        controller['cooldown_until'] = controller['nr_batches'] + math.ceil(controller['in_flight'])
+        controller['nr_decreases'] += 1
+        decision = 'decrease'
+    else:
+        # each completed batch contributes a fraction, so the values grow by one step per window of batches in flight
+        controller['in_flight']  = min(controller['max_in_flight'],  controller['in_flight']  + 1 / controller['in_flight'])
+        controller['batch_size'] = min(controller['max_batch_size'], controller['batch_size'] + ADAPTIVE_BATCH_SIZE_STEP / controller['in_flight'])
+        controller['nr_increases'] += 1
+        decision = 'increase'
+        reason   = 'no throttling and stable latency'
+
+    new_in_flight  = get_adaptive_in_flight(controller)
+    new_batch_size = get_adaptive_batch_size(controller)
+
+    # the decisions are logged only when they change the values in use, so they can be reviewed in the log file
+    # the batch size grows a little with almost every batch, so those steps alone are only logged in verbose mode
+    message = f"  * Adaptive {decision} ({reason}): batches in flight {old_in_flight} -> {new_in_flight}, batch size {old_batch_size} -> {new_batch_size}"
+    if decision == 'decrease' or new_in_flight != old_in_flight:
+        logger.info(message)
+    elif new_batch_size != old_batch_size:
+        logger.debug(message)
+
+
+# this function logs a summary of the decisions of the controller
+def log_adaptive_summary(controller):
+
+    logger.info(f"  * Adaptive controller: {controller['nr_increases']} increases, {controller['nr_decreases']} decreases, "
+                f"final batches in flight {get_adaptive_in_flight(controller)}, final batch size {get_adaptive_batch_size(controller)}")
@@ -0,0 +1,172 @@
+import os
+import bisect
+import logging
+
+
+# we obtain the logger declared in main for use within this module
+logger = logging.getLogger("miglogger")
+
+
+# The checkpoint journal allows an interrupted migration to be resumed without redoing its work.
+#
+# It is an append-only text file with two kinds of lines:
+#   * R <start_id> <end_id>  the legacy rows with ids in (start_id, end_id] have been processed without errors
+#   * W <id>                 every legacy row with an id up to this one has been processed, the watermark
+#
+# Batches finish out of order, so the ranges that are above the watermark are kept in memory until the
+# ranges between them and the watermark are completed. Ranges of batches with errors are not recorded,
+# so that their rows are retried when the migration is resumed.
+#
+# After a batch with errors the watermark stops advancing, and every later batch adds a range above it. So
+# that looking up a range does not get slower as they accumulate, the ranges that touch or overlap are merged
+# as they are added, and their starts are kept in a sorted list, which is searched by bisection.
+#
+# The coordinator (see libcoord.py) records its completed ranges in the same way, and also its leases,
+# so that a restarted coordinator gives the worker nodes the time to finish and report the ranges they hold:
+#   * L <lease_id> <start_id> <end_id> <node>  the range (start_id, end_id] has been leased to a worker node
+#   * E <lease_id>                             the lease has ended, whether its range was completed or not
+
+
+# this function adds a completed range to those in memory, merging it with those it touches or overlaps
+def add_completed_range(checkpoint, start_id, end_id):
+
+    starts = checkpoint['starts']
+    ranges = checkpoint['ranges']
+
+    position = bisect.bisect_left(starts, start_id)
+
+    # the previous range is merged if it ends where the new one starts or after
+    if position > 0 and ranges[starts[position - 1]] >= start_id:
+        position -= 1
+        start_id = starts[position]
+
+    # as are the following ones that start before the new one ends, the previous one included
+    while position < len(starts) and starts[position] <= end_id:
+        end_id = max(end_id, ranges.pop(starts[position]))
+        del starts[position]
+
+    starts.insert(position, start_id)
+    ranges[start_id] = end_id
+
+
+# this function folds the completed ranges that are contiguous to the watermark into it
+def advance_watermark(checkpoint):
+
+    watermark = checkpoint['watermark']
+
+    starts = checkpoint['starts']
+    while len(starts) > 0 and starts[0] <= watermark:
+        watermark = max(watermark, checkpoint['ranges'].pop(starts.pop(0)))
+
+    if watermark != checkpoint['watermark']:
+        checkpoint['watermark'] = watermark
+        return True
+
+    return False
+
+
+# this function opens a checkpoint journal, loading the progress recorded by previous executions
+# the journal is compacted to the watermark and the pending ranges, so that it does not grow forever
+def open_checkpoint(journal_filename, start_id=0):
+
+    checkpoint = { 'watermark': start_id, 'ranges': {}, 'starts': [], 'leases': {}, 'journal': None }
+
+    if os.path.exists(journal_filename):
+        with open(journal_filename, 'r') as journal_file:
+            for line in journal_file:
+                fields = line.split()
+                # a line without the trailing newline was interrupted while being written and is ignored
+                if not line.endswith('\n'):
+                    continue
+                if len(fields) == 2 and fields[0] == 'W':
+                    checkpoint['watermark'] = max(checkpoint['watermark'], int(fields[1]))
+                elif len(fields) == 3 and fields[0] == 'R':
+                    add_completed_range(checkpoint, int(fields[1]), int(fields[2]))
+                elif len(fields) == 5 and fields[0] == 'L':
+                    checkpoint['leases'][fields[1]] = (int(fields[2]), int(fields[3]), fields[4])
+                elif len(fields) == 2 and fields[0] == 'E':
+                    checkpoint['leases'].pop(fields[1], None)
+
+        advance_watermark(checkpoint)
+
+        logger.info(f"Resuming after id {checkpoint['watermark']} from the checkpoint journal {journal_filename}")
+
+    # we only replace the previous journal once the compacted one is complete
+    tmp_filename = f"{journal_filename}.tmp"
+    with open(tmp_filename, 'w') as journal_file:
+        journal_file.write(f"W {checkpoint['watermark']}\n")
+        for start_id, end_id in sorted(checkpoint['ranges'].items()):
+            journal_file.write(f"R {start_id} {end_id}\n")
+        for lease_id, (start_id, end_id, node) in checkpoint['leases'].items():
+            journal_file.write(f"L {lease_id} {start_id} {end_id} {node}\n")
+        journal_file.flush()
+        os.fsync(journal_file.fileno())
+    os.replace(tmp_filename, journal_filename)
+
+    checkpoint['journal'] = open(journal_filename, 'a')
+
+    return checkpoint
+
+
+# this function returns the id after which the scan should continue, jumping over completed ranges
+# together with the start of the next completed range, which bounds the current gap, or None if there is none
+def skip_completed_ranges(checkpoint, last_id):
+
+    last_id = max(last_id, checkpoint['watermark'])
+
+    starts = checkpoint['starts']
+
+    # the ranges neither touch nor overlap, so there is at most one to jump over
+    position = bisect.bisect_right(starts, last_id)
+    if position > 0 and last_id < checkpoint['ranges'][starts[position - 1]]:
+        last_id = checkpoint['ranges'][starts[position - 1]]
+
+    if position < len(starts):
+        return last_id, starts[position]
+
+    return last_id, None
+
+
+# this function records that the legacy rows with ids in (start_id, end_id] have been processed
+# the record is written to disk straight away, so that it survives a crash of the process
+def record_completed_range(checkpoint, start_id, end_id):
+
+    if end_id <= start_id:
+        return
+
+    add_completed_range(checkpoint, start_id, end_id)
+    checkpoint['journal'].write(f"R {start_id} {end_id}\n")
+
+    if advance_watermark(checkpoint):
+        checkpoint['journal'].write(f"W {checkpoint['watermark']}\n")
+
+    checkpoint['journal'].flush()
+    os.fsync(checkpoint['journal'].fileno())
+
+
+# this function records that the range (start_id, end_id] has been leased to a worker node
+def record_lease(checkpoint, lease_id, start_id, end_id, node):
+
+    checkpoint['leases'][lease_id] = (start_id, end_id, node)
+    checkpoint['journal'].write(f"L {lease_id} {start_id} {end_id} {node}\n")
+
+    checkpoint['journal'].flush()
+    os.fsync(checkpoint['journal'].fileno())
+
+
+# this function records the end of a lease, the completion of its range being recorded separately
+def record_lease_end(checkpoint, lease_id):
+
+    if checkpoint['leases'].pop(lease_id, None) is None:
+        return
+
+    checkpoint['journal'].write(f"E {lease_id}\n")
+
+    checkpoint['journal'].flush()
+    os.fsync(checkpoint['journal'].fileno())
+
+
+# this function closes the journal of a checkpoint
+def close_checkpoint(checkpoint):
+
+    checkpoint['journal'].close()
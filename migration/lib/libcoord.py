@@ -0,0 +1,469 @@
+import os
+import json
+import time
+import socket
+import logging
+import threading
+import collections
+import urllib.request
+
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+from lib.config import *
+from lib.libcheckpoint import skip_completed_ranges, record_completed_range, record_lease, record_lease_end
+
+
+# we obtain the logger declared in main for use within this module
+logger = logging.getLogger("miglogger")
+
+
+# The coordinator allows several hosts to run the migration at the same time without overlapping.
+#
+# It splits the ids of the legacy rows into ranges and leases them to the worker nodes through a small
+# HTTP endpoint. A worker node renews its lease while it works on a range and reports back when it is done.
+# A lease that is not renewed in time expires and its range is leased again to another worker node.
+#
+# A worker node that meets errors in a range releases it instead of completing it, and the range is leased
+# again, up to COORD_RANGE_ATTEMPTS times, after which it is left for a later execution.
+#
+# The state is kept in the memory of the coordinator because the migration database user can only SELECT
+# and UPDATE(path). Processing a range twice is harmless: existing files are not copied again (unless -w
+# is used) and only the rows that are still legacy are updated. With a checkpoint journal (see libcheckpoint.py)
+# the coordinator also records its leases and completed ranges, so that a restarted coordinator skips the
+# completed ranges and waits for the worker nodes to report the ranges they hold.
+#
+# A dry run is a property of the whole coordination: a coordinator started as a dry run only leases ranges to
+# worker nodes that are dry runs, and the other way round, so that ranges in which nothing was migrated are never
+# recorded as completed in the journal of a real migration.
+
+
+# this function splits the ids of the legacy rows greater than start_id into ranges (start_id, end_id]
+# the boundaries are multiples of range_size after start_id, so that a restarted coordinator finds the ranges of its journal
+# the ranges that the checkpoint, if given, records as completed are left out
+def get_id_ranges(db_connection, start_id, range_size, checkpoint=None):
+
+    scan_start_id = start_id
+    if checkpoint is not None:
+        scan_start_id = max(start_id, checkpoint['watermark'])
+
+    cur = db_connection.cursor()
+    cur.execute("SELECT MIN(id), MAX(id) FROM avatars WHERE path LIKE('image/%%') AND id > %s;", (scan_start_id,))
+    min_id, max_id = cur.fetchone()
+    cur.close()
+
+    ranges = []
+    if min_id is None:
+        return ranges
+
+    range_start = start_id + (min_id - 1 - start_id) // range_size * range_size
+    while range_start < max_id:
+        range_end = range_start + range_size
+        if checkpoint is None or skip_completed_ranges(checkpoint, range_start)[0] < range_end:
+            ranges.append((range_start, range_end))
+        range_start = range_end
+
+    return ranges
+
+
+# this function creates the state of the coordinator, which is shared by the threads of the HTTP server
+def create_coordinator_state(ranges, lease_duration, checkpoint=None, dry_run=False):
+
+    return { 'lock':               threading.Lock(),
+             'done':               threading.Event(),
+             'ranges':             ranges,
+             'range_indexes':      { start_id: range_index for range_index, (start_id, end_id) in enumerate(ranges) },
+             'pending':            collections.deque(range(len(ranges))),
+             'completed':          set(),
+             'failed':             set(),
+             'attempts':           collections.Counter(),
+             'leases':             {},
+             'next_lease_id':      1,
+             'lease_duration':     lease_duration,
+             'checkpoint':         checkpoint,
+             'dry_run':            dry_run,
+             'nr_reissued_leases': 0,
+             'copied_files':       0,
+             'updated_rows':       0,
+             'start_time':         time.time() }
+
+
+# this function tells whether every range has been completed or given up
+# it must be called with the lock of the state held
+def is_coordination_done(state):
+
+    return len(state['completed']) + len(state['failed']) == len(state['ranges'])
+
+
+# this function ends a lease, recording it in the checkpoint journal if there is one
+# it must be called with the lock of the state held
+def end_lease(state, lease_id):
+
+    lease = state['leases'].pop(lease_id, None)
+
+    if state['checkpoint'] is not None:
+        record_lease_end(state['checkpoint'], lease_id)
+
+    return lease
+
+
+# this function restores the leases that a previous coordinator recorded in the checkpoint journal
+# their worker nodes may still be working on them, so they get a full lease duration to renew them
+def restore_leases(state):
+
+    checkpoint = state['checkpoint']
+
+    with state['lock']:
+        for lease_id, (start_id, end_id, node) in list(checkpoint['leases'].items()):
+            range_index = state['range_indexes'].get(start_id)
+            if range_index is None or range_index not in state['pending']:
+                record_lease_end(checkpoint, lease_id)
+                continue
+
+            state['pending'].remove(range_index)
+            state['leases'][lease_id] = { 'range_index': range_index, 'node': node, 'expires': time.time() + state['lease_duration'] }
+            logger.info(f"  * lease {lease_id} of node {node} for range ({start_id}, {end_id}] restored from the checkpoint journal")
+
+
+# this function puts the ranges of the expired leases back at the front of the queue
+# it must be called with the lock of the state held
+def expire_leases(state):
+
+    now = time.time()
+
+    for lease_id, lease in list(state['leases'].items()):
+        if lease['expires'] < now:
+            end_lease(state, lease_id)
+            if lease['range_index'] not in state['completed'] and lease['range_index'] not in state['failed']:
+                state['pending'].appendleft(lease['range_index'])
+                state['nr_reissued_leases'] += 1
+                logger.info(f"  * lease {lease_id} of node {lease['node']} expired, range {state['ranges'][lease['range_index']]} will be leased again")
+
+
+# this function leases the next range to a worker node
+# if every range is leased the node is asked to wait, and when every range is completed it is told so
+# a node that is a dry run when the coordinator is not, or the other way round, is refused
+def grant_lease(state, node, dry_run=False):
+
+    if dry_run != state['dry_run']:
+        logger.error(f"  * node {node} refused, {'only' if state['dry_run'] else 'no'} dry run worker nodes are accepted")
+        return { 'refused': f"the coordinator {'is' if state['dry_run'] else 'is not'} a dry run" }
+
+    with state['lock']:
+        expire_leases(state)
+
+        if len(state['pending']) > 0:
+            range_index = state['pending'].popleft()
+
+            # the ids of the leases of a restarted coordinator must not be those of the leases restored from its journal
+            lease_id = f"{state['start_time']:.0f}-{state['next_lease_id']}"
+            state['next_lease_id'] += 1
+
+            state['leases'][lease_id] = { 'range_index': range_index, 'node': node, 'expires': time.time() + state['lease_duration'] }
+
+            start_id, end_id = state['ranges'][range_index]
+            if state['checkpoint'] is not None:
+                record_lease(state['checkpoint'], lease_id, start_id, end_id, node)
+
+            logger.debug(f"  * lease {lease_id} for range ({start_id}, {end_id}] granted to node {node}")
+
+            return { 'lease_id': lease_id, 'start_id': start_id, 'end_id': end_id, 'lease_duration': state['lease_duration'], 'dry_run': state['dry_run'] }
+
+        if not is_coordination_done(state):
+            return { 'wait': COORD_POLL_INTERVAL }
+
+        return { 'done': True }
+
+
+# this function extends a lease, it fails if the lease has already expired
+def renew_lease(state, lease_id):
+
+    with state['lock']:
+        lease = state['leases'].get(lease_id)
+        if lease is None:
+            return { 'renewed': False }
+
+        lease['expires'] = time.time() + state['lease_duration']
+
+        return { 'renewed': True }
+
+
+# this function records the completion of a range
+# the range is identified by its ids, as the lease may have been granted by a coordinator that has since been restarted
+# the work reported for an expired lease is real, so it is accounted for anyway
+# the ranges of a dry run are never recorded in the journal, whatever the coordinator
+def complete_lease(state, lease_id, start_id, end_id, copied_files, updated_rows, dry_run=False):
+
+    with state['lock']:
+        end_lease(state, lease_id)
+
+        state['copied_files'] += copied_files
+        state['updated_rows'] += updated_rows
+
+        if state['checkpoint'] is not None and not dry_run:
+            record_completed_range(state['checkpoint'], start_id, end_id)
+
+        range_index = state['range_indexes'].get(start_id)
+        if range_index is not None and range_index not in state['completed']:
+            state['completed'].add(range_index)
+            state['failed'].discard(range_index)
+            if range_index in state['pending']:
+                state['pending'].remove(range_index)
+
+        log_coordinator_progress(state)
+
+        if is_coordination_done(state):
+            state['done'].set()
+
+        return { 'completed': True }
+
+
+# this function puts back the range of a lease in which the worker node met errors, so that it is leased again
+# after COORD_RANGE_ATTEMPTS attempts the range is given up, and left for a later execution
+def release_lease(state, lease_id, start_id, end_id, copied_files, updated_rows, nr_errors):
+
+    with state['lock']:
+        end_lease(state, lease_id)
+
+        state['copied_files'] += copied_files
+        state['updated_rows'] += updated_rows
+
+        range_index = state['range_indexes'].get(start_id)
+        if range_index is not None and range_index not in state['completed'] and range_index not in state['failed'] and range_index not in state['pending']:
+            state['attempts'][range_index] += 1
+            if state['attempts'][range_index] >= COORD_RANGE_ATTEMPTS:
+                state['failed'].add(range_index)
+                logger.error(f"  * range ({start_id}, {end_id}] still had {nr_errors} errors after {COORD_RANGE_ATTEMPTS} attempts, it is given up")
+            else:
+                state['pending'].appendleft(range_index)
+                logger.info(f"  * range ({start_id}, {end_id}] had {nr_errors} errors, it will be leased again")
+
+        if is_coordination_done(state):
+            state['done'].set()
+
+        return { 'released': True }
+
+
+# this function provides aggregate progress information about all the worker nodes
+def get_coordinator_status(state):
+
+    return { 'ranges_total':       len(state['ranges']),
+             'ranges_completed':   len(state['completed']),
+             'ranges_failed':      len(state['failed']),
+             'ranges_leased':      len(state['leases']),
+             'nr_reissued_leases': state['nr_reissued_leases'],
+             'copied_files':       state['copied_files'],
+             'updated_rows':       state['updated_rows'],
+             'elapsed_time':       round(time.time() - state['start_time'], 2) }
+
+
+# this function logs the aggregate progress of the worker nodes
+def log_coordinator_progress(state):
+
+    status = get_coordinator_status(state)
+
+    if status['ranges_total'] > 0:
+        progress_pct = round(status['ranges_completed'] / status['ranges_total'] * 100)
+    else:
+        progress_pct = 100
+
+    logger.info(f"  * Progress {progress_pct:3d}%, ranges completed {status['ranges_completed']}/{status['ranges_total']}, ranges leased {status['ranges_leased']}, "
+                f"leases re-issued {status['nr_reissued_leases']}, files copied {status['copied_files']}, rows updated {status['updated_rows']}, elapsed time {status['elapsed_time']}")
+
+
+# the HTTP server of the coordinator, it exchanges JSON documents with the worker nodes
+class CoordinatorRequestHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+
+        if self.path == '/status':
+            with self.server.coordinator_state['lock']:
+                self.send_json(get_coordinator_status(self.server.coordinator_state))
+        else:
+            self.send_error(404)
+
+    def do_POST(self):
+
+        state = self.server.coordinator_state
+
+        try:
+            length  = int(self.headers.get('Content-Length', 0))
+            request = json.loads(self.rfile.read(length) or b'{}')
+
+            if self.path == '/lease':
+                self.send_json(grant_lease(state, request['node'], request.get('dry_run', False)))
+            elif self.path == '/renew':
+                self.send_json(renew_lease(state, request['lease_id']))
+            elif self.path == '/complete':
+                self.send_json(complete_lease(state, request['lease_id'], request['start_id'], request['end_id'], request['copied_files'], request['updated_rows'],
+                                              request.get('dry_run', False)))
+            elif self.path == '/release':
+                self.send_json(release_lease(state, request['lease_id'], request['start_id'], request['end_id'], request['copied_files'], request['updated_rows'],
+                                             request['nr_errors']))
+            else:
+                self.send_error(404)
+        except (ValueError, KeyError) as e:
+            self.send_error(400, f"bad request: {e}")
+
+    def send_json(self, document):
+
+        body = json.dumps(document).encode()
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    # the requests are logged only in debug mode, through our logger
+    def log_message(self, format, *args):
+
+        logger.debug(f"  * coordinator request from {self.address_string()}: {format % args}")
+
+
+# this function runs the coordinator until every range of legacy ids has been migrated or given up
+# if a checkpoint is given the completed ranges are skipped, and the leases and the new completed ranges are recorded
+def run_coordinator(db_connection, listen_address, start_id, range_size, lease_duration, checkpoint=None, dry_run=False):
+
+    host, port = listen_address.rsplit(':', 1)
+
+    ranges = get_id_ranges(db_connection, start_id, range_size, checkpoint)
+    state  = create_coordinator_state(ranges, lease_duration, checkpoint, dry_run)
+
+    if len(ranges) == 0:
+        logger.info('There are no legacy entries to migrate')
+        return state['copied_files'], state['updated_rows']
+
+    if checkpoint is not None:
+        restore_leases(state)
+
+    server = ThreadingHTTPServer((host, int(port)), CoordinatorRequestHandler)
+    server.daemon_threads = True
+    server.coordinator_state = state
+
+    server_thread = threading.Thread(target=server.serve_forever, daemon=True)
+    server_thread.start()
+
+    logger.info(f"Coordinator listening on {host}:{port}, {len(ranges)} ranges of up to {range_size} ids to lease")
+
+    # besides the progress on each completed range, we log it periodically so that stalls are visible
+    while not state['done'].wait(COORD_PROGRESS_INTERVAL):
+        with state['lock']:
+            expire_leases(state)
+            log_coordinator_progress(state)
+
+    # the nodes that are waiting for a lease are told that the work is done on their next poll
+    time.sleep(2 * COORD_POLL_INTERVAL)
+
+    server.shutdown()
+    server.server_close()
+
+    if len(state['failed']) > 0:
+        logger.error(f"ERROR: {len(state['failed'])} ranges were given up after {COORD_RANGE_ATTEMPTS} attempts with errors, they will be retried on the next execution:")
+        for range_index in sorted(state['failed']):
+            logger.error(f"  * ({state['ranges'][range_index][0]}, {state['ranges'][range_index][1]}]")
+
+    return state['copied_files'], state['updated_rows']
+
+
+# this function sends a request to the coordinator and returns its response
+# connection problems are retried a few times, as the coordinator may be momentarily busy
+def coordinator_request(coordinator_url, path, document=None):
+
+    if document is None:
+        request = urllib.request.Request(f"{coordinator_url}{path}")
+    else:
+        request = urllib.request.Request(f"{coordinator_url}{path}", data=json.dumps(document).encode(), headers={ 'Content-Type': 'application/json' })
+
+    for attempt in range(COORD_REQUEST_RETRIES):
+        try:
+            with urllib.request.urlopen(request, timeout=COORD_REQUEST_TIMEOUT) as response:
+                return json.loads(response.read())
+        except OSError as e:
+            if attempt == COORD_REQUEST_RETRIES - 1:
+                raise
+            logger.debug(f"  * request to the coordinator failed ({e}), retrying")
+            time.sleep(COORD_POLL_INTERVAL)
+
+
+# this function renews a lease periodically until it is told to stop
+def keep_lease_alive(coordinator_url, lease_id, lease_duration, stop_event):
+
+    while not stop_event.wait(lease_duration / 3):
+        try:
+            response = coordinator_request(coordinator_url, '/renew', { 'lease_id': lease_id })
+            if not response['renewed']:
+                logger.info(f"  * lease {lease_id} expired before it could be renewed, the range may be processed twice")
+                return
+        except OSError as e:
+            logger.error(f"Error renewing lease {lease_id}: {e}")
+
+
+# this function runs a worker node, which processes the ranges leased by the coordinator
+# migrate_range is called with the start and end ids of each range and returns the number of copied files, updated rows
+# and errors, and whether it was stopped before the end of the range
+# it returns the number of copied files, updated rows and errors of all the ranges, and whether the node was stopped
+def run_worker_node(coordinator_url, migrate_range, dry_run=False):
+
+    node = f"{socket.gethostname()}:{os.getpid()}"
+
+    total_copied_files = 0
+    total_updated_rows = 0
+    total_errors       = 0
+
+    while True:
+        try:
+            lease = coordinator_request(coordinator_url, '/lease', { 'node': node, 'dry_run': dry_run })
+        except OSError as e:
+            logger.error(f"Error getting a lease from the coordinator at {coordinator_url}: {e}")
+            exit(E_ERR)
+
+        if 'refused' in lease:
+            logger.error(f"The coordinator at {coordinator_url} refused this worker node: {lease['refused']}")
+            exit(E_ERR)
+
+        if lease.get('done'):
+            break
+
+        if 'wait' in lease:
+            time.sleep(lease['wait'])
+            continue
+
+        logger.info(f"Got lease {lease['lease_id']} for ids in ({lease['start_id']}, {lease['end_id']}]")
+
+        stop_event = threading.Event()
+        renew_thread = threading.Thread(target=keep_lease_alive, args=(coordinator_url, lease['lease_id'], lease['lease_duration'], stop_event), daemon=True)
+        renew_thread.start()
+
+        try:
+            copied_files, updated_rows, nr_errors, stopped = migrate_range(lease['start_id'], lease['end_id'])
+        finally:
+            stop_event.set()
+            renew_thread.join()
+
+        total_copied_files += copied_files
+        total_updated_rows += updated_rows
+        total_errors       += nr_errors
+
+        # an unfinished range is not reported, so its lease expires and another node takes it over
+        if stopped:
+            logger.info(f"Stopped before the end of lease {lease['lease_id']}, its range will be leased again once it expires")
+            return total_copied_files, total_updated_rows, total_errors, True
+
+        # a range with errors is released rather than completed, so that its rows are retried
+        if nr_errors > 0:
+            path = '/release'
+            logger.info(f"Releasing lease {lease['lease_id']} after {nr_errors} errors, its range will be leased again")
+        else:
+            path = '/complete'
+
+        try:
+            coordinator_request(coordinator_url, path, { 'lease_id': lease['lease_id'], 'start_id': lease['start_id'], 'end_id': lease['end_id'],
+                                                         'copied_files': copied_files, 'updated_rows': updated_rows, 'nr_errors': nr_errors,
+                                                         'dry_run': dry_run })
+        except OSError as e:
+            logger.error(f"Error reporting the end of lease {lease['lease_id']}: {e}")
+            exit(E_ERR)
+
+    logger.info('The coordinator has no more ranges to lease')
+
+    return total_copied_files, total_updated_rows, total_errors, False
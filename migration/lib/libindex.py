@@ -0,0 +1,277 @@
+import os
+import mmap
+import time
+import logging
+
+from lib.config import *
+from lib.libstorage import list_storage_pages
+from lib.libinventory import build_inventory_key_index
+
+
+# we obtain the logger declared in main for use within this module
+logger = logging.getLogger("miglogger")
+
+
+# The destination key index is a local replacement for the per key existence LISTs on the production bucket.
+#
+# It is made of two files:
+#   * the index itself, a sorted file with one key per line, that is searched with a binary search over an mmap
+#   * a journal (the index file name + .journal) to which the keys copied during a run are appended
+#
+# The journal is merged into the index when the index is prepared at the beginning of the next run,
+# so that a resumed migration does not need to list the production bucket again.
+#
+# An index built from an inventory of the production bucket (see libinventory.py) is partial: the keys created since
+# the inventory, by other processes or by migrations that did not use this index, can be anywhere in the key space.
+# A marker file (the index file name + .partial) tells the workers that a key that is not in such an index must be
+# checked live, while a key that is in it exists, as nothing is deleted from the production bucket.
+#
+# An index built from a listing is complete as of the start of the listing, which is written to a third file (the index
+# file name + .built). Only the keys copied by the runs that use the index are added to it afterwards, so the keys
+# created by anything else go unnoticed. Once the index is older than KEY_INDEX_MAX_AGE, or if its age is unknown,
+# it is therefore reused as a partial index, until it is rebuilt with -r.
+#
+# The size index of the legacy bucket has the same format, with a tab and the size of the object after each key. It is
+# built from the inventory of the legacy bucket (see libinventory.py), which does not change, so it is never rebuilt.
+
+
+# this function returns the name of the journal file of an index
+def get_key_index_journal_filename(index_filename):
+
+    return f"{index_filename}.journal"
+
+
+# this function returns the name of the marker file of a partial index
+def get_key_index_partial_filename(index_filename):
+
+    return f"{index_filename}.partial"
+
+
+# this function returns the name of the file with the build time of an index
+def get_key_index_built_filename(index_filename):
+
+    return f"{index_filename}.built"
+
+
+# this function returns the age in seconds of an index built from a listing, or None if its build time is unknown
+def get_key_index_age(index_filename):
+
+    try:
+        with open(get_key_index_built_filename(index_filename), 'r') as built_file:
+            return time.time() - float(built_file.read())
+    except (OSError, ValueError):
+        return None
+
+
+# this function writes the index of the keys of a bucket with a given prefix
+# the storage returns the keys in lexicographic order, so the listing can be streamed straight to the file
+def build_key_index(storage, bucket_name, prefix, index_filename):
+
+    start_time = time.time()
+
+    tmp_filename = f"{index_filename}.tmp"
+    nr_keys = 0
+
+    with open(tmp_filename, 'wb') as index_file:
+        for keys in list_storage_pages(storage, bucket_name, prefix):
+            for key in keys:
+                index_file.write(key.encode() + b'\n')
+                nr_keys += 1
+
+    # the index only replaces a previous one once it is complete
+    os.replace(tmp_filename, index_filename)
+
+    # the keys created during the listing may be missing, so the index is as old as the start of the listing
+    with open(get_key_index_built_filename(index_filename), 'w') as built_file:
+        built_file.write(f"{start_time}\n")
+
+    # a listing has all the keys, even if the previous index was built from an inventory
+    partial_filename = get_key_index_partial_filename(index_filename)
+    if os.path.exists(partial_filename):
+        os.remove(partial_filename)
+
+    # the journal refers to the previous index, whose keys are all in the new listing
+    journal_filename = get_key_index_journal_filename(index_filename)
+    if os.path.exists(journal_filename):
+        os.remove(journal_filename)
+
+    elapsed_time = round(time.time() - start_time, 2)
+    logger.info(f"  * indexed {nr_keys} keys of {bucket_name}/{prefix} in {elapsed_time} seconds")
+
+    return nr_keys
+
+
+# this function merges the keys appended to the journal by a previous run into the index
+def merge_key_index_journal(index_filename):
+
+    journal_filename = get_key_index_journal_filename(index_filename)
+
+    if not os.path.exists(journal_filename):
+        return 0
+
+    # a line without the trailing newline was interrupted while being written and is ignored
+    with open(journal_filename, 'rb') as journal_file:
+        journal_keys = sorted(set(line[:-1] for line in journal_file if line.endswith(b'\n') and len(line) > 1))
+
+    # we merge two sorted streams, so only the journal needs to be held in memory
+    tmp_filename = f"{index_filename}.tmp"
+    with open(index_filename, 'rb') as index_file, open(tmp_filename, 'wb') as merged_file:
+        journal_position = 0
+        for line in index_file:
+            key = line.rstrip(b'\n')
+            while journal_position < len(journal_keys) and journal_keys[journal_position] < key:
+                merged_file.write(journal_keys[journal_position] + b'\n')
+                journal_position += 1
+            if journal_position < len(journal_keys) and journal_keys[journal_position] == key:
+                journal_position += 1
+            merged_file.write(key + b'\n')
+
+        for journal_key in journal_keys[journal_position:]:
+            merged_file.write(journal_key + b'\n')
+
+    os.replace(tmp_filename, index_filename)
+    os.remove(journal_filename)
+
+    logger.info(f"  * merged {len(journal_keys)} keys copied by previous runs into the key index")
+
+    return len(journal_keys)
+
+
+# this function makes sure an up to date index exists before the migration starts
+# an existing index is reused unless a rebuild is requested, and it is built from the inventory of the bucket if one is given
+# a reused index that is too old to be trusted as complete is turned into a partial one
+def prepare_key_index(storage, bucket_name, prefix, index_filename, rebuild=False, inventory=None):
+
+    if (rebuild or not os.path.exists(index_filename)) and inventory is not None:
+        logger.info(f"Building the key index {index_filename} from the inventory {inventory['manifest']}")
+        build_inventory_key_index(inventory, prefix, index_filename)
+        with open(get_key_index_partial_filename(index_filename), 'w'):
+            pass
+        # the keys copied by previous runs may be more recent than the inventory
+        merge_key_index_journal(index_filename)
+    elif rebuild or not os.path.exists(index_filename):
+        logger.info(f"Building the key index {index_filename}")
+        build_key_index(storage, bucket_name, prefix, index_filename)
+    else:
+        logger.info(f"Reusing the key index {index_filename}")
+        merge_key_index_journal(index_filename)
+
+        partial_filename = get_key_index_partial_filename(index_filename)
+        index_age = get_key_index_age(index_filename)
+        if not os.path.exists(partial_filename) and KEY_INDEX_MAX_AGE > 0 and (index_age is None or index_age > KEY_INDEX_MAX_AGE):
+            if index_age is None:
+                logger.info('  * the build time of the key index is unknown, the keys that are not in it will be checked live (use -r to rebuild it)')
+            else:
+                logger.info(f"  * the key index was built {round(index_age / 3600, 1)} hours ago, the keys that are not in it will be checked live (use -r to rebuild it)")
+            with open(partial_filename, 'w'):
+                pass
+
+
+# this function opens an index for lookups and for appending newly copied keys
+# the index is represented by a dictionary so that it can be used by the helpers below
+def open_key_index(index_filename):
+
+    key_index = { 'mmap': None, 'journal': None, 'pending': [], 'partial': os.path.exists(get_key_index_partial_filename(index_filename)) }
+
+    with open(index_filename, 'rb') as index_file:
+        # an empty file can not be mapped, but it also can not contain any key
+        if os.fstat(index_file.fileno()).st_size > 0:
+            key_index['mmap'] = mmap.mmap(index_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    # each worker process has its own descriptor, and appends are atomic for the small writes we do
+    key_index['journal'] = open(get_key_index_journal_filename(index_filename), 'ab', buffering=0)
+
+    return key_index
+
+
+# this function finds the line of a key using a binary search over the lines of the mmap of an index
+# the key of a line is the part before the tab, if any, and the line is returned without its key, or None if it is not found
+def find_index_line(index_map, key):
+
+    if index_map is None:
+        return None
+
+    # lower is always the start of a line and upper the end of the range still to search
+    lower = 0
+    upper = len(index_map)
+    while lower < upper:
+        middle = (lower + upper) // 2
+
+        line_start = index_map.rfind(b'\n', 0, middle) + 1
+        line_end   = index_map.find(b'\n', line_start)
+        if line_end == -1:
+            line_end = len(index_map)
+
+        line_key, _, line_value = index_map[line_start:line_end].partition(b'\t')
+        if line_key == key:
+            return line_value
+        elif line_key < key:
+            lower = line_end + 1
+        else:
+            upper = line_start
+
+    return None
+
+
+# this function checks if a key is in the index
+def key_index_contains(key_index, key):
+
+    return find_index_line(key_index['mmap'], key.encode()) is not None
+
+
+# this function tells whether a key that is not in the index may still exist, and must then be checked live
+def key_index_is_partial(key_index):
+
+    return key_index['partial']
+
+
+# this function records a key that has just been copied
+# the key is only written to the journal when the index is flushed and it is only searchable
+# on the next run, which is fine as each legacy row is processed once per run
+def key_index_add(key_index, key):
+
+    key_index['pending'].append(key.encode())
+
+
+# this function writes the keys recorded since the last flush to the journal with a single write
+def key_index_flush(key_index):
+
+    if len(key_index['pending']) == 0:
+        return
+
+    key_index['journal'].write(b''.join(key + b'\n' for key in key_index['pending']))
+    key_index['pending'] = []
+
+
+# this function makes sure the size index of a bucket exists before the migration starts
+# it is built from the inventory of the bucket, and reused as is by the executions that use the same inventory
+def prepare_size_index(inventory, prefix, index_filename):
+
+    if os.path.exists(index_filename):
+        logger.info(f"Reusing the size index {index_filename}")
+    else:
+        logger.info(f"Building the size index {index_filename} from the inventory {inventory['manifest']}")
+        build_inventory_key_index(inventory, prefix, index_filename, sizes=True)
+
+
+# this function opens a size index for lookups
+def open_size_index(index_filename):
+
+    size_index = { 'mmap': None }
+
+    with open(index_filename, 'rb') as index_file:
+        if os.fstat(index_file.fileno()).st_size > 0:
+            size_index['mmap'] = mmap.mmap(index_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    return size_index
+
+
+# this function returns the size of the object of a key, or None if the key is not in the index
+# the keys created since the inventory are not in it
+def size_index_get(size_index, key):
+
+    size = find_index_line(size_index['mmap'], key.encode())
+    if size is None:
+        return None
+
+    return int(size)
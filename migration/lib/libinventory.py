@@ -0,0 +1,258 @@
+import os
+import csv
+import gzip
+import json
+import time
+import heapq
+import logging
+import datetime
+
+from urllib.parse import unquote_plus
+
+from lib.config import *
+from lib.libstorage import list_storage_pages
+
+# pyarrow is only needed for the inventories in the Parquet format
+try:
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+
+# we obtain the logger declared in main for use within this module
+logger = logging.getLogger("miglogger")
+
+
+# An S3 inventory is a daily or weekly report with the keys of a bucket, made of a manifest.json file and of
+# data files in the CSV (gzip compressed) or Parquet format. It can replace the listings of the bucket, which
+# take a huge number of LIST requests on a large bucket.
+#
+# The inventory is staged locally, as delivered: the manifest.json file and the data files it refers to, either
+# in the same directory or in the data/ directory next to the dated directory of the manifest. The data files
+# are read one row at a time (or one batch of rows for Parquet), so the memory used does not depend on the size
+# of the inventory.
+#
+# The inventory is a snapshot taken at its creation date, and how the keys created since are found depends on the bucket:
+#   * the legacy bucket is append only in key order: nothing is deleted from it and the avatar numbers only grow,
+#     so the keys created after the inventory come after its last key with the same prefix (see
+#     S3_LIST_PARTITION_PREFIXES), and only those are listed live to count its objects
+#   * the production bucket is not: the migration copies legacy avatars anywhere in its key space, so its inventory
+#     is neither used for its count nor as a complete key index, but as a partial one, where a key that is not found
+#     is checked live (see libindex.py)
+#
+# When the inventory of the legacy bucket has the optional Size field, the sizes of its objects are also written to a
+# size index, in which the workers look up the size of each copied file for the bytes_copied_total counter, as the
+# response of a copy does not tell its size.
+
+
+# this function returns the local file of a data file of an inventory, whose key is relative to the inventory bucket
+def get_inventory_data_filename(manifest_filename, data_key):
+
+    manifest_dir = os.path.dirname(os.path.abspath(manifest_filename))
+    data_basename = os.path.basename(data_key)
+
+    for data_filename in [ os.path.join(manifest_dir, data_basename), os.path.join(os.path.dirname(manifest_dir), 'data', data_basename) ]:
+        if os.path.isfile(data_filename):
+            return data_filename
+
+    raise ValueError(f"the data file {data_basename} of the inventory {manifest_filename} has not been staged")
+
+
+# this function loads the manifest of an inventory and checks that its data files are staged
+# the inventory is represented by a dictionary so that it can be used by the helpers below
+def load_inventory(manifest_filename):
+
+    with open(manifest_filename, 'r') as manifest_file:
+        manifest = json.load(manifest_file)
+
+    inventory = { 'manifest': manifest_filename,
+                  'bucket':   manifest['sourceBucket'],
+                  'format':   manifest['fileFormat'].lower(),
+                  'date':     datetime.datetime.fromtimestamp(int(manifest['creationTimestamp']) / 1000, datetime.timezone.utc),
+                  'files':    [] }
+
+    if inventory['format'] not in [ 'csv', 'parquet' ]:
+        raise ValueError(f"the {manifest['fileFormat']} format of the inventory {manifest_filename} is not supported")
+
+    if inventory['format'] == 'parquet' and pyarrow is None:
+        raise ValueError(f"the inventory {manifest_filename} is in the Parquet format, which requires pyarrow")
+
+    # the columns of the CSV files are only named in the manifest, in the same order
+    if inventory['format'] == 'csv':
+        inventory['columns'] = [ column.strip() for column in manifest['fileSchema'].split(',') ]
+        if 'Key' not in inventory['columns']:
+            raise ValueError(f"the inventory {manifest_filename} has no Key column")
+        inventory['sizes'] = 'Size' in inventory['columns']
+
+    # a data file that is still being downloaded would silently drop keys
+    for data_file in manifest['files']:
+        data_filename = get_inventory_data_filename(manifest_filename, data_file['key'])
+        if 'size' in data_file and os.path.getsize(data_filename) != data_file['size']:
+            raise ValueError(f"the data file {data_filename} of the inventory {manifest_filename} is incomplete")
+        inventory['files'].append(data_filename)
+
+    # the schema of the Parquet files is in the files themselves
+    if inventory['format'] == 'parquet':
+        inventory['sizes'] = len(inventory['files']) > 0 and 'size' in pyarrow.parquet.ParquetFile(inventory['files'][0]).schema_arrow.names
+
+    return inventory
+
+
+# this function yields the keys of a CSV data file with the sizes of their objects, None if the inventory has no sizes
+# the keys are URL encoded in this format, and the columns are those of the manifest
+def read_inventory_csv_objects(inventory, data_filename):
+
+    columns = inventory['columns']
+    key_column = columns.index('Key')
+    size_column = columns.index('Size') if 'Size' in columns else None
+    latest_column = columns.index('IsLatest') if 'IsLatest' in columns else None
+    delete_marker_column = columns.index('IsDeleteMarker') if 'IsDeleteMarker' in columns else None
+
+    with gzip.open(data_filename, 'rt', encoding='utf-8', newline='') as data_file:
+        for row in csv.reader(data_file):
+            # the inventories of versioned buckets also list the old versions and the delete markers
+            if latest_column is not None and row[latest_column] == 'false':
+                continue
+            if delete_marker_column is not None and row[delete_marker_column] == 'true':
+                continue
+            if size_column is not None and row[size_column] != '':
+                yield unquote_plus(row[key_column]), int(row[size_column])
+            else:
+                yield unquote_plus(row[key_column]), None
+
+
+# this function yields the keys of a Parquet data file with the sizes of their objects, None if the inventory has no sizes
+# the rows are read INVENTORY_PARQUET_BATCH_SIZE at a time
+def read_inventory_parquet_objects(inventory, data_filename):
+
+    parquet_file = pyarrow.parquet.ParquetFile(data_filename)
+    columns = [ column for column in [ 'key', 'size', 'is_latest', 'is_delete_marker' ] if column in parquet_file.schema_arrow.names ]
+
+    for batch in parquet_file.iter_batches(batch_size=INVENTORY_PARQUET_BATCH_SIZE, columns=columns):
+        batch_columns = { column: batch.column(position).to_pylist() for position, column in enumerate(columns) }
+        for row_position, key in enumerate(batch_columns['key']):
+            # the inventories of versioned buckets also list the old versions and the delete markers
+            if 'is_latest' in batch_columns and batch_columns['is_latest'][row_position] is False:
+                continue
+            if 'is_delete_marker' in batch_columns and batch_columns['is_delete_marker'][row_position] is True:
+                continue
+            yield key, batch_columns['size'][row_position] if 'size' in batch_columns else None
+
+
+# this function yields all the keys of an inventory with the sizes of their objects, in no particular order
+def read_inventory_objects(inventory):
+
+    if inventory['format'] == 'parquet':
+        read_objects = read_inventory_parquet_objects
+    else:
+        read_objects = read_inventory_csv_objects
+
+    for data_filename in inventory['files']:
+        yield from read_objects(inventory, data_filename)
+
+
+# this function yields all the keys of an inventory, in no particular order
+def read_inventory_keys(inventory):
+
+    for key, _ in read_inventory_objects(inventory):
+        yield key
+
+
+# this function returns the partition prefix of a key, or None if it has none of them
+def get_key_partition_prefix(key):
+
+    for prefix in S3_LIST_PARTITION_PREFIXES:
+        if key.startswith(prefix):
+            return prefix
+
+    return None
+
+
+# this function counts the objects of a bucket with its inventory and a live listing of the keys created since
+# it assumes that the bucket is append only in key order, which is only the case of the legacy bucket
+def count_inventory_bucket(storage, inventory):
+
+    start_time = time.time()
+
+    # the last key of each partition prefix is all we need to know where the live listing starts
+    nr_inventory_objects = 0
+    last_keys = { prefix: None for prefix in S3_LIST_PARTITION_PREFIXES }
+    for key in read_inventory_keys(inventory):
+        nr_inventory_objects += 1
+        prefix = get_key_partition_prefix(key)
+        if prefix is not None and (last_keys[prefix] is None or key > last_keys[prefix]):
+            last_keys[prefix] = key
+
+    nr_new_objects = 0
+    for prefix, last_key in last_keys.items():
+        for keys in list_storage_pages(storage, inventory['bucket'], prefix, last_key):
+            nr_new_objects += len(keys)
+
+    elapsed_time = round(time.time() - start_time, 2)
+    logger.debug(f"  * found {nr_inventory_objects} objects in the inventory of bucket {inventory['bucket']} of {inventory['date']:%Y-%m-%d %H:%M} UTC and {nr_new_objects} newer objects in {elapsed_time} seconds")
+
+    return nr_inventory_objects + nr_new_objects
+
+
+# this function writes a sorted run of index lines to a temporary file and returns its name
+def write_inventory_run(index_filename, run_number, keys):
+
+    run_filename = f"{index_filename}.run{run_number}"
+    with open(run_filename, 'wb') as run_file:
+        for key in sorted(set(keys)):
+            run_file.write(key + b'\n')
+
+    return run_filename
+
+
+# this function writes the index of the keys of a bucket with a given prefix from its inventory, in the format of the
+# key index (see libindex.py), and returns the number of keys
+# with sizes, each line is followed by a tab and the size of the object, and the objects without a size are left out
+# the keys created since the inventory may be anywhere in the key space, so the index is partial and nothing is listed
+# the keys of the inventory are not sorted, so they are sorted in runs of INVENTORY_SORT_CHUNK_SIZE keys that are merged
+# a tab sorts before any character of a key, so the lines with sizes are sorted by key as well
+def build_inventory_key_index(inventory, prefix, index_filename, sizes=False):
+
+    start_time = time.time()
+
+    run_filenames = []
+    try:
+        keys = []
+        for key, size in read_inventory_objects(inventory):
+            if key.startswith(prefix) and (not sizes or size is not None):
+                keys.append(f"{key}\t{size}".encode() if sizes else key.encode())
+                if len(keys) == INVENTORY_SORT_CHUNK_SIZE:
+                    run_filenames.append(write_inventory_run(index_filename, len(run_filenames), keys))
+                    keys = []
+        if len(keys) > 0:
+            run_filenames.append(write_inventory_run(index_filename, len(run_filenames), keys))
+        keys = None
+
+        tmp_filename = f"{index_filename}.tmp"
+        nr_inventory_keys = 0
+        last_key = None
+
+        with open(tmp_filename, 'wb') as index_file:
+            run_files = [ open(run_filename, 'rb') for run_filename in run_filenames ]
+            try:
+                # a key may be in several runs, but the merged lines are sorted so the duplicates are consecutive
+                for line in heapq.merge(*run_files):
+                    key = line[:-1]
+                    if key != last_key:
+                        index_file.write(line)
+                        nr_inventory_keys += 1
+                        last_key = key
+            finally:
+                for run_file in run_files:
+                    run_file.close()
+    finally:
+        for run_filename in run_filenames:
+            os.remove(run_filename)
+
+    # the index only replaces a previous one once it is complete
+    os.replace(tmp_filename, index_filename)
+
+    elapsed_time = round(time.time() - start_time, 2)
+    logger.info(f"  * indexed {nr_inventory_keys} keys of {inventory['bucket']}/{prefix} from the inventory of {inventory['date']:%Y-%m-%d %H:%M} UTC in {elapsed_time} seconds")
+
+    return nr_inventory_keys
@@ -0,0 +1,119 @@
+import os
+import zlib
+import atexit
+import logging
+import multiprocessing
+
+from logging.handlers import QueueHandler, QueueListener
+
+from lib.config import *
+
+
+# we obtain the logger declared in main for use within this module
+logger = logging.getLogger("miglogger")
+
+
+# The worker processes do not write the log themselves. A forked worker inherits the handlers of the main process,
+# whose file and console would then be written by many processes at once. Instead, each worker replaces them by a
+# handler that puts its records on a queue, which never blocks, and a thread of the main process takes the records
+# from the queue and writes them with the handlers of the main process, one at a time.
+#
+# With -v the migration logs a line for each file. On a large migration this is too much, so the detail of the
+# lines about single files can be reduced (see LOG_OBJECT_DETAIL):
+#   * full: one line for each file
+#   * sampled: one line for one file out of LOG_OBJECT_SAMPLE_RATE, chosen by a hash of its name, so that the
+#     copy and the update of a file are both logged, and the same files are logged on every run
+#   * compact: one line for each batch, with the numbers of files and the range of ids
+# The errors are always logged for each file.
+
+
+# the log queue of the main process, None until the listener is started
+log_queue    = None
+log_listener = None
+
+# the detail of the lines about single files in this process
+object_log_detail = LOG_OBJECT_DETAIL
+
+
+# this function starts the thread of the main process that writes the records of the worker processes
+# with the handlers of the logger, and returns the queue to be passed to the workers
+def start_log_listener():
+
+    global log_queue
+    global log_listener
+
+    log_queue = multiprocessing.Queue()
+
+    # the level of each record has already been checked by the worker, and each handler checks its own
+    log_listener = QueueListener(log_queue, *logger.handlers, respect_handler_level=True)
+    log_listener.start()
+
+    # the records still in the queue are written whatever the way the script exits
+    atexit.register(stop_log_listener)
+
+    return log_queue
+
+
+# this function writes the records still in the queue and stops the listener
+def stop_log_listener():
+
+    global log_listener
+
+    if log_listener is not None:
+        log_listener.stop()
+        log_listener = None
+
+
+# this function returns the queue on which the worker processes put their records, or None if there is no listener
+def get_log_queue():
+
+    return log_queue
+
+
+# this function sets the detail of the lines about single files
+def set_object_log_detail(detail):
+
+    global object_log_detail
+
+    if detail not in [ 'full', 'sampled', 'compact' ]:
+        raise ValueError(f"unknown detail {detail} of the file log")
+
+    object_log_detail = detail
+
+
+# this function returns the detail of the lines about single files
+def get_object_log_detail():
+
+    return object_log_detail
+
+
+# this function makes a worker process send its records to the queue of the main process
+def configure_worker_logging(queue, detail):
+
+    if queue is not None:
+        for handler in list(logger.handlers):
+            logger.removeHandler(handler)
+        logger.addHandler(QueueHandler(queue))
+
+    set_object_log_detail(detail)
+
+
+# this function tells whether the line about a single file should be logged
+# it is checked before the line is formatted, which is what costs the most on a large migration
+def is_object_logged(key):
+
+    if not logger.isEnabledFor(logging.DEBUG):
+        return False
+
+    if object_log_detail == 'full':
+        return True
+    elif object_log_detail == 'sampled':
+        return zlib.crc32(os.path.basename(key).encode()) % LOG_OBJECT_SAMPLE_RATE == 0
+    else:
+        return False
+
+
+# this function tells whether a line summarizing the files of a batch should be logged
+def is_batch_summary_logged():
+
+    return object_log_detail == 'compact' and logger.isEnabledFor(logging.DEBUG)
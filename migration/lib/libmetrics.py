@@ -0,0 +1,216 @@
+import json
+import logging
+import threading
+
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+from lib.config import *
+
+
+# we obtain the logger declared in main for use within this module
+logger = logging.getLogger("miglogger")
+
+
+# The metrics are latency histograms and counters of the stages of the migration.
+#
+# Each process records its own metrics. The worker processes hand theirs over to the main process with the result
+# of each batch and start again from zero, so the main process holds the aggregate of all of them. The main process
+# can expose the aggregate in the Prometheus text format and writes a JSON summary at the end of the execution.
+#
+# The histograms have the fixed buckets of METRICS_LATENCY_BUCKETS, so they can be merged by adding them up.
+
+
+# the metrics of this process and the lock that protects them, as the async engine records them from several threads
+metrics      = { 'histograms': {}, 'counters': {} }
+metrics_lock = threading.Lock()
+
+
+# this function discards the metrics of this process
+# the worker processes call it when they start, as they may inherit a copy of the metrics of the main process
+# (and of its lock, possibly held by the thread of the HTTP server) when they are forked
+def reset_metrics():
+
+    global metrics
+    global metrics_lock
+
+    metrics      = { 'histograms': {}, 'counters': {} }
+    metrics_lock = threading.Lock()
+
+
+# this function creates an empty histogram, with one count per bucket plus one for the values above the last bucket
+def create_histogram():
+
+    return { 'buckets': [ 0 ] * (len(METRICS_LATENCY_BUCKETS) + 1), 'sum': 0.0, 'count': 0, 'max': 0.0 }
+
+
+# this function records a value on a histogram
+def observe_metric(name, value):
+
+    bucket_index = len(METRICS_LATENCY_BUCKETS)
+    for index, upper_bound in enumerate(METRICS_LATENCY_BUCKETS):
+        if value <= upper_bound:
+            bucket_index = index
+            break
+
+    with metrics_lock:
+        histogram = metrics['histograms'].setdefault(name, create_histogram())
+        histogram['buckets'][bucket_index] += 1
+        histogram['sum']   += value
+        histogram['count'] += 1
+        histogram['max']    = max(histogram['max'], value)
+
+
+# this function adds an amount to a counter
+def increment_metric(name, amount=1):
+
+    with metrics_lock:
+        metrics['counters'][name] = metrics['counters'].get(name, 0) + amount
+
+
+# this function returns the metrics recorded since the last call and starts again from zero
+# it is used by the worker processes to hand their metrics over with the result of each batch
+def take_metrics():
+
+    global metrics
+
+    with metrics_lock:
+        taken   = metrics
+        metrics = { 'histograms': {}, 'counters': {} }
+
+    return taken
+
+
+# this function adds the metrics taken from a worker process to the metrics of this process
+def merge_metrics(taken):
+
+    with metrics_lock:
+        for name, taken_histogram in taken['histograms'].items():
+            histogram = metrics['histograms'].setdefault(name, create_histogram())
+            histogram['buckets'] = [ a + b for a, b in zip(histogram['buckets'], taken_histogram['buckets']) ]
+            histogram['sum']    += taken_histogram['sum']
+            histogram['count']  += taken_histogram['count']
+            histogram['max']     = max(histogram['max'], taken_histogram['max'])
+
+        for name, value in taken['counters'].items():
+            metrics['counters'][name] = metrics['counters'].get(name, 0) + value
+
+
+# this function estimates a quantile of a histogram, interpolating linearly within the bucket where it falls
+# values above the last bucket are only known to be up to the maximum, which is used as the upper bound
+def get_histogram_quantile(histogram, quantile):
+
+    if histogram['count'] == 0:
+        return None
+
+    rank = quantile * histogram['count']
+    cumulative_count = 0
+    lower_bound = 0.0
+    for index, bucket_count in enumerate(histogram['buckets']):
+        if index < len(METRICS_LATENCY_BUCKETS):
+            upper_bound = METRICS_LATENCY_BUCKETS[index]
+        else:
+            upper_bound = histogram['max']
+
+        if bucket_count > 0 and cumulative_count + bucket_count >= rank:
+            upper_bound = min(upper_bound, histogram['max'])
+            return lower_bound + (upper_bound - lower_bound) * (rank - cumulative_count) / bucket_count
+
+        cumulative_count += bucket_count
+        lower_bound = upper_bound
+
+    return histogram['max']
+
+
+# this function renders the metrics in the Prometheus text exposition format
+def get_prometheus_metrics():
+
+    lines = []
+
+    with metrics_lock:
+        for name, histogram in sorted(metrics['histograms'].items()):
+            full_name = f"{METRICS_PREFIX}{name}"
+            lines.append(f"# TYPE {full_name} histogram")
+            cumulative_count = 0
+            for upper_bound, bucket_count in zip(METRICS_LATENCY_BUCKETS, histogram['buckets']):
+                cumulative_count += bucket_count
+                lines.append(f"{full_name}_bucket{{le=\"{upper_bound}\"}} {cumulative_count}")
+            lines.append(f"{full_name}_bucket{{le=\"+Inf\"}} {histogram['count']}")
+            lines.append(f"{full_name}_sum {histogram['sum']}")
+            lines.append(f"{full_name}_count {histogram['count']}")
+
+        for name, value in sorted(metrics['counters'].items()):
+            full_name = f"{METRICS_PREFIX}{name}"
+            lines.append(f"# TYPE {full_name} counter")
+            lines.append(f"{full_name} {value}")
+
+    return '\n'.join(lines) + '\n'
+
+
+# this function summarizes the metrics, with the quantiles of each histogram instead of its buckets
+def get_metrics_summary():
+
+    summary = { 'latencies': {}, 'counters': {} }
+
+    with metrics_lock:
+        for name, histogram in sorted(metrics['histograms'].items()):
+            if histogram['count'] > 0:
+                mean = histogram['sum'] / histogram['count']
+            else:
+                mean = None
+            summary['latencies'][name] = { 'count': histogram['count'],
+                                           'mean':  mean,
+                                           'p50':   get_histogram_quantile(histogram, 0.5),
+                                           'p90':   get_histogram_quantile(histogram, 0.9),
+                                           'p99':   get_histogram_quantile(histogram, 0.99),
+                                           'max':   histogram['max'] }
+
+        summary['counters'] = dict(sorted(metrics['counters'].items()))
+
+    return summary
+
+
+# this function writes the summary of the metrics to a JSON file
+def write_metrics_summary(filename):
+
+    with open(filename, 'w') as summary_file:
+        json.dump(get_metrics_summary(), summary_file, indent=2)
+        summary_file.write('\n')
+
+
+# the HTTP server of the metrics, it only answers to /metrics
+class MetricsRequestHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+
+        if self.path != '/metrics':
+            self.send_error(404)
+            return
+
+        body = get_prometheus_metrics().encode()
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    # the scrapes are logged only in debug mode, through our logger
+    def log_message(self, format, *args):
+
+        logger.debug(f"  * metrics request from {self.address_string()}: {format % args}")
+
+
+# this function starts serving the metrics of this process on HOST:PORT, on a background thread
+def start_metrics_server(listen_address):
+
+    host, port = listen_address.rsplit(':', 1)
+
+    server = ThreadingHTTPServer((host, int(port)), MetricsRequestHandler)
+    server.daemon_threads = True
+
+    server_thread = threading.Thread(target=server.serve_forever, daemon=True)
+    server_thread.start()
+
+    logger.info(f"Serving the metrics on http://{host}:{port}/metrics")
+
+    return server
@@ -3,21 +3,49 @@ import os
 import time
 import logging
 import psycopg2
-import boto3
-import botocore
 import getpass
 import datetime
 import random
 import math
+import queue
+import asyncio
+import signal
 
-from multiprocessing import Process, Manager, Queue
+from multiprocessing import Pool
+from concurrent.futures import ThreadPoolExecutor
 
 from lib.config import *
+from lib.libindex import open_key_index, key_index_contains, key_index_is_partial, key_index_add, key_index_flush, open_size_index, size_index_get
+from lib.libinventory import count_inventory_bucket
+from lib.liblog import is_object_logged, is_batch_summary_logged, configure_worker_logging, get_log_queue, get_object_log_detail
+from lib.libcheckpoint import skip_completed_ranges, record_completed_range
+from lib.libratelimit import set_rate_limits, get_rate_limits, acquire_rate_limit
+from lib.libstorage import get_storage, list_storage_pages, storage_key_exists, copy_storage_object, put_storage_object, delete_storage_objects
+from lib.libmetrics import reset_metrics, observe_metric, increment_metric, take_metrics, merge_metrics
+from lib.libprogress import start_progress_window, write_progress
+from lib.libprofile import start_worker_profiling, get_profile_prefix, start_profile_stage, end_profile_stage
+from lib.libadaptive import get_adaptive_in_flight, get_adaptive_batch_size, adaptive_batch_completed, log_adaptive_summary
 
 
 # we obtain the logger declared in main for use within this module
 logger = logging.getLogger("miglogger")
 
+# connections owned by a worker process of the pool
+# they are opened once by init_worker and reused for every batch the worker processes
+worker_db_connection = None
+worker_storage       = None
+
+# settings of the copy engine used by a worker process of the pool
+worker_engine        = 'sync'
+worker_max_in_flight = S3_MAX_IN_FLIGHT
+worker_executor      = None
+
+# index of the keys of the production bucket, if the migration uses one
+worker_key_index = None
+
+# index of the sizes of the objects of the legacy bucket, if it has an inventory with sizes
+worker_size_index = None
+
 
 def get_random_string(length, charset):
 
@@ -52,75 +80,154 @@ def get_random_keyname():
 # this function obtains a database connection
 def get_db_connection():
 
-    return psycopg2.connect(DB_CONN_STRING)
+    # with a lock timeout a contended UPDATE fails fast, which tells the adaptive controller to slow down
+    return psycopg2.connect(DB_CONN_STRING, options=f"-c lock_timeout={DB_LOCK_TIMEOUT}")
 
 
-# this function obtains an S3 connection
-def get_s3_connection():
+# this function returns the keys that split the keyspace of a bucket into ranges that can be listed in parallel
+# they are made of the known key prefixes followed by every combination of the first digits of the avatar number
+def get_listing_boundaries(prefixes=S3_LIST_PARTITION_PREFIXES, nr_digits=S3_LIST_PARTITION_DIGITS):
 
-    session = boto3.session.Session()
-    s3_connection = session.client('s3',
-                                   config=botocore.config.Config(s3={'addressing_style': 'virtual'}),
-                                   region_name=AWS_DEFAULT_REGION,
-                                   endpoint_url=S3_ENDPOINT_URL_LEG,
-                                   aws_access_key_id=AWS_ACCESS_KEY_ID,
-                                   aws_secret_access_key=AWS_SECRET_ACCESS_KEY)
+    boundaries = []
+    for prefix in prefixes:
+        for number in range(10 ** nr_digits):
+            boundaries.append(f"{prefix}{number:0{nr_digits}d}")
 
-    return s3_connection
+    return sorted(boundaries)
 
 
-# this function checks the current S3 and database status
-def check_s3_status(s3_connection, bucket_name):
+# this function counts the objects of a bucket whose keys are in the range (start_after, end_at]
+# a None start or end means that the range is open on that side
+def count_s3_range(storage, bucket_name, start_after=None, end_at=None):
 
-    response = s3_connection.list_objects_v2(Bucket=bucket_name, MaxKeys=S3_MAX_OBJECTS_REQ)
+    nr_found_objects = 0
 
-    try:
-        objects = response['Contents']
-        nr_found_objects_partial = len(objects)
-        nr_found_objects_total   = len(objects)
-    except Exception as e:
-        nr_found_objects_partial = 0
-        nr_found_objects_total   = 0
+    for keys in list_storage_pages(storage, bucket_name, start_after=start_after):
 
-    # we need to loop because the list_objects_v2 functions never returns more than 1000
-    # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/s3/client/list_objects_v2.html#list-objects-v2
+        # the keys are returned in order, so we can stop as soon as we go past the end of the range
+        if end_at is not None and len(keys) > 0 and keys[-1] > end_at:
+            nr_found_objects += sum(1 for key in keys if key <= end_at)
+            break
 
-    while nr_found_objects_partial > 0:
+        nr_found_objects += len(keys)
 
-        if not response.get('IsTruncated'):
-            break
-        else:
-            continuation_token = response.get('NextContinuationToken')
+    return nr_found_objects
 
-        response = s3_connection.list_objects_v2(Bucket=bucket_name, MaxKeys=S3_MAX_OBJECTS_REQ, ContinuationToken=continuation_token)
-        try:
-            objects = response['Contents']
-            nr_found_objects_partial = len(objects)
-            nr_found_objects_total += nr_found_objects_partial
-            logger.debug(f"  * found so far {nr_found_objects_total}, bucket {bucket_name} has more objects")
-        except Exception as e:
-            logger.debug(f"  * found so far {nr_found_objects_total} bucket {bucket_name} has NO more objects")
-            nr_found_objects_partial = 0
+
+# this function checks the current S3 and database status
+# the keyspace is split into ranges that are listed by up to fan_out threads at the same time
+# with the inventory of a bucket that is append only in key order, only the keys created after the inventory are listed
+def check_s3_status(storage, bucket_name, fan_out=S3_LIST_FAN_OUT, inventory=None):
+
+    if inventory is not None:
+        nr_found_objects_total = count_inventory_bucket(storage, inventory)
+        logger.info(f"  * {nr_found_objects_total} objects in bucket {bucket_name} (inventory of {inventory['date']:%Y-%m-%d %H:%M} UTC and newer objects)")
+        return nr_found_objects_total
+
+    if fan_out > 1:
+        boundaries = get_listing_boundaries()
+        ranges = list(zip([ None ] + boundaries, boundaries + [ None ]))
+    else:
+        ranges = [ (None, None) ]
+
+    # each listing thread needs its own connection of the pool of the S3 client
+    if fan_out > S3_DEFAULT_POOL_CONNECTIONS:
+        storage = get_storage(fan_out)
+
+    with ThreadPoolExecutor(max_workers=fan_out) as executor:
+        range_counts = list(executor.map(lambda r: count_s3_range(storage, bucket_name, r[0], r[1]), ranges))
+
+    for (start_after, end_at), range_count in zip(ranges, range_counts):
+        if range_count > 0:
+            logger.debug(f"  * found {range_count} objects in bucket {bucket_name} after {start_after} up to {end_at}")
+
+    nr_found_objects_total = sum(range_counts)
 
     logger.info(f"  * {nr_found_objects_total} objects in bucket {bucket_name}")
 
     return nr_found_objects_total
 
 
+# this function estimates the DB status without scanning the whole table
+# the total comes from the planner statistics and the share of legacy and production entries from a sample of the table
+# it returns None if the table is too small or has never been analyzed, in which case the estimate would be meaningless
+def estimate_db_status(cur):
+
+    cur.execute("SELECT reltuples::bigint FROM pg_class WHERE oid = 'avatars'::regclass;")
+    total_count = cur.fetchone()[0]
+
+    cur.execute("SELECT COUNT(*) FILTER (WHERE path LIKE('image/%%')), COUNT(*) FILTER (WHERE path LIKE('avatar/%%')), COUNT(*) FROM avatars TABLESAMPLE SYSTEM (%s);", (DB_STATUS_SAMPLE_PCT,))
+    sample_legacy_count, sample_prod_count, sample_total_count = cur.fetchone()
+
+    if total_count <= 0 or sample_total_count == 0:
+        return None
+
+    legacy_count = round(total_count * sample_legacy_count / sample_total_count)
+    prod_count   = round(total_count * sample_prod_count / sample_total_count)
+
+    return [ legacy_count, prod_count, total_count ]
+
+
+# this function tells whether the avatars table has both indexes used by the separate counts of count_db_status
+def has_db_status_indexes(cur):
+
+    cur.execute("SELECT indexname FROM pg_indexes WHERE tablename = 'avatars';")
+    index_names = [ row[0] for row in cur.fetchall() ]
+
+    return 'avatars_legacy_id_idx' in index_names and 'avatars_path_c_idx' in index_names
+
+
+# this function counts the entries of the database exactly
+# with the indexes created by the -s flag of the preparation script, each number has its own query, answered from an index:
+#   * the legacy entries from the partial index avatars_legacy_id_idx, whose predicate is the same
+#   * the production entries from the range of their paths in the index avatars_path_c_idx
+#   * all the entries from the primary key
+# without them each of these queries would read the whole table, so the three numbers are counted in a single pass
+def count_db_status(cur):
+
+    if not has_db_status_indexes(cur):
+        cur.execute("SELECT COUNT(*) FILTER (WHERE path LIKE('image/%')), COUNT(*) FILTER (WHERE path LIKE('avatar/%')), COUNT(*) FROM avatars;")
+        return list(cur.fetchone())
+
+    cur.execute("SELECT COUNT(*) FROM avatars WHERE path LIKE('image/%');")
+    legacy_count = cur.fetchone()[0]
+
+    # the "C" collation compares the bytes, and '0' is the character after '/'
+    cur.execute("SELECT COUNT(*) FROM avatars WHERE path COLLATE \"C\" >= 'avatar/' AND path COLLATE \"C\" < 'avatar0';")
+    prod_count = cur.fetchone()[0]
+
+    cur.execute('SELECT COUNT(*) FROM avatars;')
+    total_count = cur.fetchone()[0]
+
+    return [ legacy_count, prod_count, total_count ]
+
+
 # this functions summarizes the DB status
-def check_db_status(db_connection):
+# all the counts are obtained from the indexes of the table if it has them (see count_db_status), or estimated if approximate is set
+# it returns None if the database could not be queried
+def check_db_status(db_connection, approximate=False):
 
     cur = db_connection.cursor()
 
+    legacy_count = None
+    prod_count   = None
+    total_count  = None
+
     try:
-        cur.execute('SELECT COUNT(*) from avatars WHERE path LIKE(\'image/%\');')
-        legacy_count = cur.fetchone()[0]
+        counts = None
+        if approximate:
+            counts = estimate_db_status(cur)
+            if counts is None:
+                logger.info('  * the database statistics are not usable for an estimate, counting exactly')
+
+        if counts is None:
+            approximate = False
+            counts = count_db_status(cur)
 
-        cur.execute('SELECT COUNT(*) from avatars WHERE path LIKE(\'avatar/%\');')
-        prod_count = cur.fetchone()[0]
+        legacy_count, prod_count, total_count = counts
 
-        cur.execute('SELECT COUNT(*) from avatars')
-        total_count = cur.fetchone()[0]
+        if approximate:
+            logger.info('  * the following database numbers are estimates')
 
         entry_diff = total_count - (legacy_count + prod_count)
 
@@ -131,24 +238,35 @@ def check_db_status(db_connection):
 
     except Exception as e:
         logger.error(f"Error querying database for status: {e}")
+        # the failed query aborted the transaction, which would fail the next queries on this connection
+        db_connection.rollback()
+        return None
 
     return [ legacy_count, prod_count, total_count ]
 
 
 # this function summarizes the S3 status
-def check_status(db_connection, s3_connection, request_confirmation):
+# inventories maps the name of a bucket to its inventory, which is only used for the legacy bucket
+# the production bucket is always listed, as the migration adds keys anywhere in its key space (see libinventory.py)
+# it returns None if the database status could not be checked, without requesting any confirmation
+def check_status(db_connection, storage, request_confirmation, fan_out=S3_LIST_FAN_OUT, approximate=False, inventories=None):
+
+    if inventories is None:
+        inventories = {}
 
     logger.info('')
     logger.info('Current data status:')
-    nr_found_objects_legacy     = check_s3_status(s3_connection, S3_BUCKET_NAME_LEG)
-    nr_found_objects_production = check_s3_status(s3_connection, S3_BUCKET_NAME)
+    nr_found_objects_legacy     = check_s3_status(storage, S3_BUCKET_NAME_LEG, fan_out, inventories.get(S3_BUCKET_NAME_LEG))
+    nr_found_objects_production = check_s3_status(storage, S3_BUCKET_NAME, fan_out)
     nr_found_objects_total = nr_found_objects_legacy + nr_found_objects_production
 
     s3_status_list = [ nr_found_objects_legacy, nr_found_objects_production ]
 
     logger.info(f"  * {nr_found_objects_total} total objects found\n")
 
-    db_status_list = check_db_status(db_connection)
+    db_status_list = check_db_status(db_connection, approximate)
+    if db_status_list is None:
+        return None
 
     # prepare a CSV string, as it is easier to parse from the outside
     status_list = s3_status_list + db_status_list
@@ -172,12 +290,14 @@ def check_status(db_connection, s3_connection, request_confirmation):
 
 
 # this function checks if we have write permissions a bucket
-def check_bucket_write_permissions(s3_connection, bucket_name):
+def check_bucket_write_permissions(storage, bucket_name):
 
     try:
         hello_world_key = get_random_keyname()
-        s3_connection.put_object(Bucket=bucket_name, Key=hello_world_key, Body='hello world!')
-        s3_connection.delete_object(Bucket=bucket_name, Key=hello_world_key)
+        put_storage_object(storage, bucket_name, hello_world_key, 'hello world!')
+        errors = delete_storage_objects(storage, bucket_name, [ hello_world_key ])
+        if len(errors) > 0:
+            raise Exception(errors[0][1])
     except Exception as e:
         logger.error(f"Error while creating an test s3 object on bucket {bucket_name}")
         logger.error('  * check domain name, bucket name, key/secret pair and bucket write permissions')
@@ -185,68 +305,147 @@ def check_bucket_write_permissions(s3_connection, bucket_name):
 
 
 # this function checks if we have read permissions on a production bucket
-def check_bucket_read_permissions(s3_connection, bucket_name):
+def check_bucket_read_permissions(storage, bucket_name):
 
     try:
-        s3_connection.list_objects_v2(Bucket=bucket_name,)
+        next(list_storage_pages(storage, bucket_name))
     except Exception as e:
         logger.error(f"Error while listing the contents of bucket {bucket_name}")
         logger.error('  * check domain name, bucket name, key/secret pair and bucket write permissions')
         exit(E_ERR)
 
 
-# this function copies a batch of legacy files present on the legacy bucket to the production bucket
-def copy_s3_batch(s3_connection, bucket_src, bucket_dst, batch, dry_run=False, overwrite=False):
+# this function tells if an error means that S3 or the database are asking us to slow down
+# S3 errors carry the error code and the HTTP status in their response, database errors carry the SQLSTATE code
+def is_throttling_error(e):
 
-    # because of process concurrency we need to delay the logs of this function
-    # and log them all at once
-    messages_to_log = []
+    response = getattr(e, 'response', None)
+    if isinstance(response, dict):
+        if response.get('Error', {}).get('Code') in S3_THROTTLING_ERROR_CODES:
+            return True
+        if response.get('ResponseMetadata', {}).get('HTTPStatusCode') == 503:
+            return True
+
+    return getattr(e, 'pgcode', None) in DB_CONTENTION_ERROR_CODES
 
-    start_time = time.time()
+
+# this function counts the outcome of the copy of a file on the metrics and passes it through
+def record_copy_outcome(outcome):
+
+    increment_metric(f"files_{outcome}_total")
+
+    return outcome
+
+
+# this function copies a single legacy file present on the legacy bucket to the production bucket
+# it returns the outcome: copied, skipped, error or throttled, which is an error caused by S3 asking us to slow down
+# if a key index is passed as an argument it is used instead of listing the production bucket
+# the lines about the file are sent to the log right away, according to the detail of the file log (see liblog.py)
+def copy_s3_object(storage, bucket_src, bucket_dst, old_key, dry_run=False, overwrite=False, key_index=None):
 
     if dry_run:
         msg_prefix = 'DRY RUN '
     else:
         msg_prefix = ''
 
-    messages_to_log.append('Got S3 batch')
+    filename = os.path.basename(old_key)
+    new_key = f"avatar/{filename}"
 
-    sucessfully_copied = []
-    for row in batch:
-        old_key = row[1]
-        copy_source = { 'Bucket': bucket_src, 'Key': old_key }
-        filename = os.path.basename(old_key)
-        new_key = f"avatar/{filename}"
-
-        if overwrite is True:
-            skip = False
-            messages_to_log.append(f"  * {msg_prefix}copying {bucket_src}/{old_key} to {bucket_dst}/{new_key}")
-        else:
-            # check first if an object with the same key is already in the production bucket
-            # for performance, integrity and idempotency reasons we do not overwrite an existing file on bucket_dst
-            response = s3_connection.list_objects_v2(Bucket=bucket_dst, Prefix=new_key)
+    if overwrite is True:
+        skip = False
+        if is_object_logged(old_key):
+            logger.debug(f"  * {msg_prefix}copying {bucket_src}/{old_key} to {bucket_dst}/{new_key}")
+    else:
+        # check first if an object with the same key is already in the production bucket
+        # for performance, integrity and idempotency reasons we do not overwrite an existing file on bucket_dst
+        # a key that is not in a partial index, built from an inventory, may have been created since and is checked live
+        if key_index is not None:
+            skip = key_index_contains(key_index, new_key)
+        if key_index is None or (not skip and key_index_is_partial(key_index)):
+            acquire_rate_limit('s3_list')
+            request_start_time = time.time()
             try:
-                objects = response['Contents']
-                skip = True
-                messages_to_log.append(f"  * skipping {bucket_src}/{old_key} as {bucket_dst}/{new_key} already exists")
+                skip = storage_key_exists(storage, bucket_dst, new_key)
             except Exception as e:
-                skip = False
-                messages_to_log.append(f"  * {msg_prefix}copying {bucket_src}/{old_key} to {bucket_dst}/{new_key}")
+                logger.debug(f"Error checking file {new_key}: {e}")
+                return record_copy_outcome('throttled' if is_throttling_error(e) else 'error')
+            finally:
+                observe_metric('s3_list_check_seconds', time.time() - request_start_time)
+                increment_metric('s3_list_requests_total')
+
+        if is_object_logged(old_key):
+            if skip:
+                logger.debug(f"  * skipping {bucket_src}/{old_key} as {bucket_dst}/{new_key} already exists")
+            else:
+                logger.debug(f"  * {msg_prefix}copying {bucket_src}/{old_key} to {bucket_dst}/{new_key}")
+
+    if skip is True:
+        return record_copy_outcome('skipped')
 
-        if skip is not True:
+    try:
+        if not dry_run:
+            acquire_rate_limit('s3_copy')
+            request_start_time = time.time()
             try:
-                # reference https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/s3/client/copy.html#copy
-                if not dry_run:
-                    # initial code: s3_connection.copy(copy_source, bucket_dst, new_key)
-                    # initially we used copy() but it turns out that copy_object is twice as fast
-                    # at least for small files
-                    s3_connection.copy_object(CopySource=f"{bucket_src}/{old_key}", Bucket=bucket_dst, Key=new_key)
-                # we store the list of sucessfully copied files
-                sucessfully_copied.append(row)
-            except Exception as e:
-                messages_to_log.append(f"Error copying file {old_key}: {e}")
+                copy_storage_object(storage, bucket_src, old_key, bucket_dst, new_key)
+            finally:
+                observe_metric('s3_copy_object_seconds', time.time() - request_start_time)
+                increment_metric('s3_copy_requests_total')
+            if key_index is not None:
+                key_index_add(key_index, new_key)
+    except Exception as e:
+        logger.debug(f"Error copying file {old_key}: {e}")
+        return record_copy_outcome('throttled' if is_throttling_error(e) else 'error')
+
+    return record_copy_outcome('copied')
+
+
+# this function logs a line summarizing the copies of a batch, when the file log is compact
+def log_copy_summary(batch, outcomes, dry_run):
+
+    if not is_batch_summary_logged() or len(batch) == 0:
+        return
+
+    if dry_run:
+        msg_prefix = 'DRY RUN '
+    else:
+        msg_prefix = ''
+
+    nr_failed = outcomes.count('error') + outcomes.count('throttled')
+    logger.debug(f"  * {msg_prefix}copied {outcomes.count('copied')}, skipped {outcomes.count('skipped')} and failed {nr_failed} files of rows {batch[0][0]}..{batch[-1][0]}")
+
+
+# this function copies a batch of legacy files present on the legacy bucket to the production bucket
+def copy_s3_batch(storage, bucket_src, bucket_dst, batch, dry_run=False, overwrite=False, key_index=None):
+
+    start_time = time.time()
+
+    logger.debug('Got S3 batch')
+
+    sucessfully_copied = []
+    outcomes = []
+    nr_copy_errors = 0
+    nr_throttles   = 0
+    for row in batch:
+        outcome = copy_s3_object(storage, bucket_src, bucket_dst, row[1], dry_run, overwrite, key_index)
+        outcomes.append(outcome)
+
+        # we store the list of sucessfully copied files
+        if outcome == 'copied':
+            sucessfully_copied.append(row)
+        elif outcome == 'error':
+            nr_copy_errors += 1
+        elif outcome == 'throttled':
+            nr_copy_errors += 1
+            nr_throttles   += 1
+
+    # the keys copied in this batch are added to the index all at once
+    if key_index is not None:
+        key_index_flush(key_index)
 
-    messages_to_log.append('S3 batch done')
+    log_copy_summary(batch, outcomes, dry_run)
+
+    logger.debug('S3 batch done')
 
     end_time = time.time()
 
@@ -255,23 +454,75 @@ def copy_s3_batch(s3_connection, bucket_src, bucket_dst, batch, dry_run=False, o
 
     elapsed_time_readable = round(elapsed_time, 2)
 
-    messages_to_log.append('')
-    messages_to_log.append(f"The execution of copy_s3_batch took {elapsed_time_readable} seconds, avg {avg_time_per_file} per file\n")
-
-    for m in messages_to_log:
-        logger.debug(m)
+    logger.debug('')
+    logger.debug(f"The execution of copy_s3_batch took {elapsed_time_readable} seconds, avg {avg_time_per_file} per file\n")
 
     # we return the list of sucessfully copied files to be used as an input for the update of db rows
-    return sucessfully_copied
+    # together with the number of files that could not be copied and how many of them were throttled
+    return sucessfully_copied, nr_copy_errors, nr_throttles
+
+
+# this function does the same as copy_s3_batch but keeps up to max_in_flight copies in flight at once
+# the avatars are tiny so the copies are bound by latency and not by CPU
+# boto3 is not asyncio aware, so asyncio bounds the number of copies in flight and each copy runs
+# on a thread of the executor, all of them sharing the connection pool of the same S3 client
+def copy_s3_batch_async(storage, executor, bucket_src, bucket_dst, batch, dry_run=False, overwrite=False, max_in_flight=S3_MAX_IN_FLIGHT, key_index=None):
+
+    start_time = time.time()
+
+    logger.debug('Got S3 batch (async engine)')
+
+    async def copy_row(loop, semaphore, row):
+        async with semaphore:
+            return await loop.run_in_executor(executor, copy_s3_object, storage, bucket_src, bucket_dst, row[1], dry_run, overwrite, key_index)
+
+    async def copy_rows():
+        loop = asyncio.get_running_loop()
+        semaphore = asyncio.Semaphore(max_in_flight)
+        return await asyncio.gather(*(copy_row(loop, semaphore, row) for row in batch))
+
+    # the lines about each file are logged as the copies complete, gather returns the outcomes in the order of the batch
+    outcomes = asyncio.run(copy_rows())
+
+    sucessfully_copied = []
+    nr_copy_errors = 0
+    nr_throttles   = 0
+    for row, outcome in zip(batch, outcomes):
+
+        # as in the sequential engine, only the rows whose file was copied are returned
+        if outcome == 'copied':
+            sucessfully_copied.append(row)
+        elif outcome == 'error':
+            nr_copy_errors += 1
+        elif outcome == 'throttled':
+            nr_copy_errors += 1
+            nr_throttles   += 1
+
+    # the keys copied in this batch are added to the index all at once
+    if key_index is not None:
+        key_index_flush(key_index)
+
+    log_copy_summary(batch, outcomes, dry_run)
+
+    logger.debug('S3 batch done')
+
+    end_time = time.time()
+
+    elapsed_time = end_time - start_time
+    avg_time_per_file = round(elapsed_time / len(batch), 4)
+
+    elapsed_time_readable = round(elapsed_time, 2)
+
+    logger.debug('')
+    logger.debug(f"The execution of copy_s3_batch_async took {elapsed_time_readable} seconds, avg {avg_time_per_file} per file\n")
+
+    return sucessfully_copied, nr_copy_errors, nr_throttles
 
 
 # this function updates a batch of database rows
+# it returns the number of updated rows and 1 if the update failed because the database is contended, 0 otherwise
 def update_db_batch(db_connection, rows_to_update, dry_run=False):
 
-    # because of process concurrency we need to delay the logs of this function
-    # and log them all at once
-    messages_to_log = []
-
     start_time = time.time()
 
     if dry_run:
@@ -279,28 +530,53 @@ def update_db_batch(db_connection, rows_to_update, dry_run=False):
     else:
         msg_prefix = ''
 
-    messages_to_log.append('Got DB batch')
+    logger.debug('Got DB batch')
 
-    cur = db_connection.cursor()
-    nr_updated_rows = 0
-    try:
-        for row in rows_to_update:
-            row_id  = row[0]
-            old_key = row[1]
+    row_ids = []
+    for row in rows_to_update:
+        old_key = row[1]
+
+        if is_object_logged(old_key):
             filename = os.path.basename(old_key)
             new_key = f"avatar/{filename}"
+            logger.debug(f"  * {msg_prefix}updating {old_key} to {new_key}")
 
-            messages_to_log.append(f"  * {msg_prefix}updating {old_key} to {new_key}")
+        row_ids.append(row[0])
 
-            if not dry_run:
-                cur.execute("UPDATE avatars SET path = %s WHERE id = %s", (new_key, row_id))
-            nr_updated_rows += 1
-    except Exception as e:
-        messages_to_log.append(f"Error updating row {entry}: {e}")
+    if is_batch_summary_logged() and len(row_ids) > 0:
+        logger.debug(f"  * {msg_prefix}updating {len(row_ids)} rows {row_ids[0]}..{row_ids[-1]} to avatar/")
 
-    db_connection.commit()
+    # the whole batch is updated with a single statement to avoid one network round trip per row
+    # the new path is calculated on the server, replacing everything up to the last / by avatar/
+    # which is the same as avatar/ + os.path.basename(path); rows that are no longer legacy are left alone
+    update_str = "UPDATE avatars SET path = regexp_replace(path, '^.*/', 'avatar/') WHERE id = ANY(%s) AND path LIKE('image/%%')"
 
-    messages_to_log.append('DB batch done')
+    nr_updated_rows = 0
+    nr_throttles    = 0
+    if dry_run:
+        nr_updated_rows = len(row_ids)
+    elif len(row_ids) > 0:
+        # the limit is on rows and not on statements, as rows are what loads the database
+        acquire_rate_limit('db_rows', len(row_ids))
+        update_start_time = time.time()
+        cur = db_connection.cursor()
+        try:
+            cur.execute(update_str, (row_ids,))
+            nr_updated_rows = cur.rowcount
+            db_connection.commit()
+        except Exception as e:
+            # the files of these rows are already copied, so the next execution skips them (see migrate_legacy_data)
+            logger.error(f"Error updating rows {row_ids[0]}..{row_ids[-1]}: {e}")
+            db_connection.rollback()
+            increment_metric('db_update_errors_total')
+            if is_throttling_error(e):
+                nr_throttles = 1
+        cur.close()
+        observe_metric('db_update_seconds', time.time() - update_start_time)
+        increment_metric('db_update_statements_total')
+        increment_metric('db_rows_updated_total', nr_updated_rows)
+
+    logger.debug('DB batch done')
 
     end_time = time.time()
 
@@ -313,150 +589,418 @@ def update_db_batch(db_connection, rows_to_update, dry_run=False):
 
     elapsed_time_readable = round(elapsed_time, 2)
 
-    messages_to_log.append('')
-    messages_to_log.append(f"The execution of update_db_batch took {elapsed_time_readable} seconds, avg {avg_time_per_row} seconds per row\n")
+    logger.debug('')
+    logger.debug(f"The execution of update_db_batch took {elapsed_time_readable} seconds, avg {avg_time_per_row} seconds per row\n")
 
-    for m in messages_to_log:
-        logger.debug(m)
-
-    return nr_updated_rows
+    return nr_updated_rows, nr_throttles
 
 
 # this function processes a batch of data in terms of s3 copies and db row updates
-def process_batch(bucket_src, bucket_dst, batch, dry_run, overwrite, queue=None):
-
-    db_connection = get_db_connection()
-    s3_connection = get_s3_connection()
+# it returns a dictionary with the numbers of copied files, updated rows, errors and throttled requests
+# the bytes copied are counted with the sizes of the size index, if one is passed as an argument
+def process_batch(db_connection, storage, bucket_src, bucket_dst, batch, dry_run, overwrite, executor=None, max_in_flight=S3_MAX_IN_FLIGHT, key_index=None,
+                  size_index=None):
 
     # we only update the entries that correspond to files that have been copied
     # files that were already on the destination bucket of files for which there was an error
     # do not have their corresponding db entry updated
 
-    # perform s3 copy
-    rows_to_update = copy_s3_batch(s3_connection, bucket_src, bucket_dst, batch, dry_run, overwrite)
+    # perform s3 copy, with the async engine if an executor has been passed as an argument
+    stage_start = start_profile_stage()
+    if executor is not None:
+        rows_to_update, nr_copy_errors, nr_copy_throttles = copy_s3_batch_async(storage, executor, bucket_src, bucket_dst, batch, dry_run, overwrite, max_in_flight, key_index)
+    else:
+        rows_to_update, nr_copy_errors, nr_copy_throttles = copy_s3_batch(storage, bucket_src, bucket_dst, batch, dry_run, overwrite, key_index)
     copied_files = len(rows_to_update)
+    end_profile_stage('copy_s3_batch', stage_start)
+
+    # the response of a copy does not tell its size, and the files created since the inventory are not counted
+    if size_index is not None and not dry_run:
+        increment_metric('bytes_copied_total', sum(size_index_get(size_index, row[1]) or 0 for row in rows_to_update))
 
     # update database rows
-    updated_rows = update_db_batch(db_connection, rows_to_update, dry_run)
+    stage_start = start_profile_stage()
+    updated_rows, nr_update_throttles = update_db_batch(db_connection, rows_to_update, dry_run)
+    end_profile_stage('update_db_batch', stage_start)
 
-    # we pass the result as dictionary if a queue has been passed as an argument
-    # otherwise we use the tradicional return values
-    if queue is not None:
-        result = { "copied_files": copied_files, "updated_rows": updated_rows }
-        queue.put(result)
-        return
+    # copied files whose row could not be updated are also errors
+    nr_errors = nr_copy_errors + (copied_files - updated_rows)
+
+    return { 'copied_files': copied_files,
+             'updated_rows': updated_rows,
+             'nr_errors':    nr_errors,
+             'nr_throttles': nr_copy_throttles + nr_update_throttles }
+
+
+# this function is executed once by each process of the worker pool
+# opening the TLS database connection and the S3 client is more expensive than copying a small batch
+# so each worker keeps them for its whole lifetime instead of opening them per batch
+def init_worker(engine='sync', max_in_flight=S3_MAX_IN_FLIGHT, key_index_filename=None, rate_limits=None, profile_prefix=None, log_queue=None, object_log_detail=LOG_OBJECT_DETAIL,
+                size_index_filename=None):
+
+    global worker_db_connection
+    global worker_storage
+    global worker_engine
+    global worker_max_in_flight
+    global worker_executor
+    global worker_key_index
+    global worker_size_index
+
+    # a Ctrl-C on the terminal reaches every process of the group, but only the main process
+    # should handle it, by letting the batches in flight finish before exiting
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    # a forked worker inherits the SIGTERM handler of the main process, which only requests a stop
+    # the default one is restored so that the pool can still terminate its workers when something fails
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+
+    # a forked worker inherits the log handlers of the main process, its records are sent to the main process instead
+    configure_worker_logging(log_queue, object_log_detail)
+
+    # a forked worker starts with a copy of the metrics of the main process, which are not its own
+    reset_metrics()
+
+    # the rate limits are shared with the main process and the other workers
+    if rate_limits is not None:
+        set_rate_limits(rate_limits)
+
+    # in profiling mode each worker writes its part of the profile when the pool is closed
+    if profile_prefix is not None:
+        start_worker_profiling(profile_prefix)
+
+    stage_start = start_profile_stage()
+
+    worker_engine        = engine
+    worker_max_in_flight = max_in_flight
+
+    worker_db_connection = get_db_connection()
+
+    # the async engine needs as many pooled connections as copies in flight
+    if engine == 'async':
+        worker_storage = get_storage(max_in_flight)
+        worker_executor      = ThreadPoolExecutor(max_workers=max_in_flight)
     else:
-        return copied_files, updated_rows
+        worker_storage = get_storage()
+
+    # the index is mapped in memory, so all the workers share the same pages of the page cache
+    if key_index_filename is not None:
+        worker_key_index = open_key_index(key_index_filename)
+
+    if size_index_filename is not None:
+        worker_size_index = open_size_index(size_index_filename)
+
+    end_profile_stage('init_worker', stage_start)
+
+
+# this function is the entry point of the worker pool for each batch
+# it processes the batch using the connections that were opened by init_worker
+def process_batch_in_worker(bucket_src, bucket_dst, batch, dry_run, overwrite):
+
+    global worker_db_connection
+
+    # the database server may have dropped the connection since the previous batch
+    if worker_db_connection.closed:
+        worker_db_connection = get_db_connection()
+
+    result = process_batch(worker_db_connection, worker_storage, bucket_src, bucket_dst, batch, dry_run, overwrite, worker_executor, worker_max_in_flight, worker_key_index,
+                           worker_size_index)
+
+    # the metrics recorded while processing the batch travel back with its result, to be aggregated by the main process
+    result['metrics'] = take_metrics()
+
+    return result
+
+
+# this function creates the pool of worker processes that migrate the batches
+# the key index is not needed when overwriting because nothing is checked in that case
+def create_worker_pool(parallelization_level, engine='sync', max_in_flight=S3_MAX_IN_FLIGHT, key_index_filename=None, overwrite=False, size_index_filename=None):
+
+    if overwrite:
+        key_index_filename = None
+
+    return Pool(processes=parallelization_level, initializer=init_worker, initargs=(engine, max_in_flight, key_index_filename, get_rate_limits(), get_profile_prefix(),
+                                                                                 get_log_queue(), get_object_log_detail(), size_index_filename))
+
+
+# this function fetches the next page of legacy rows, those with an id greater than last_id
+# we use keyset pagination instead of a single SELECT because a client side cursor would bring
+# the whole result set into memory, so memory usage stays flat whatever the size of the table
+# the condition on path must match the predicate of the partial index avatars_legacy_id_idx, recommended for
+# production and created by the preparation script, so that each page is read from the index
+# it returns the rows and the id from which the following page should be fetched
+def fetch_legacy_batch(cur, last_id, batch_size, end_id=None):
+
+    if batch_size <= 0:
+        return [], last_id
+
+    if end_id is not None:
+        cur.execute("SELECT id, path FROM avatars WHERE path LIKE('image/%%') AND id > %s AND id <= %s ORDER BY id LIMIT %s;", (last_id, end_id, batch_size))
+    else:
+        cur.execute("SELECT id, path FROM avatars WHERE path LIKE('image/%%') AND id > %s ORDER BY id LIMIT %s;", (last_id, batch_size))
+    batch = cur.fetchall()
+
+    if len(batch) > 0:
+        last_id = batch[-1][0]
+
+    return batch, last_id
+
+
+# this function fetches the next batch of legacy rows, jumping over the ranges that the checkpoint says are completed
+# it returns the rows, the id after which they were fetched and the id from which the following batch should be fetched
+def fetch_next_legacy_batch(cur, last_id, batch_size, end_id=None, checkpoint=None):
+
+    if checkpoint is None:
+        batch, next_last_id = fetch_legacy_batch(cur, last_id, batch_size, end_id)
+        return batch, last_id, next_last_id
+
+    while True:
+        last_id, gap_end_id = skip_completed_ranges(checkpoint, last_id)
+
+        # the batch must not go into the next completed range
+        if gap_end_id is not None and (end_id is None or gap_end_id < end_id):
+            bound_id = gap_end_id
+        else:
+            bound_id = end_id
+            gap_end_id = None
+
+        batch, next_last_id = fetch_legacy_batch(cur, last_id, batch_size, bound_id)
+        if len(batch) > 0 or gap_end_id is None or batch_size <= 0:
+            return batch, last_id, next_last_id
+
+        # there are no legacy rows left before the next completed range, so the gap is completed as well
+        record_completed_range(checkpoint, last_id, gap_end_id)
+        last_id = gap_end_id
 
 
 # this function performs the data migration work from a high level perspective
-def migrate_legacy_data(db_connection, s3_connection, bucket_src, bucket_dst, start_time, batch_size, limit, dry_run=False, overwrite=False, parallelization_level=1):
+# the legacy rows are scanned in id order, starting after start_id and up to end_id, if given
+# if a checkpoint is given the completed ranges are skipped and the new ones are recorded
+# the migration can be stopped with SIGTERM or SIGINT, in which case the batches in flight are finished first
+# if an adaptive controller is given it sets the batch size and the batches in flight, which are then upper bounds
+# if a progress stream is given the progress is also written to it, in the JSON lines format
+# if a pool of worker processes is given it is used and left open, otherwise one is created and closed at the end
+# it returns the number of copied files, updated rows and errors, and whether the migration was stopped before the end
+def migrate_legacy_data(db_connection, storage, bucket_src, bucket_dst, start_time, batch_size, limit, dry_run=False, overwrite=False, parallelization_level=1,
+                        engine='sync', max_in_flight=S3_MAX_IN_FLIGHT, start_id=0, key_index_filename=None, end_id=None, checkpoint=None, adaptive=None, progress_stream=None,
+                        pool=None, size_index_filename=None):
 
     total_copied_files = 0
     total_updated_rows = 0
+    total_errors       = 0
+
+    if checkpoint is not None:
+        start_id = max(start_id, checkpoint['watermark'])
 
     if dry_run:
         msg_prefix = 'DRY RUN '
     else:
         msg_prefix = ''
 
+    # there is no need to count the legacy rows beforehand, which would mean another scan of the table
+    # the progress is measured by the position of the scan in the id space, or against the limit if there is one
     if limit > 0:
-        extra_sql = f" LIMIT {limit}"
+        rows_to_fetch = limit
     else:
-        extra_sql = ''
+        rows_to_fetch = math.inf
+
+    # the adaptive controller changes both values as the batches complete
+    def get_batch_size():
+        if adaptive is not None:
+            return get_adaptive_batch_size(adaptive)
+        return batch_size
 
-    select_str = f"SELECT * FROM avatars WHERE path LIKE(\'image/%\'){extra_sql}"
+    def get_batches_in_flight():
+        if adaptive is not None:
+            return get_adaptive_in_flight(adaptive)
+        return parallelization_level
+
+    own_pool = pool is None
+
+    # no new batches are started once a stop is requested
+    stop_requested = False
+
+    def request_stop(signum, frame):
+        nonlocal stop_requested
+        if not stop_requested:
+            logger.info(f"{msg_prefix}  * Stop requested, waiting for the batches in flight to finish")
+        stop_requested = True
+
+    previous_sigterm_handler = signal.signal(signal.SIGTERM, request_stop)
+    previous_sigint_handler  = signal.signal(signal.SIGINT, request_stop)
 
     try:
         cur = db_connection.cursor()
 
-        cur.execute(f"SELECT COUNT(*) FROM ({select_str}) foobar;")
-        row_count = cur.fetchone()[0]
-
-        nr_batches_to_process = math.ceil(row_count / batch_size)
+        # the highest id is read from the primary key index, so this is immediate
+        if end_id is not None:
+            max_id = end_id
+        else:
+            cur.execute('SELECT MAX(id) FROM avatars;')
+            max_id = cur.fetchone()[0] or 0
+
+        # the estimated time to completion of the progress stream is based on the legacy rows that remain
+        # without a limit their number is estimated from the statistics of the table, which is cheap
+        # the estimate covers the whole table, so it is not used for a range of ids
+        initial_legacy_rows = None
+        if progress_stream is not None and limit <= 0 and end_id is None:
+            try:
+                counts = estimate_db_status(cur)
+                if counts is not None:
+                    initial_legacy_rows = counts[0]
+            except Exception as e:
+                logger.debug(f"The legacy rows could not be estimated for the progress stream: {e}")
+                db_connection.rollback()
 
         start_time = time.time()
 
-        # this SELECT statement fetches the rows that match the legacy pattern
-        cur.execute(select_str + ';')
+        # we retreive the entries in batches, one page of the legacy rows at a time
+        batch, batch_start_id, last_id = fetch_next_legacy_batch(cur, start_id, min(get_batch_size(), rows_to_fetch), end_id, checkpoint)
+        rows_to_fetch -= len(batch)
+
         end_time = time.time()
 
         elapsed_time = round(end_time - start_time, 2)
 
         logger.debug('')
-        logger.debug(f"The execution of SELECT took {elapsed_time} seconds\n")
+        logger.debug(f"The execution of the first SELECT took {elapsed_time} seconds\n")
 
-        # we retreive the entries in batches
-        batch = cur.fetchmany(batch_size)
+        # the pool is created once and its workers process many batches over their lifetime
+        # the results travel back through the pool's own result pipe
+        # the existence checks are done with the key index, if one was prepared
+        if own_pool:
+            pool = create_worker_pool(parallelization_level, engine, max_in_flight, key_index_filename, overwrite, size_index_filename)
 
-        # Create a queue to pass data between processes
-        manager = Manager()
-        queue   = manager.Queue()
+        # the workers report each finished batch through these callbacks, which run in a
+        # helper thread of the pool, so we hand the results over with a thread safe queue
+        completed_batches = queue.Queue()
 
         nr_batches_processed = 0
-        while len(batch) > 0:
-            nr_processes = 0
-            processes = []
-            while nr_processes < parallelization_level and len(batch) > 0:
-
-                args = (bucket_src, bucket_dst, batch, dry_run, overwrite, queue)
-                proc = Process(target=process_batch, args=args)
-                proc.daemon = True
-
-                processes.append(proc)
-                nr_processes += 1
-
-                batch = cur.fetchmany(batch_size)
-
-            # we exited the inner loop because we either reached the desired number of processes
-            # or because there are no more batches
-
-            # now let's start the processes
-            for p in processes:
-                p.start()
-
-            # and wait for their completion
-            for p in processes:
-                p.join()
-                nr_batches_processed += 1
-
-            # and now the lets the results from the queue
-            result_list = []
-            try:
-                # get all the items until the queue is empty
-                while True:
-                    entry = queue.get(False)
-                    result_list.append(entry)
-
-            except Exception as ex:
-                pass
-
-            # and proceed with the sums for this process group
-            copied_files = 0
-            updated_rows = 0
-            for result in result_list:
-                copied_files += result['copied_files']
-                updated_rows += result['updated_rows']
+        nr_batches_in_flight = 0
+        nr_rows_processed    = 0
+        highest_processed_id = start_id
+        progress_fraction    = 0
+
+        if progress_stream is not None:
+            start_progress_window(progress_stream, start_time)
+
+        def get_remaining_rows():
+            if limit > 0:
+                return limit - nr_rows_processed
+            if initial_legacy_rows is not None:
+                return max(initial_legacy_rows - nr_rows_processed, 0)
+            return None
+        while (len(batch) > 0 and not stop_requested) or nr_batches_in_flight > 0:
+
+            # we keep exactly parallelization_level batches in flight while there are batches left
+            # so that a slow batch does not leave the remaining workers idle
+            # the adaptive controller may keep fewer in flight, but never more than there are workers
+            while nr_batches_in_flight < get_batches_in_flight() and len(batch) > 0 and not stop_requested:
+
+                # each result is tagged with the range of ids of its batch, its size and the time it was submitted,
+                # for the checkpoint, the progress and the adaptive controller
+                batch_range = (batch_start_id, last_id, len(batch), time.time())
+                args = (bucket_src, bucket_dst, batch, dry_run, overwrite)
+                pool.apply_async(process_batch_in_worker, args,
+                                 callback=lambda result, batch_range=batch_range: completed_batches.put((batch_range, result)),
+                                 error_callback=lambda error, batch_range=batch_range: completed_batches.put((batch_range, error)))
+                nr_batches_in_flight += 1
+
+                batch, batch_start_id, last_id = fetch_next_legacy_batch(cur, last_id, min(get_batch_size(), rows_to_fetch), end_id, checkpoint)
+                rows_to_fetch -= len(batch)
+
+            # now let's wait for any of the batches in flight to finish
+            batch_range, result = completed_batches.get()
+            nr_batches_in_flight -= 1
+
+            if isinstance(result, Exception):
+                raise result
+
+            copied_files = result['copied_files']
+            updated_rows = result['updated_rows']
+            nr_errors    = result['nr_errors']
+            nr_batches_processed += 1
+            nr_rows_processed    += batch_range[2]
+            highest_processed_id  = max(highest_processed_id, batch_range[1])
+
+            # the rows of a batch with errors must be retried when resuming, so its range is not recorded
+            if checkpoint is not None and nr_errors == 0 and not dry_run:
+                record_completed_range(checkpoint, batch_range[0], batch_range[1])
 
             # and here we calculate the totals
             total_copied_files += copied_files
             total_updated_rows += updated_rows
+            total_errors       += nr_errors
+
+            merge_metrics(result['metrics'])
+            observe_metric('batch_seconds', time.time() - batch_range[3])
+            increment_metric('batches_total')
+            increment_metric('throttled_requests_total', result['nr_throttles'])
+
+            if adaptive is not None:
+                adaptive_batch_completed(adaptive, time.time() - batch_range[3], batch_range[2], result['nr_throttles'])
 
             # and provide some progress information
-            progress_pct = round(nr_batches_processed / nr_batches_to_process * 100)
+            if limit > 0:
+                progress_fraction = nr_rows_processed / limit
+            else:
+                progress_fraction = (highest_processed_id - start_id) / max(max_id - start_id, 1)
+            progress_pct = round(progress_fraction * 100)
             cur_time = time.time()
             elapsed_time = round(cur_time - start_time, 2)
 
-            progress_str = f"{msg_prefix}  * Progress {progress_pct:3d}%, batches processed {nr_batches_processed}/{nr_batches_to_process}, files copied {total_copied_files}, rows updated {total_updated_rows}, elapsed time {elapsed_time}"
+            progress_str = f"{msg_prefix}  * Progress {progress_pct:3d}%, batches processed {nr_batches_processed}, files copied {total_copied_files}, rows updated {total_updated_rows}, elapsed time {elapsed_time}"
 
             logger.info(progress_str)
 
+            if progress_stream is not None:
+                write_progress(progress_stream, 'progress', nr_batches_processed, nr_rows_processed, total_copied_files, total_updated_rows, total_errors,
+                               cur_time - start_time, get_remaining_rows(), progress_fraction)
+
+        if own_pool:
+            pool.close()
+            pool.join()
+
+        if progress_stream is not None:
+            if stop_requested:
+                write_progress(progress_stream, 'stopped', nr_batches_processed, nr_rows_processed, total_copied_files, total_updated_rows, total_errors,
+                               time.time() - start_time, get_remaining_rows(), progress_fraction)
+            else:
+                write_progress(progress_stream, 'finished', nr_batches_processed, nr_rows_processed, total_copied_files, total_updated_rows, total_errors,
+                               time.time() - start_time, 0, 1)
+
         cur.close()
 
     except Exception as e:
         logger.error(f"Error getting file list entries: {e}")
+        if pool is not None:
+            pool.terminate()
         db_connection.close()
         exit(E_ERR)
 
-    if total_updated_rows != total_copied_files:
-        logger.error("ERROR: the number of updated rows should be equal to the number of copied files")
+    finally:
+        signal.signal(signal.SIGTERM, previous_sigterm_handler)
+        signal.signal(signal.SIGINT, previous_sigint_handler)
+
+    if stop_requested:
+        if checkpoint is not None:
+            logger.info(f"{msg_prefix}  * Stopped after the batches in flight, the migration will resume after id {checkpoint['watermark']}")
+        else:
+            logger.info(f"{msg_prefix}  * Stopped after the batches in flight")
+
+    if adaptive is not None:
+        log_adaptive_summary(adaptive)
+
+    # the files that could not be copied are still missing from the destination bucket, so they are retried
+    # but the files whose row could not be updated are already there, and the next execution skips them
+    nr_update_errors = total_copied_files - total_updated_rows
+    nr_copy_errors   = total_errors - nr_update_errors
+
+    if nr_copy_errors > 0:
+        logger.error(f"ERROR: {nr_copy_errors} entries could not be copied, they will be retried on the next execution")
+
+    if nr_update_errors > 0:
+        logger.error(f"ERROR: {nr_update_errors} files were copied but their rows could not be updated, their ids are logged above")
+        logger.error("  * the next execution skips files that already exist, so their rows stay on image/ unless it is run with -w")
+        logger.error("  * they are reported as legacy_with_destination by --verify")
+
+    return total_copied_files, total_updated_rows, total_errors, stop_requested
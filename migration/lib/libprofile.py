@@ -0,0 +1,180 @@
+import os
+import sys
+import glob
+import json
+import pstats
+import cProfile
+import logging
+import threading
+import tracemalloc
+
+from multiprocessing.util import Finalize
+
+from lib.config import *
+
+
+# we obtain the logger declared in main for use within this module
+logger = logging.getLogger("miglogger")
+
+
+# The profiling mode tells where the time and the memory of a migration go.
+#
+# Every process (the main process, which may be the coordinator, and each worker process) runs cProfile and
+# tracemalloc. The profile of every thread is recorded as well, including the threads that pickle the batches
+# for the pool, the threads of the async engine and those of the HTTP servers. Each process writes its part
+# when it finishes, and the main process merges all the parts into a single report next to the log file.
+#
+# The memory is reported per stage: the peak of memory allocated by Python during the stage, above the memory
+# that was already allocated when it started, for the largest occurrence of the stage in any process.
+
+
+# the profiling state of this process, profile_prefix is None when not profiling
+profile_prefix  = None
+profile_name    = None
+profilers       = []
+profilers_lock  = threading.Lock()
+memory_peaks    = {}
+
+
+# this function is installed with threading.setprofile and runs once at the start of each new thread
+# it replaces itself by a profiler for the thread
+def start_thread_profiler(frame, event, arg):
+
+    thread_profiler = cProfile.Profile()
+    try:
+        thread_profiler.enable()
+    except ValueError:
+        # since python 3.12 a single profiler covers all the threads and another one can not be enabled
+        sys.setprofile(None)
+        return
+
+    with profilers_lock:
+        profilers.append(thread_profiler)
+
+
+# this function starts profiling this process, whose part of the report is identified by name
+def start_profiling(prefix, name):
+
+    global profile_prefix
+    global profile_name
+    global profilers
+    global profilers_lock
+    global memory_peaks
+
+    # a forked worker process inherits the state of the main process, which is not its own
+    profile_prefix = prefix
+    profile_name   = name
+    profilers      = []
+    profilers_lock = threading.Lock()
+    memory_peaks   = {}
+
+    if not tracemalloc.is_tracing():
+        tracemalloc.start()
+
+    threading.setprofile(start_thread_profiler)
+
+    main_profiler = cProfile.Profile()
+    main_profiler.enable()
+    profilers.append(main_profiler)
+
+
+# this function starts profiling a worker process, whose part is written when the process exits normally
+def start_worker_profiling(prefix):
+
+    start_profiling(prefix, f"worker-{os.getpid()}")
+
+    Finalize(None, stop_profiling, exitpriority=10)
+
+
+# this function returns the prefix of the files of the profile, or None if this process is not profiling
+def get_profile_prefix():
+
+    return profile_prefix
+
+
+# this function marks the start of a stage and returns what is needed to measure it
+def start_profile_stage():
+
+    if profile_prefix is None:
+        return None
+
+    tracemalloc.reset_peak()
+
+    return tracemalloc.get_traced_memory()[0]
+
+
+# this function marks the end of a stage and records its memory peak
+def end_profile_stage(stage, stage_start):
+
+    if stage_start is None:
+        return
+
+    peak = max(tracemalloc.get_traced_memory()[1] - stage_start, 0)
+    memory_peaks[stage] = max(memory_peaks.get(stage, 0), peak)
+
+
+# this function stops profiling this process and writes its part of the report
+def stop_profiling():
+
+    global profile_prefix
+
+    if profile_prefix is None:
+        return
+
+    threading.setprofile(None)
+
+    with profilers_lock:
+        stats = pstats.Stats(profilers[0])
+        for thread_profiler in profilers[1:]:
+            stats.add(thread_profiler)
+
+    stats.dump_stats(f"{profile_prefix}.{profile_name}.prof")
+
+    with open(f"{profile_prefix}.{profile_name}.memory.json", 'w') as memory_file:
+        json.dump(memory_peaks, memory_file)
+
+    tracemalloc.stop()
+
+    profile_prefix = None
+
+
+# this function merges the parts written by all the processes into the report and returns its file name
+# the merged statistics are also kept in a .prof file, which can be explored with pstats or other tools
+def write_profile_report(prefix):
+
+    profile_filenames = sorted(glob.glob(f"{prefix}.*.prof"))
+    memory_filenames  = sorted(glob.glob(f"{prefix}.*.memory.json"))
+
+    report_filename = f"{prefix}.txt"
+
+    # the largest peak of each stage in any process, and how many processes went through it
+    stage_peaks = {}
+    for memory_filename in memory_filenames:
+        with open(memory_filename, 'r') as memory_file:
+            for stage, peak in json.load(memory_file).items():
+                max_peak, nr_processes = stage_peaks.get(stage, (0, 0))
+                stage_peaks[stage] = (max(max_peak, peak), nr_processes + 1)
+
+    with open(report_filename, 'w') as report_file:
+        report_file.write(f"Profile of {len(profile_filenames)} processes\n\n")
+
+        report_file.write('Peak memory allocated by python per stage:\n')
+        for stage, (peak, nr_processes) in sorted(stage_peaks.items()):
+            report_file.write(f"  * {stage:<20} {round(peak / 1024 / 1024, 2):>10} MiB (largest of {nr_processes} processes)\n")
+        report_file.write('\n')
+
+        if len(profile_filenames) > 0:
+            stats = pstats.Stats(*profile_filenames, stream=report_file)
+            stats.dump_stats(f"{prefix}.prof")
+
+            report_file.write(f"Functions sorted by cumulative time (top {PROFILE_REPORT_LINES}):\n")
+            stats.sort_stats('cumulative').print_stats(PROFILE_REPORT_LINES)
+
+            report_file.write(f"Functions sorted by internal time (top {PROFILE_REPORT_LINES}):\n")
+            stats.sort_stats('tottime').print_stats(PROFILE_REPORT_LINES)
+
+    # the parts are no longer needed once merged
+    for part_filename in profile_filenames + memory_filenames:
+        os.remove(part_filename)
+
+    return report_filename
@@ -0,0 +1,98 @@
+import os
+import json
+import time
+import collections
+
+from lib.config import *
+
+
+# The progress stream is a machine readable version of the progress lines of the log, meant for dashboards and
+# test harnesses. It is written in the JSON lines format, one JSON document per line, to a file or to an inherited
+# file descriptor.
+#
+# Each completed batch produces a "progress" line and the end of the migration a "finished" line, or a "stopped"
+# line if the migration was stopped before the end. All of them have the
+# numbers of batches processed, files copied, rows updated and errors, the throughput in rows per second over
+# the last PROGRESS_RATE_WINDOW seconds and the estimated time to completion in seconds (eta_seconds).
+#
+# The estimate is based on the legacy rows that remain, when their number is known (from the limit or from the
+# database statistics), and otherwise on the position of the scan within the ids of the table.
+
+
+# this function opens a progress stream on a file, or on a file descriptor if one is given instead
+def open_progress_stream(filename=None, fd=None):
+
+    if fd is not None:
+        stream_file = os.fdopen(fd, 'w', buffering=1)
+    else:
+        stream_file = open(filename, 'w', buffering=1)
+
+    return { 'file': stream_file, 'window': collections.deque() }
+
+
+# this function starts measuring the throughput from zero rows at start_time
+# it is called at the start of each migration, as a worker node migrates several ranges with the same stream
+def start_progress_window(stream, start_time):
+
+    stream['window'].clear()
+    stream['window'].append((start_time, 0))
+
+
+# this function returns the rows per second processed over the last PROGRESS_RATE_WINDOW seconds
+def get_progress_rate(stream, now, nr_rows_processed):
+
+    window = stream['window']
+    window.append((now, nr_rows_processed))
+
+    # we always keep the oldest sample within the window and the one before it, so that the window is complete
+    while len(window) > 2 and window[1][0] <= now - PROGRESS_RATE_WINDOW:
+        window.popleft()
+
+    window_start_time, window_start_rows = window[0]
+    if now <= window_start_time:
+        return None
+
+    return (nr_rows_processed - window_start_rows) / (now - window_start_time)
+
+
+# this function writes a line to the progress stream
+# remaining_rows is the estimate of the legacy rows left, or None if unknown, in which case progress_fraction,
+# the fraction of the work done, is used instead
+def write_progress(stream, event, nr_batches_processed, nr_rows_processed, copied_files, updated_rows, nr_errors, elapsed_time, remaining_rows, progress_fraction):
+
+    now = time.time()
+
+    rows_per_sec = get_progress_rate(stream, now, nr_rows_processed)
+
+    eta_seconds = None
+    if event == 'finished':
+        eta_seconds = 0
+    elif remaining_rows is not None:
+        if rows_per_sec:
+            eta_seconds = round(remaining_rows / rows_per_sec, 1)
+    elif progress_fraction > 0:
+        eta_seconds = round(elapsed_time * (1 - progress_fraction) / progress_fraction, 1)
+
+    if rows_per_sec is not None:
+        rows_per_sec = round(rows_per_sec, 2)
+
+    document = { 'event':             event,
+                 'timestamp':         round(now, 3),
+                 'elapsed_time':      round(elapsed_time, 2),
+                 'progress_pct':      round(progress_fraction * 100, 1),
+                 'batches_processed': nr_batches_processed,
+                 'rows_processed':    nr_rows_processed,
+                 'files_copied':      copied_files,
+                 'rows_updated':      updated_rows,
+                 'errors':            nr_errors,
+                 'rows_per_sec':      rows_per_sec,
+                 'remaining_rows':    remaining_rows,
+                 'eta_seconds':       eta_seconds }
+
+    stream['file'].write(json.dumps(document) + '\n')
+
+
+# this function closes a progress stream
+def close_progress_stream(stream):
+
+    stream['file'].close()
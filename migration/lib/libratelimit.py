@@ -0,0 +1,86 @@
+import time
+import logging
+import multiprocessing
+
+
+# we obtain the logger declared in main for use within this module
+logger = logging.getLogger("miglogger")
+
+
+# The rate limits keep the migration below a given number of S3 copies, S3 LIST requests and database rows
+# updated per second, so that it can be throttled during business hours.
+#
+# Each limit is a token bucket that refills at its rate up to its burst. The state of a bucket (the tokens left
+# and the time of the last refill) is kept in shared memory, so a limit is global to the main process and all the
+# worker processes it creates, which receive the buckets when the pool starts them. With several worker nodes,
+# each node has its own limits.
+#
+# Tokens are taken even when there are not enough of them, leaving the bucket in debt, and the caller sleeps
+# until the debt is paid back. This way a request larger than the burst (a batch of rows) is still served, and
+# callers are served in the order in which they arrive.
+
+
+# the buckets in use by this process, by name (s3_copy, s3_list and db_rows), set with set_rate_limits
+rate_limits = {}
+
+
+# this function creates a token bucket, which starts full
+def create_rate_limit(rate, burst):
+
+    return { 'rate':  rate,
+             'burst': burst,
+             'state': multiprocessing.Array('d', [ burst, time.monotonic() ]) }
+
+
+# this function creates the buckets of the limits that are set, a rate of 0 means unlimited
+# a burst of None means one second worth of the rate
+def create_rate_limits(s3_copy_rate, s3_copy_burst, s3_list_rate, s3_list_burst, db_rows_rate, db_rows_burst):
+
+    limits = {}
+
+    for name, description, rate, burst in [ ('s3_copy', 'S3 copies',              s3_copy_rate, s3_copy_burst),
+                                            ('s3_list', 'S3 LIST requests',       s3_list_rate, s3_list_burst),
+                                            ('db_rows', 'database rows updated',  db_rows_rate, db_rows_burst) ]:
+        if rate > 0:
+            if burst is None:
+                burst = max(rate, 1)
+            limits[name] = create_rate_limit(rate, burst)
+            logger.info(f"Limiting {description} to {rate} per second, with bursts of up to {burst}")
+
+    return limits
+
+
+# this function sets the buckets used by the current process
+def set_rate_limits(limits):
+
+    global rate_limits
+
+    rate_limits = limits
+
+
+# this function returns the buckets used by the current process, to hand them over to the worker processes
+def get_rate_limits():
+
+    return rate_limits
+
+
+# this function takes amount tokens from a bucket, waiting as long as needed for them
+# it returns immediately if there is no limit with that name
+def acquire_rate_limit(name, amount=1):
+
+    limit = rate_limits.get(name)
+    if limit is None or amount <= 0:
+        return
+
+    # the monotonic clock is the same for all the processes of the host
+    state = limit['state']
+    with state.get_lock():
+        now = time.monotonic()
+        tokens = min(limit['burst'], state[0] + (now - state[1]) * limit['rate'])
+        tokens -= amount
+        state[0] = tokens
+        state[1] = now
+
+    # we sleep outside of the lock, so that other callers can queue behind us in the meantime
+    if tokens < 0:
+        time.sleep(-tokens / limit['rate'])
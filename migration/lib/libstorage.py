@@ -0,0 +1,307 @@
+import os
+import uuid
+import fcntl
+import shutil
+import boto3
+import botocore
+
+from lib.config import *
+from lib.libratelimit import acquire_rate_limit
+
+
+# The storage is where the buckets live. The migration only needs a few operations on it: list the keys of a
+# bucket, check if a key exists, copy an object between buckets, put an object and delete objects.
+#
+# A storage is represented by a dictionary with the name of its backend, the operations of the backend and
+# whatever the backend needs (the S3 client or the root directory). The functions below call the operations
+# of the backend, so the rest of the code does not depend on it. There are two backends:
+#   * s3, the S3 compatible service of the configuration
+#   * local, where each bucket is a directory of STORAGE_LOCAL_ROOT and each key a file in that directory,
+#     so that the whole cycle can run offline and the copy engine can be profiled without the network
+#
+# The local backend makes every change with an atomic rename, so concurrent readers never see a partial object,
+# and copies objects with hard links or reflinks, which do not copy any data (see STORAGE_LOCAL_COPY).
+
+
+# the ioctl that clones a file into another one on file systems with copy-on-write support (btrfs, xfs)
+LOCAL_FICLONE = 0x40049409
+
+
+# this function connects to an S3 compatible service
+# the client is thread safe and can keep up to max_pool_connections connections open at once
+def connect_s3_storage(storage, max_pool_connections):
+
+    session = boto3.session.Session()
+    storage['client'] = session.client('s3',
+                                       config=botocore.config.Config(s3={'addressing_style': S3_ADDRESSING_STYLE}, max_pool_connections=max_pool_connections),
+                                       region_name=AWS_DEFAULT_REGION,
+                                       endpoint_url=S3_ENDPOINT_URL_LEG,
+                                       aws_access_key_id=AWS_ACCESS_KEY_ID,
+                                       aws_secret_access_key=AWS_SECRET_ACCESS_KEY)
+    storage['location'] = S3_BUCKET_DOMAIN
+
+
+# this function yields the keys of a bucket one page of up to S3_MAX_OBJECTS_REQ keys at a time, one LIST request per page
+def list_s3_pages(storage, bucket_name, prefix, start_after):
+
+    list_args = { 'Bucket': bucket_name, 'Prefix': prefix, 'MaxKeys': S3_MAX_OBJECTS_REQ }
+    if start_after is not None:
+        list_args['StartAfter'] = start_after
+
+    # we need to loop because the list_objects_v2 functions never returns more than 1000
+    # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/s3/client/list_objects_v2.html#list-objects-v2
+    while True:
+        acquire_rate_limit('s3_list')
+        response = storage['client'].list_objects_v2(**list_args)
+        yield [ obj['Key'] for obj in response.get('Contents', []) ]
+
+        if not response.get('IsTruncated'):
+            return
+
+        list_args['ContinuationToken'] = response.get('NextContinuationToken')
+
+
+# this function checks if a key exists in a bucket with a single LIST request
+# a key comes before all the other keys it is a prefix of, so it is the first one listed if it exists
+def s3_key_exists(storage, bucket_name, key):
+
+    response = storage['client'].list_objects_v2(Bucket=bucket_name, Prefix=key, MaxKeys=1)
+
+    return any(obj['Key'] == key for obj in response.get('Contents', []))
+
+
+# this function copies an object on the server side
+def copy_s3_storage_object(storage, bucket_src, key_src, bucket_dst, key_dst):
+
+    # reference https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/s3/client/copy.html#copy
+    # initial code: s3_connection.copy(copy_source, bucket_dst, new_key)
+    # initially we used copy() but it turns out that copy_object is twice as fast
+    # at least for small files
+    storage['client'].copy_object(CopySource=f"{bucket_src}/{key_src}", Bucket=bucket_dst, Key=key_dst)
+
+
+# this function creates an object
+def put_s3_object(storage, bucket_name, key, body):
+
+    storage['client'].put_object(Bucket=bucket_name, Key=key, Body=body)
+
+
+# this function deletes up to S3_MAX_OBJECTS_REQ objects with a single request
+# it returns the keys that could not be deleted together with the reason
+def delete_s3_objects(storage, bucket_name, keys):
+
+    response = storage['client'].delete_objects(Bucket=bucket_name, Delete={ 'Objects': [ { 'Key': key } for key in keys ], 'Quiet': True })
+
+    # in quiet mode only the keys that could not be deleted are returned
+    return [ (error.get('Key'), error.get('Message')) for error in response.get('Errors', []) ]
+
+
+# this function sets up a local storage, whose buckets are the directories of STORAGE_LOCAL_ROOT
+# the temporary files are written to a directory of the same file system, so that they can be renamed into the buckets,
+# whose name starts with a dot so that it can not be a bucket
+def connect_local_storage(storage, max_pool_connections):
+
+    if STORAGE_LOCAL_COPY not in [ 'hardlink', 'reflink', 'copy' ]:
+        raise ValueError(f"unknown copy mode {STORAGE_LOCAL_COPY} of the local storage")
+
+    storage['root']     = STORAGE_LOCAL_ROOT
+    storage['tmp_dir']  = os.path.join(STORAGE_LOCAL_ROOT, '.tmp')
+    storage['location'] = STORAGE_LOCAL_ROOT
+
+    os.makedirs(storage['tmp_dir'], exist_ok=True)
+
+
+# this function returns the path of the file of an object of the local storage
+def get_local_path(storage, bucket_name, key):
+
+    # the keys are relative paths, a key that would escape its bucket is refused
+    if key.startswith('/') or '..' in key.split('/'):
+        raise ValueError(f"invalid key {key}")
+
+    return os.path.join(storage['root'], bucket_name, key)
+
+
+# this function returns a new temporary path of the local storage
+def get_local_tmp_path(storage):
+
+    return os.path.join(storage['tmp_dir'], uuid.uuid4().hex)
+
+
+# this function yields the keys under a directory of a bucket in lexicographic order, as S3 lists them
+# path_prefix is the key prefix of the directory, the subtrees that can not have a key matching prefix and
+# coming after start_after are not visited
+def walk_local_keys(directory, path_prefix, prefix, start_after):
+
+    try:
+        entries = list(os.scandir(directory))
+    except FileNotFoundError:
+        return
+
+    # a directory is sorted as its name followed by a slash, which is the prefix of all the keys within it
+    named_entries = []
+    for entry in entries:
+        if entry.is_dir():
+            named_entries.append((f"{path_prefix}{entry.name}/", entry))
+        elif entry.is_file():
+            named_entries.append((f"{path_prefix}{entry.name}", entry))
+    named_entries.sort(key=lambda named_entry: named_entry[0])
+
+    for name, entry in named_entries:
+        if entry.is_dir():
+            if not (name.startswith(prefix) or prefix.startswith(name)):
+                continue
+            if start_after is not None and name < start_after and not start_after.startswith(name):
+                continue
+            yield from walk_local_keys(entry.path, name, prefix, start_after)
+        else:
+            if not name.startswith(prefix):
+                continue
+            if start_after is not None and name <= start_after:
+                continue
+            yield name
+
+
+# this function yields the keys of a local bucket one page of up to S3_MAX_OBJECTS_REQ keys at a time
+# each page stands for a LIST request, so it is rate limited in the same way before it is read
+# a bucket that does not exist yet is empty
+def list_local_pages(storage, bucket_name, prefix, start_after):
+
+    acquire_rate_limit('s3_list')
+    page = []
+    for key in walk_local_keys(os.path.join(storage['root'], bucket_name), '', prefix, start_after):
+        page.append(key)
+        if len(page) == S3_MAX_OBJECTS_REQ:
+            yield page
+            acquire_rate_limit('s3_list')
+            page = []
+
+    yield page
+
+
+# this function checks if a key exists in a local bucket
+def local_key_exists(storage, bucket_name, key):
+
+    return os.path.isfile(get_local_path(storage, bucket_name, key))
+
+
+# this function moves a temporary file to its place in a bucket
+def rename_local_tmp_file(storage, tmp_path, bucket_name, key):
+
+    path = get_local_path(storage, bucket_name, key)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    os.replace(tmp_path, path)
+
+
+# this function copies an object of the local storage according to STORAGE_LOCAL_COPY
+# the objects are never modified in place, only replaced by a rename, so a hard link is as good as a copy
+def copy_local_object(storage, bucket_src, key_src, bucket_dst, key_dst):
+
+    src_path = get_local_path(storage, bucket_src, key_src)
+    tmp_path = get_local_tmp_path(storage)
+
+    try:
+        if STORAGE_LOCAL_COPY == 'hardlink':
+            os.link(src_path, tmp_path)
+        else:
+            with open(src_path, 'rb') as src_file, open(tmp_path, 'wb') as tmp_file:
+                cloned = False
+                if STORAGE_LOCAL_COPY == 'reflink':
+                    try:
+                        fcntl.ioctl(tmp_file.fileno(), LOCAL_FICLONE, src_file.fileno())
+                        cloned = True
+                    except OSError:
+                        # the file system does not support reflinks, so the data is copied instead
+                        pass
+                if not cloned:
+                    shutil.copyfileobj(src_file, tmp_file)
+
+        rename_local_tmp_file(storage, tmp_path, bucket_dst, key_dst)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+# this function creates an object of the local storage
+def put_local_object(storage, bucket_name, key, body):
+
+    if isinstance(body, str):
+        body = body.encode()
+
+    tmp_path = get_local_tmp_path(storage)
+
+    try:
+        with open(tmp_path, 'wb') as tmp_file:
+            tmp_file.write(body)
+
+        rename_local_tmp_file(storage, tmp_path, bucket_name, key)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+# this function deletes objects of the local storage
+# as on S3, deleting a key that does not exist is not an error
+def delete_local_objects(storage, bucket_name, keys):
+
+    errors = []
+    for key in keys:
+        try:
+            os.remove(get_local_path(storage, bucket_name, key))
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            errors.append((key, str(e)))
+
+    return errors
+
+
+# the operations of each backend
+STORAGE_BACKENDS = { 's3':    { 'connect': connect_s3_storage,    'list_pages': list_s3_pages,    'exists': s3_key_exists,
+                                'copy':    copy_s3_storage_object, 'put':       put_s3_object,     'delete': delete_s3_objects },
+                     'local': { 'connect': connect_local_storage, 'list_pages': list_local_pages, 'exists': local_key_exists,
+                                'copy':    copy_local_object,     'put':        put_local_object, 'delete': delete_local_objects } }
+
+
+# this function obtains a storage of the backend of the configuration
+# the storage is thread safe and the S3 backend can keep up to max_pool_connections connections open at once
+def get_storage(max_pool_connections=S3_DEFAULT_POOL_CONNECTIONS):
+
+    if STORAGE_BACKEND not in STORAGE_BACKENDS:
+        raise ValueError(f"unknown storage backend {STORAGE_BACKEND}")
+
+    storage = { 'backend': STORAGE_BACKEND, 'operations': STORAGE_BACKENDS[STORAGE_BACKEND] }
+    storage['operations']['connect'](storage, max_pool_connections)
+
+    return storage
+
+
+# this function yields the keys of a bucket with a given prefix and after a given key, one page at a time, in lexicographic order
+# the limit of LIST requests is applied by the backends, right before each request
+def list_storage_pages(storage, bucket_name, prefix='', start_after=None):
+
+    return storage['operations']['list_pages'](storage, bucket_name, prefix, start_after)
+
+
+# this function checks if a key exists in a bucket
+def storage_key_exists(storage, bucket_name, key):
+
+    return storage['operations']['exists'](storage, bucket_name, key)
+
+
+# this function copies an object from a bucket to another one, overwriting the destination if it exists
+def copy_storage_object(storage, bucket_src, key_src, bucket_dst, key_dst):
+
+    storage['operations']['copy'](storage, bucket_src, key_src, bucket_dst, key_dst)
+
+
+# this function creates an object, overwriting it if it exists
+def put_storage_object(storage, bucket_name, key, body):
+
+    storage['operations']['put'](storage, bucket_name, key, body)
+
+
+# this function deletes up to S3_MAX_OBJECTS_REQ objects of a bucket
+# it returns the keys that could not be deleted together with the reason
+def delete_storage_objects(storage, bucket_name, keys):
+
+    return storage['operations']['delete'](storage, bucket_name, keys)
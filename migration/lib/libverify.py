@@ -0,0 +1,276 @@
+import time
+import signal
+import logging
+
+from multiprocessing import Pool
+
+from lib.config import *
+from lib.libmig import get_db_connection, get_listing_boundaries
+from lib.libstorage import get_storage, list_storage_pages
+from lib.libratelimit import set_rate_limits, get_rate_limits
+from lib.liblog import configure_worker_logging, get_log_queue, get_object_log_detail
+
+
+# we obtain the logger declared in main for use within this module
+logger = logging.getLogger("miglogger")
+
+
+# The verification checks every row of the avatars table against the buckets, and every object of the buckets
+# against the table, without holding any of them in memory.
+#
+# The rows and the objects are matched by file name: image/avatar-X.png is on the legacy bucket, and once migrated
+# avatar/avatar-X.png is on the production bucket. Four streams are read in file name order: the rows whose path
+# starts with avatar/, those whose path starts with image/, and the keys of the two buckets with the same prefixes.
+# As all of them are sorted, they are joined like the sorted runs of a merge sort, one file name at a time.
+#
+# The file names are split into ranges at the first digits of the avatar number (see S3_LIST_PARTITION_DIGITS),
+# which are verified by a pool of worker processes, each with its own database connection and storage.
+#
+# The findings are appended to a report next to the log file, one per line:
+#   * dangling_reference: a row whose path points to an object that does not exist
+#   * orphaned_object: an object that no row points to, neither on the legacy nor on the production bucket
+#   * legacy_with_destination: a row still on the legacy bucket whose object already exists on the production bucket,
+#     which only needs its path to be updated (a copy whose update failed or was interrupted)
+
+
+# the categories of the findings of the report, in the order of the technical status
+VERIFY_CATEGORIES = [ 'dangling_reference', 'orphaned_object', 'legacy_with_destination' ]
+
+
+# the state of each worker process of the verification
+verify_db_connection = None
+verify_storage       = None
+verify_report_file   = None
+
+
+# this function returns the ranges of file names that are verified independently, as (start_after, end_at) pairs
+# a None start or end means that the range is open on that side
+def get_verify_ranges():
+
+    boundaries = get_listing_boundaries(prefixes=[ 'avatar-' ])
+
+    return list(zip([ None ] + boundaries, boundaries + [ None ]))
+
+
+# this function checks that the avatars table has an index on the paths in byte order
+# without it each range is a scan and a sort of the whole table, so the verification is only attempted with a warning
+def check_verify_index(db_connection):
+
+    cur = db_connection.cursor()
+    try:
+        cur.execute("SELECT indexdef FROM pg_indexes WHERE tablename = 'avatars';")
+        index_definitions = [ row[0] for row in cur.fetchall() ]
+    except Exception as e:
+        logger.debug(f"The indexes of the avatars table could not be checked: {e}")
+        db_connection.rollback()
+        return
+    finally:
+        cur.close()
+
+    if not any('(path COLLATE "C")' in index_definition for index_definition in index_definitions):
+        logger.info('WARNING: the avatars table has no index on path COLLATE "C", each range of the verification will scan the whole table')
+        logger.info('  * create it with: CREATE INDEX avatars_path_c_idx ON avatars (path COLLATE "C");')
+
+
+# this function yields the (file name, id) pairs of the rows whose path has a given prefix, in file name order
+# a server side cursor brings the rows VERIFY_DB_FETCH_SIZE at a time, so the memory used does not depend on the range
+# the "C" collation sorts the paths by their bytes, which is the order of the bucket listings
+def stream_db_range(db_connection, prefix, start_after, end_at):
+
+    lower = prefix + (start_after or '')
+
+    # the end of an open range is the end of the prefix
+    if end_at is not None:
+        query = 'SELECT id, path FROM avatars WHERE path COLLATE "C" > %s AND path COLLATE "C" <= %s ORDER BY path COLLATE "C";'
+        upper = prefix + end_at
+    else:
+        query = 'SELECT id, path FROM avatars WHERE path COLLATE "C" > %s AND path COLLATE "C" < %s ORDER BY path COLLATE "C";'
+        upper = prefix[:-1] + chr(ord(prefix[-1]) + 1)
+
+    cur = db_connection.cursor(name=f"verify_{prefix.strip('/')}")
+    try:
+        cur.execute(query, (lower, upper))
+        while True:
+            rows = cur.fetchmany(VERIFY_DB_FETCH_SIZE)
+            if len(rows) == 0:
+                break
+            for row_id, path in rows:
+                yield path[len(prefix):], row_id
+    finally:
+        cur.close()
+
+
+# this function yields the (file name, key) pairs of the objects of a bucket whose key has a given prefix, in file name order
+def stream_bucket_range(storage, bucket_name, prefix, start_after, end_at):
+
+    start_key = prefix + start_after if start_after is not None else None
+    end_key   = prefix + end_at if end_at is not None else None
+
+    for keys in list_storage_pages(storage, bucket_name, prefix, start_key):
+        for key in keys:
+            # the keys are listed in order, so we can stop as soon as we go past the end of the range
+            if end_key is not None and key > end_key:
+                return
+            yield key[len(prefix):], key
+
+
+# this function joins sorted streams of (file name, value) pairs
+# it yields each file name with the values of each stream for that file name, of which there are usually none or one
+def join_sorted_streams(streams):
+
+    heads = [ next(stream, None) for stream in streams ]
+
+    while any(head is not None for head in heads):
+        filename = min(head[0] for head in heads if head is not None)
+
+        values = []
+        for position, stream in enumerate(streams):
+            stream_values = []
+            while heads[position] is not None and heads[position][0] == filename:
+                stream_values.append(heads[position][1])
+                heads[position] = next(stream, None)
+            values.append(stream_values)
+
+        yield filename, values
+
+
+# this function verifies a range of file names and appends its findings to the report
+# it returns the counts of the range
+def verify_range(db_connection, storage, report_file, start_after, end_at):
+
+    counts = { 'rows': 0, 'objects': 0, 'migrated_legacy_objects': 0 }
+    for category in VERIFY_CATEGORIES:
+        counts[category] = 0
+
+    findings = []
+
+    def add_finding(category, row_id, location):
+        counts[category] += 1
+        findings.append(f"{category},{row_id if row_id is not None else ''},{location}\n")
+        if len(findings) >= VERIFY_REPORT_FLUSH_SIZE:
+            flush_findings()
+
+    # the findings are written with a single write, so the lines of several workers are not mixed
+    def flush_findings():
+        if len(findings) > 0:
+            report_file.write(''.join(findings).encode())
+            findings.clear()
+
+    streams = [ stream_db_range(db_connection, 'avatar/', start_after, end_at),
+                stream_db_range(db_connection, 'image/', start_after, end_at),
+                stream_bucket_range(storage, S3_BUCKET_NAME, 'avatar/', start_after, end_at),
+                stream_bucket_range(storage, S3_BUCKET_NAME_LEG, 'image/', start_after, end_at) ]
+
+    try:
+        for filename, (production_ids, legacy_ids, production_keys, legacy_keys) in join_sorted_streams(streams):
+            counts['rows']    += len(production_ids) + len(legacy_ids)
+            counts['objects'] += len(production_keys) + len(legacy_keys)
+
+            for row_id in production_ids:
+                if len(production_keys) == 0:
+                    add_finding('dangling_reference', row_id, f"avatar/{filename}")
+
+            # a legacy row may be both, when its object is missing but has already been copied
+            for row_id in legacy_ids:
+                if len(legacy_keys) == 0:
+                    add_finding('dangling_reference', row_id, f"image/{filename}")
+                if len(production_keys) > 0:
+                    add_finding('legacy_with_destination', row_id, f"image/{filename}")
+
+            # the legacy objects are not deleted by the migration, so those of migrated rows are expected
+            if len(production_ids) == 0 and len(legacy_ids) == 0:
+                for key in production_keys:
+                    add_finding('orphaned_object', None, f"{S3_BUCKET_NAME}/{key}")
+                for key in legacy_keys:
+                    add_finding('orphaned_object', None, f"{S3_BUCKET_NAME_LEG}/{key}")
+            elif len(legacy_ids) == 0:
+                counts['migrated_legacy_objects'] += len(legacy_keys)
+
+        flush_findings()
+    finally:
+        # the server side cursors belong to the transaction, which only reads
+        db_connection.rollback()
+
+    return counts
+
+
+# this function is executed once by each process of the verification pool
+def init_verify_worker(report_filename, rate_limits=None, log_queue=None, object_log_detail=LOG_OBJECT_DETAIL):
+
+    global verify_db_connection
+    global verify_storage
+    global verify_report_file
+
+    # only the main process handles Ctrl-C, and the pool terminates the workers if needed
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+
+    # the records of the worker are written by the main process
+    configure_worker_logging(log_queue, object_log_detail)
+
+    # the rate limits are shared with the main process and the other workers
+    if rate_limits is not None:
+        set_rate_limits(rate_limits)
+
+    verify_db_connection = get_db_connection()
+    verify_storage       = get_storage()
+
+    # each worker appends to the report with its own descriptor, and appends are atomic for the writes we do
+    verify_report_file = open(report_filename, 'ab', buffering=0)
+
+
+# this function is the entry point of the verification pool for each range
+def verify_range_in_worker(verify_range_bounds):
+
+    global verify_db_connection
+
+    # the database server may have dropped the connection since the previous range
+    if verify_db_connection.closed:
+        verify_db_connection = get_db_connection()
+
+    return verify_range(verify_db_connection, verify_storage, verify_report_file, *verify_range_bounds)
+
+
+# this function verifies the whole table and both buckets with parallelization_level worker processes
+# it writes the findings to the report and returns the total counts
+def verify_data(parallelization_level, report_filename):
+
+    start_time = time.time()
+
+    with open(report_filename, 'w') as report_file:
+        report_file.write('category,id,location\n')
+
+    ranges = get_verify_ranges()
+
+    totals = { 'rows': 0, 'objects': 0, 'migrated_legacy_objects': 0 }
+    for category in VERIFY_CATEGORIES:
+        totals[category] = 0
+
+    logger.info('')
+    logger.info('Verification progress:')
+
+    with Pool(processes=parallelization_level, initializer=init_verify_worker, initargs=(report_filename, get_rate_limits(), get_log_queue(), get_object_log_detail())) as pool:
+        nr_ranges_verified = 0
+        last_progress_pct  = 0
+
+        # the ranges are small, so their order of completion does not matter
+        for counts in pool.imap_unordered(verify_range_in_worker, ranges):
+            for name, count in counts.items():
+                totals[name] += count
+            nr_ranges_verified += 1
+
+            progress_pct = nr_ranges_verified * 100 // len(ranges)
+            if progress_pct >= last_progress_pct + 10 or nr_ranges_verified == len(ranges):
+                last_progress_pct = progress_pct
+                elapsed_time = round(time.time() - start_time, 2)
+                logger.info(f"  * Progress {progress_pct:3}%, rows checked {totals['rows']}, objects checked {totals['objects']}, findings {sum(totals[category] for category in VERIFY_CATEGORIES)}, elapsed time {elapsed_time}")
+
+    logger.info('')
+    logger.info('Verification results:')
+    logger.info(f"  * {totals['rows']} rows and {totals['objects']} objects checked")
+    logger.info(f"  * {totals['dangling_reference']} rows pointing to objects that do not exist")
+    logger.info(f"  * {totals['orphaned_object']} objects that no row points to")
+    logger.info(f"  * {totals['legacy_with_destination']} legacy rows whose object already exists on {S3_BUCKET_NAME}")
+    logger.info(f"  * {totals['migrated_legacy_objects']} legacy objects of migrated rows, which can be deleted")
+
+    return totals
@@ -11,8 +11,20 @@ import argparse
 # all constants are in use and are UPPER_CASE, no danger in sight
 from lib.config import *
 
-from lib.libmig import ( copy_s3_batch, update_db_batch, migrate_legacy_data, get_db_connection, get_s3_connection, get_log_filename,
+from lib.libmig import ( copy_s3_batch, update_db_batch, migrate_legacy_data, create_worker_pool, get_db_connection, get_log_filename,
                          check_status, check_bucket_read_permissions, check_bucket_write_permissions )
+from lib.libindex import prepare_key_index, prepare_size_index
+from lib.libinventory import load_inventory
+from lib.libverify import verify_data, check_verify_index
+from lib.liblog import start_log_listener, set_object_log_detail
+from lib.libstorage import get_storage
+from lib.libcoord import run_coordinator, run_worker_node
+from lib.libcheckpoint import open_checkpoint, close_checkpoint
+from lib.libadaptive import create_adaptive_controller
+from lib.libratelimit import create_rate_limits, set_rate_limits
+from lib.libmetrics import start_metrics_server, write_metrics_summary
+from lib.libprogress import open_progress_stream, close_progress_stream
+from lib.libprofile import start_profiling, stop_profiling, start_profile_stage, end_profile_stage, write_profile_report
 
 
 # we obtain the logger declared in main for use within this module
@@ -30,6 +42,10 @@ def check_environment():
         logger.error('the SKETCH_DB_PASS environment variable is not defined')
         exit(E_ERR)
 
+    # the local storage needs no credentials
+    if STORAGE_BACKEND == 'local':
+        return
+
     if AWS_ACCESS_KEY_ID is None:
         logger.error('the AWS_ACCESS_KEY_ID environment variable is not defined')
         exit(E_ERR)
@@ -65,14 +81,42 @@ def main():
     parser.add_argument('-p', '--parallelization-level', help='number of parallel worker processes',        type=int, default=1)
     parser.add_argument('-b', '--batch-size',            help='number of db and s3 entries per iteration',  type=int, default=20)
     parser.add_argument('-l', '--limit',                 help='limit for the number of entries to migrate', type=int, default=0)
+    parser.add_argument('-e', '--engine',                help='S3 copy engine used by each worker process', choices=['sync', 'async'], default='sync')
+    parser.add_argument('-a', '--start-after-id',        help='only migrate the entries whose id is greater than this one', type=int, default=0)
+    parser.add_argument('-i', '--max-in-flight',         help='maximum S3 copies in flight per worker process with the async engine', type=int, default=S3_MAX_IN_FLIGHT)
+    parser.add_argument('--coordinator-listen',          help='run as the coordinator of several worker nodes, listening on HOST:PORT', type=str, default=None)
+    parser.add_argument('--coordinator-url',             help='run as a worker node of the coordinator at this URL, e.g. http://HOST:PORT', type=str, default=None)
+    parser.add_argument('--range-size',                  help='number of ids per range leased by the coordinator', type=int, default=COORD_RANGE_SIZE)
+    parser.add_argument('--lease-duration',              help='seconds after which a lease that is not renewed expires', type=int, default=COORD_LEASE_DURATION)
+    parser.add_argument('-f', '--fan-out',               help='number of parallel listings when counting the objects of a bucket', type=int, default=S3_LIST_FAN_OUT)
+    parser.add_argument('-j', '--journal',               help='checkpoint journal file used to resume an interrupted migration', type=str, default=None)
+    parser.add_argument('-k', '--key-index',             help='file with an index of the production bucket keys, used instead of per key LISTs', type=str, default=None)
+    parser.add_argument('--min-parallelization',         help='lower bound of the batches in flight with --adaptive, -p is the upper bound', type=int, default=ADAPTIVE_MIN_IN_FLIGHT)
+    parser.add_argument('--min-batch-size',              help='lower bound of the batch size with --adaptive, -b is the upper bound', type=int, default=ADAPTIVE_MIN_BATCH_SIZE)
+    parser.add_argument('--copy-rate',                   help='maximum S3 copies per second, 0 means unlimited', type=float, default=S3_COPY_RATE_LIMIT)
+    parser.add_argument('--copy-burst',                  help='maximum S3 copies in a burst, one second worth of --copy-rate by default', type=float, default=None)
+    parser.add_argument('--list-rate',                   help='maximum S3 LIST requests per second, 0 means unlimited', type=float, default=S3_LIST_RATE_LIMIT)
+    parser.add_argument('--list-burst',                  help='maximum S3 LIST requests in a burst, one second worth of --list-rate by default', type=float, default=None)
+    parser.add_argument('--db-rate',                     help='maximum database rows updated per second, 0 means unlimited', type=float, default=DB_ROWS_RATE_LIMIT)
+    parser.add_argument('--db-burst',                    help='maximum database rows updated in a burst, one second worth of --db-rate by default', type=float, default=None)
+    parser.add_argument('--progress-stream',             help='write the progress in the JSON lines format to this file', type=str, default=None)
+    parser.add_argument('--progress-fd',                 help='write the progress in the JSON lines format to this inherited file descriptor', type=int, default=None)
+    parser.add_argument('--metrics-listen',              help='serve the metrics in the Prometheus text format on HOST:PORT', type=str, default=None)
+    parser.add_argument('--object-log',                  help='detail of the lines about single files with -v, the errors are always logged', choices=['full', 'sampled', 'compact'], default=LOG_OBJECT_DETAIL)
+    parser.add_argument('--inventory',                   help='manifest.json of a locally staged S3 inventory of a bucket, used instead of listing it as far as possible (can be repeated)', type=str, action='append', default=[])
 
     # flags
     parser.add_argument('-v', '--verbose',          help='print extra messages',                            default=False, action='store_true')
     parser.add_argument('-d', '--dry-run',          help='simulate execution without actually executing',   default=False, action='store_true')
     parser.add_argument('-w', '--overwrite',        help='allow overwriting of existing files',             default=False, action='store_true')
     parser.add_argument('-s', '--status-only',      help='only print the data status',                      default=False, action='store_true')
+    parser.add_argument('--verify',                 help='only check every database row against the buckets and the other way round', default=False, action='store_true')
     parser.add_argument('-t', '--technical-status', help='print a line with the numbers at the end',        default=False, action='store_true')
     parser.add_argument('-y', '--say-yes',          help='skip confirmation prompts',                       default=False, action='store_true')
+    parser.add_argument('--approximate',            help='estimate the database status instead of counting it', default=False, action='store_true')
+    parser.add_argument('-r', '--rebuild-key-index', help='list the production bucket again instead of reusing the key index', default=False, action='store_true')
+    parser.add_argument('--profile',                help='profile the execution and write a report next to the log file', default=False, action='store_true')
+    parser.add_argument('--adaptive',               help='adapt the batches in flight and the batch size to throttling and latency', default=False, action='store_true')
 
     args = parser.parse_args()
 
@@ -112,23 +156,115 @@ def main():
     logger.addHandler(console_handler)
     logger.addHandler(file_handler)
 
+    # the worker processes send their records to this process, which is the only one writing the log
+    start_log_listener()
+    set_object_log_detail(args.object_log)
+
     # basic sanity check on the inputs
     if args.batch_size < 1 or args.parallelization_level < 1:
         logger.error('batch size and parallelization level must be positive integers')
         exit(E_ERR)
 
+    if args.fan_out < 1:
+        logger.error('the fan-out must be a positive integer')
+        exit(E_ERR)
+
+    if args.max_in_flight < 1:
+        logger.error('the maximum number of copies in flight must be a positive integer')
+        exit(E_ERR)
+
     if args.limit < 0:
         logger.error('limit must be greater than or equal to zero')
         exit(E_ERR)
 
+    if args.start_after_id < 0:
+        logger.error('the start id must be greater than or equal to zero')
+        exit(E_ERR)
+
+    if args.coordinator_listen is not None and args.coordinator_url is not None:
+        logger.error('a process can either be the coordinator or a worker node, not both')
+        exit(E_ERR)
+
+    if args.limit > 0 and (args.coordinator_listen is not None or args.coordinator_url is not None):
+        logger.error('the limit option can not be used with a coordinator')
+        exit(E_ERR)
+
+    if args.journal is not None and args.coordinator_url is not None:
+        logger.error('the checkpoint journal of a multi-node execution is kept by the coordinator, not by the worker nodes')
+        exit(E_ERR)
+
+    if args.range_size < 1 or args.lease_duration < 1:
+        logger.error('range size and lease duration must be positive integers')
+        exit(E_ERR)
+
+    if args.adaptive and not (1 <= args.min_parallelization <= args.parallelization_level and 1 <= args.min_batch_size <= args.batch_size):
+        logger.error('the lower bounds of the adaptive controller must be positive integers not greater than the parallelization level and the batch size')
+        exit(E_ERR)
+
+    if args.copy_rate < 0 or args.list_rate < 0 or args.db_rate < 0:
+        logger.error('the rate limits must be greater than or equal to zero')
+        exit(E_ERR)
+
+    if any(burst is not None and burst < 1 for burst in [ args.copy_burst, args.list_burst, args.db_burst ]):
+        logger.error('the bursts of the rate limits must be at least 1')
+        exit(E_ERR)
+
+    if args.progress_stream is not None and args.progress_fd is not None:
+        logger.error('the progress can either be written to a file or to a file descriptor, not both')
+        exit(E_ERR)
+
+    if (args.progress_stream is not None or args.progress_fd is not None) and args.coordinator_listen is not None:
+        logger.error('the progress stream is written by the worker nodes, not by the coordinator')
+        exit(E_ERR)
+
+    # the inventories are loaded early, so that a missing data file is found before anything else is done
+    inventories = {}
+    for manifest_filename in args.inventory:
+        try:
+            inventory = load_inventory(manifest_filename)
+        except Exception as e:
+            logger.error(f"Error while loading the inventory {manifest_filename}: {e}")
+            exit(E_ERR)
+
+        if inventory['bucket'] not in [ S3_BUCKET_NAME_LEG, S3_BUCKET_NAME ]:
+            logger.error(f"the inventory {manifest_filename} is of bucket {inventory['bucket']}, which is not migrated")
+            exit(E_ERR)
+
+        if inventory['bucket'] in inventories:
+            logger.error(f"only one inventory can be given for bucket {inventory['bucket']}")
+            exit(E_ERR)
+
+        inventories[inventory['bucket']] = inventory
+
+    # the existence checks use a key index built from the inventory of the production bucket
+    # its default name depends on the inventory and not on the execution, so that the next execution with the same
+    # inventory reuses it and merges the keys copied by this one from its journal
+    if S3_BUCKET_NAME in inventories and args.key_index is None:
+        args.key_index = f"{LOG_DIR}/sketch_key_index_{S3_BUCKET_NAME}_{inventories[S3_BUCKET_NAME]['date']:%Y-%m-%dT%H-%MZ}"
+
+    if args.verify and (args.status_only or args.coordinator_listen is not None or args.coordinator_url is not None):
+        logger.error('the verification can not be combined with the status mode or with a coordinator')
+        exit(E_ERR)
+
     # Check if we have the necessary environment variables defined and fail early otherwise
     check_environment()
 
     # Check if the user really wants to migrate
-    # unless are only printing the status or the user disables confirmations prompts
-    if not args.status_only and not args.say_yes:
+    # unless are only printing the status, verifying, or the user disables confirmations prompts
+    if not args.status_only and not args.verify and not args.say_yes:
         check_willingness(args.overwrite)
 
+    # the profile is written next to the log file and starts before the connections, whose TLS handshakes may be slow
+    profile_prefix = f"{os.path.splitext(log_file)[0]}.profile"
+
+    if args.profile:
+        start_profiling(profile_prefix, 'main')
+
+    stage_start = start_profile_stage()
+
+    # the limits apply from now on, to the status checks as well as to the worker processes
+    set_rate_limits(create_rate_limits(args.copy_rate, args.copy_burst, args.list_rate, args.list_burst, args.db_rate, args.db_burst))
+
     logger.info('Connecting to the database')
 
     # Connect to the database server using our database
@@ -139,61 +275,216 @@ def main():
         logger.error('  * please check the database hostname and credentials.')
         exit(E_ERR)
 
-    logger.info('Connecting to the S3 storage')
+    logger.info(f"Connecting to the {STORAGE_BACKEND} storage")
 
-    # Initialize s3 connection
+    # Initialize the storage of the buckets, an S3 connection or a local directory
     try:
-        s3_conn = get_s3_connection()
+        storage = get_storage()
     except Exception as e:
-        logger.error(f"Error while connecting to S3: {e}")
+        logger.error(f"Error while connecting to the {STORAGE_BACKEND} storage: {e}")
         exit(E_ERR)
 
     # Check if we have the necessary permissions on each buckets
 
-    logger.info(f"Checking S3 read permissions for {S3_BUCKET_NAME_LEG} on {S3_BUCKET_DOMAIN}")
+    logger.info(f"Checking read permissions for {S3_BUCKET_NAME_LEG} on {storage['location']}")
+
+    check_bucket_read_permissions(storage, S3_BUCKET_NAME_LEG)
+
+    # the verification only reads, so it can run with read only credentials
+    if args.verify:
+        logger.info(f"Checking read permissions for {S3_BUCKET_NAME} on {storage['location']}")
+
+        check_bucket_read_permissions(storage, S3_BUCKET_NAME)
+    else:
+        logger.info(f"Checking write permissions for {S3_BUCKET_NAME} on {storage['location']}")
+
+        check_bucket_write_permissions(storage, S3_BUCKET_NAME)
+
+    end_profile_stage('connections', stage_start)
 
-    check_bucket_read_permissions(s3_conn, S3_BUCKET_NAME_LEG)
+    # the verification compares every row with the buckets instead of comparing totals
+    if args.verify:
+        report_file = f"{os.path.splitext(log_file)[0]}.verify.csv"
 
-    logger.info(f"Checking S3 write permissions for {S3_BUCKET_NAME} on {S3_BUCKET_DOMAIN}")
+        check_verify_index(conn)
 
-    check_bucket_write_permissions(s3_conn, S3_BUCKET_NAME)
+        stage_start = start_profile_stage()
+        totals = verify_data(args.parallelization_level, report_file)
+        end_profile_stage('verification', stage_start)
+
+        print('\nThe findings can be reviewed with:')
+        print(f"less {report_file}")
+
+        if args.profile:
+            stop_profiling()
+            print('\nThe profile can be reviewed with:')
+            print(f"less {write_profile_report(profile_prefix)}")
+        if args.technical_status:
+            print(f"\nverify_status {','.join(str(totals[category]) for category in [ 'rows', 'objects', 'dangling_reference', 'orphaned_object', 'legacy_with_destination' ])}")
+        conn.close()
+
+        # a row pointing to an object that does not exist is a failure, the other findings are only reported
+        if totals['dangling_reference'] > 0:
+            exit(E_ERR)
+        exit(E_OK)
 
     # Check the status and reconfirm that the user wants to migrate from this status, if necessary
+    stage_start = start_profile_stage()
     if args.status_only:
-        status = check_status(conn, s3_conn, False)
+        status = check_status(conn, storage, False, args.fan_out, args.approximate, inventories)
+        end_profile_stage('status check', stage_start)
+        if args.profile:
+            stop_profiling()
+            print('\nThe profile can be reviewed with:')
+            print(f"less {write_profile_report(profile_prefix)}")
+        conn.close()
+        if status is None:
+            exit(E_ERR)
         if args.technical_status:
             print(f"\ntech_status {status}")
-        conn.close()
         exit(E_OK)
     else:
-        check_status(conn, s3_conn, not args.say_yes)
+        status = check_status(conn, storage, not args.say_yes, args.fan_out, args.approximate, inventories)
+    end_profile_stage('status check', stage_start)
+
+    # the migration is not started on a database whose status could not be checked
+    if status is None:
+        logger.error('The database status could not be checked, the migration is not started')
+        conn.close()
+        exit(E_ERR)
 
     logger.info('Migrating legacy data')
 
     logger.info(f"The log file for this execution will be {log_file}")
 
+    # the summary of the metrics is written next to the log file
+    metrics_file = f"{os.path.splitext(log_file)[0]}.metrics.json"
+
+    if args.metrics_listen is not None:
+        start_metrics_server(args.metrics_listen)
+
     start_time = time.time()
 
-    logger.info('')
-    logger.info('Progress information:')
-    migrate_legacy_data(conn, s3_conn, S3_BUCKET_NAME_LEG, S3_BUCKET_NAME, start_time, args.batch_size, args.limit, args.dry_run, args.overwrite, args.parallelization_level)
+    # the coordinator is not stopped by a signal, only the worker nodes and the migration are
+    stopped = False
+
+    # the coordinator only hands out ranges of ids, the work is done by the worker nodes
+    if args.coordinator_listen is not None:
+        logger.info('')
+        logger.info('Progress information of the worker nodes:')
+        # the journal of the coordinator records its leases and the ranges completed by the worker nodes
+        if args.journal is not None and not args.dry_run:
+            checkpoint = open_checkpoint(args.journal, args.start_after_id)
+        else:
+            checkpoint = None
+
+        stage_start = start_profile_stage()
+        run_coordinator(conn, args.coordinator_listen, args.start_after_id, args.range_size, args.lease_duration, checkpoint, args.dry_run)
+        end_profile_stage('coordination', stage_start)
+
+        if checkpoint is not None:
+            close_checkpoint(checkpoint)
+    else:
+        # the key index is prepared once, before any worker process opens it
+        if args.key_index is not None and not args.overwrite:
+            stage_start = start_profile_stage()
+            prepare_key_index(storage, S3_BUCKET_NAME, 'avatar/', args.key_index, args.rebuild_key_index, inventories.get(S3_BUCKET_NAME))
+            end_profile_stage('key index', stage_start)
+
+        # the bytes copied are counted with the sizes of the objects in the inventory of the legacy bucket, if it has them
+        # like the key index, the size index is named after the inventory, so that the next executions reuse it
+        if S3_BUCKET_NAME_LEG in inventories and inventories[S3_BUCKET_NAME_LEG]['sizes']:
+            size_index = f"{LOG_DIR}/sketch_size_index_{S3_BUCKET_NAME_LEG}_{inventories[S3_BUCKET_NAME_LEG]['date']:%Y-%m-%dT%H-%MZ}"
+            stage_start = start_profile_stage()
+            prepare_size_index(inventories[S3_BUCKET_NAME_LEG], 'image/', size_index)
+            end_profile_stage('size index', stage_start)
+        else:
+            size_index = None
+
+        # a dry run does not migrate anything, so it neither uses nor updates the journal
+        if args.journal is not None and not args.dry_run:
+            checkpoint = open_checkpoint(args.journal, args.start_after_id)
+        else:
+            checkpoint = None
+
+        # the controller is shared by the ranges of a worker node, so that it does not ramp up again for each one
+        if args.adaptive:
+            adaptive = create_adaptive_controller(args.min_parallelization, args.parallelization_level, args.min_batch_size, args.batch_size)
+        else:
+            adaptive = None
+
+        if args.progress_stream is not None or args.progress_fd is not None:
+            progress_stream = open_progress_stream(args.progress_stream, args.progress_fd)
+        else:
+            progress_stream = None
+
+        logger.info('')
+        logger.info('Progress information:')
+        stage_start = start_profile_stage()
+        if args.coordinator_url is not None:
+            # the worker processes of a node are started once and migrate all of its ranges
+            pool = create_worker_pool(args.parallelization_level, args.engine, args.max_in_flight, args.key_index, args.overwrite, size_index)
+
+            def migrate_range(range_start_id, range_end_id):
+                return migrate_legacy_data(conn, storage, S3_BUCKET_NAME_LEG, S3_BUCKET_NAME, start_time, args.batch_size, 0, args.dry_run, args.overwrite, args.parallelization_level,
+                                           args.engine, args.max_in_flight, range_start_id, args.key_index, range_end_id, None, adaptive, progress_stream, pool)
+
+            _, _, _, stopped = run_worker_node(args.coordinator_url, migrate_range, args.dry_run)
+
+            pool.close()
+            pool.join()
+        else:
+            _, _, _, stopped = migrate_legacy_data(conn, storage, S3_BUCKET_NAME_LEG, S3_BUCKET_NAME, start_time, args.batch_size, args.limit, args.dry_run, args.overwrite,
+                                                   args.parallelization_level, args.engine, args.max_in_flight, args.start_after_id, args.key_index, None, checkpoint,
+                                                   adaptive, progress_stream, None, size_index)
+        end_profile_stage('migration', stage_start)
+
+        if checkpoint is not None:
+            close_checkpoint(checkpoint)
+
+        if progress_stream is not None:
+            close_progress_stream(progress_stream)
+
     logger.info('')
 
     end_time = time.time()
 
     elapsed_time = round(end_time - start_time, 2)
 
-    logger.info(f"Execution finished after {elapsed_time} seconds")
+    write_metrics_summary(metrics_file)
+
+    # a stopped execution is usually expected to exit quickly, and the status check takes a while on large buckets
+    if stopped:
+        logger.info(f"Execution stopped after {elapsed_time} seconds, skipping the final status check")
+        status = None
+    else:
+        logger.info(f"Execution finished after {elapsed_time} seconds")
 
-    status = check_status(conn, s3_conn, False)
+        # the migration has changed the buckets since their inventories, so they are listed
+        stage_start = start_profile_stage()
+        status = check_status(conn, storage, False, args.fan_out, args.approximate)
+        end_profile_stage('final status check', stage_start)
 
     # extra copy/paste niceness for the user
     print('\nThe log file can be reviewed with:')
     print(f"less {log_file}")
 
-    if args.technical_status:
+    print('\nThe summary of the metrics can be reviewed with:')
+    print(f"less {metrics_file}")
+
+    # the workers have written their parts of the profile when their pools were closed
+    if args.profile:
+        stop_profiling()
+        print('\nThe profile can be reviewed with:')
+        print(f"less {write_profile_report(profile_prefix)}")
+
+    if args.technical_status and status is not None:
         print(f"\ntech_status {status}")
 
+    # the migration itself went through, but the final status of the database is unknown
+    if status is None and not stopped:
+        exit(E_ERR)
+
     exit(E_OK)
 
 
@@ -8,6 +8,15 @@ import os
 # AWS_SECRET_ACCESS_KEY
 
 # These variables are not part of the configuration since they are sensitive. The remaining variables should be added as necessary.
+#
+# The following environment variables are OPTIONAL, they point the script to other servers such as local stand-ins
+#
+# SKETCH_DB_HOST, SKETCH_DB_PORT, SKETCH_DB_SSLMODE, SKETCH_DB_DEFAULT_NAME
+# SKETCH_S3_DOMAIN, SKETCH_S3_ENDPOINT_URL, SKETCH_S3_ADDRESSING_STYLE
+#
+# and these ones select the storage of the buckets, AWS_ACCESS_KEY_ID and AWS_SECRET_ACCESS_KEY are not required with the local storage
+#
+# SKETCH_STORAGE, SKETCH_STORAGE_ROOT, SKETCH_STORAGE_COPY
 
 ### Exit codes
 
@@ -16,19 +25,43 @@ E_ERR = 1
 
 ### Database related variables
 
-DB_HOST = 'sketch-production-db-do-user-7447558-0.c.db.ondigitalocean.com'
-DB_PORT = 25060
+DB_HOST = os.getenv('SKETCH_DB_HOST', 'sketch-production-db-do-user-7447558-0.c.db.ondigitalocean.com')
+DB_PORT = int(os.getenv('SKETCH_DB_PORT', 25060))
 DB_NAME = 'proddatabase'
 
+# database to connect to in order to create our database, the one that comes with the server
+DB_DEFAULT_NAME = os.getenv('SKETCH_DB_DEFAULT_NAME', 'defaultdb')
+
+DB_SSLMODE = os.getenv('SKETCH_DB_SSLMODE', 'require')
+
 DB_USER = os.getenv('SKETCH_DB_USER')
 DB_PASS = os.getenv('SKETCH_DB_PASS')
 
-DB_CONN_STRING_0 = f"postgresql://{DB_USER}:{DB_PASS}@{DB_HOST}:{DB_PORT}/defaultdb?sslmode=require"
-DB_CONN_STRING_1 = f"postgresql://{DB_USER}:{DB_PASS}@{DB_HOST}:{DB_PORT}/{DB_NAME}?sslmode=require"
+DB_CONN_STRING_0 = f"postgresql://{DB_USER}:{DB_PASS}@{DB_HOST}:{DB_PORT}/{DB_DEFAULT_NAME}?sslmode={DB_SSLMODE}"
+DB_CONN_STRING_1 = f"postgresql://{DB_USER}:{DB_PASS}@{DB_HOST}:{DB_PORT}/{DB_NAME}?sslmode={DB_SSLMODE}"
 
 # user that is created automatically on the preparation of the environment
 DB_MIGRATION_USER = 'migration'
 
+# number of rows inserted with each COPY, in a single transaction
+DB_COPY_CHUNK_SIZE = 100000
+
+# percentage of each table page filled by inserts when creating the production schema
+DB_FILLFACTOR = 90
+
+### Storage related variables
+
+# where the buckets are: s3 for the S3 compatible service configured below, or local to keep each bucket
+# in a directory of STORAGE_LOCAL_ROOT, which needs no network and no credentials (see the README)
+STORAGE_BACKEND = os.getenv('SKETCH_STORAGE', 's3')
+
+# directory of the buckets of the local storage, which must be on a single file system
+STORAGE_LOCAL_ROOT = os.getenv('SKETCH_STORAGE_ROOT', '/var/tmp/sketch-storage')
+
+# how the local storage copies an object: hardlink, reflink (a copy-on-write clone, on file systems that support it,
+# otherwise a regular copy) or copy
+STORAGE_LOCAL_COPY = os.getenv('SKETCH_STORAGE_COPY', 'hardlink')
+
 ### S3 related variables
 
 # S3 bucket names to use. They must exist and be accessible to your AWS credentials
@@ -40,11 +73,27 @@ S3_BUCKET_NAME_LEG  = 'sketch-legacy-s3'
 S3_MAX_OBJECTS_REQ = 1000
 
 # S3 connection details
-S3_BUCKET_DOMAIN    = 'fra1.digitaloceanspaces.com'
+S3_BUCKET_DOMAIN    = os.getenv('SKETCH_S3_DOMAIN', 'fra1.digitaloceanspaces.com')
 S3_ENDPOINT_URL     = f"https://{S3_BUCKET_NAME}.{S3_BUCKET_DOMAIN}"
-S3_ENDPOINT_URL_LEG = f"https://{S3_BUCKET_DOMAIN}"  # for the legacy client connection
+S3_ENDPOINT_URL_LEG = os.getenv('SKETCH_S3_ENDPOINT_URL', f"https://{S3_BUCKET_DOMAIN}")  # for the legacy client connection
+
+# servers that do not have a DNS name per bucket, such as a local MinIO, need the path addressing style
+S3_ADDRESSING_STYLE = os.getenv('SKETCH_S3_ADDRESSING_STYLE', 'virtual')
+
 AWS_DEFAULT_REGION  = 'us-east-1'
 
+# default number of concurrent uploads when creating the avatars, which is also the size of the S3 connection pool
+S3_PARALLEL_UPLOADS = 32
+
+# number of concurrent multi-object delete requests when cleaning a bucket
+S3_PARALLEL_DELETES = 8
+
+# paths waiting to be uploaded, per concurrent upload
+S3_UPLOAD_QUEUE_FACTOR = 4
+
+# number of attempts of each S3 request, transient errors and throttling are retried with backoff
+S3_MAX_ATTEMPTS = 5
+
 AWS_ACCESS_KEY_ID     = os.getenv('AWS_ACCESS_KEY_ID')
 AWS_SECRET_ACCESS_KEY = os.getenv('AWS_SECRET_ACCESS_KEY')
 
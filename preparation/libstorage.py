@@ -0,0 +1,172 @@
+import os
+import uuid
+import boto3
+import botocore
+
+from config import *
+
+
+# The storage is where the buckets live, with the same two backends as the migration script (see its
+# lib/libstorage.py): s3, the S3 compatible service of the configuration, and local, where each bucket is a
+# directory of STORAGE_LOCAL_ROOT and each key a file in that directory. The preparation only needs to list
+# the keys of a bucket, put objects and delete them.
+
+
+# this function connects to an S3 compatible service
+# transient errors and throttling are retried by the S3 client itself, see S3_MAX_ATTEMPTS
+def connect_s3_storage(storage, max_pool_connections):
+
+    # we are using the traditional cient API instead of the newer resource API because
+    # the enumeration of objects using the resource API was not working on Digital Ocean
+    # the traditional API seems to be the recommended practice at this point
+    #
+    # https://docs.digitalocean.com/products/spaces/reference/s3-sdk-examples/
+    #
+    # and it probably maximizes compatibility with other vendors as well
+    #
+    # see also:
+    # https://stackoverflow.com/questions/65687417/list-all-objects-in-digitalocean-bucket
+
+    session = boto3.session.Session()
+    storage['client'] = session.client('s3',
+                                       config=botocore.config.Config(s3={'addressing_style': S3_ADDRESSING_STYLE},
+                                                                     max_pool_connections=max_pool_connections,
+                                                                     retries={'max_attempts': S3_MAX_ATTEMPTS, 'mode': 'standard'}),
+                                       region_name=AWS_DEFAULT_REGION,
+                                       endpoint_url=S3_ENDPOINT_URL_LEG,
+                                       aws_access_key_id=AWS_ACCESS_KEY_ID,
+                                       aws_secret_access_key=AWS_SECRET_ACCESS_KEY)
+    storage['location'] = S3_BUCKET_DOMAIN
+
+
+# this function yields the keys of a bucket one page of up to S3_MAX_OBJECTS_REQ keys at a time
+def list_s3_pages(storage, bucket_name):
+
+    list_args = { 'Bucket': bucket_name, 'MaxKeys': S3_MAX_OBJECTS_REQ }
+
+    # we need to loop because the list_objects_v2 functions never returns more than 1000
+    # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/s3/client/list_objects_v2.html#list-objects-v2
+    while True:
+        response = storage['client'].list_objects_v2(**list_args)
+        yield [ obj['Key'] for obj in response.get('Contents', []) ]
+
+        if not response.get('IsTruncated'):
+            return
+
+        list_args['ContinuationToken'] = response.get('NextContinuationToken')
+
+
+# this function creates an object
+def put_s3_object(storage, bucket_name, key, body):
+
+    storage['client'].put_object(Bucket=bucket_name, Key=key, Body=body)
+
+
+# this function deletes up to S3_MAX_OBJECTS_REQ objects with a single request
+# it returns the keys that could not be deleted together with the reason
+def delete_s3_objects(storage, bucket_name, keys):
+
+    response = storage['client'].delete_objects(Bucket=bucket_name, Delete={ 'Objects': [ { 'Key': key } for key in keys ], 'Quiet': True })
+
+    # in quiet mode only the keys that could not be deleted are returned
+    return [ (error.get('Key'), error.get('Message')) for error in response.get('Errors', []) ]
+
+
+# this function sets up a local storage, whose buckets are the directories of STORAGE_LOCAL_ROOT
+# the temporary files are written to a directory of the same file system, so that they can be renamed into the buckets,
+# whose name starts with a dot so that it can not be a bucket
+def connect_local_storage(storage, max_pool_connections):
+
+    storage['root']     = STORAGE_LOCAL_ROOT
+    storage['tmp_dir']  = os.path.join(STORAGE_LOCAL_ROOT, '.tmp')
+    storage['location'] = STORAGE_LOCAL_ROOT
+
+    os.makedirs(storage['tmp_dir'], exist_ok=True)
+
+
+# this function yields the keys of a local bucket one page of up to S3_MAX_OBJECTS_REQ keys at a time
+# the order of the keys does not matter to the preparation, and a bucket that does not exist yet is empty
+def list_local_pages(storage, bucket_name):
+
+    bucket_path = os.path.join(storage['root'], bucket_name)
+
+    page = []
+    for directory, subdirectories, filenames in os.walk(bucket_path):
+        for filename in filenames:
+            page.append(os.path.relpath(os.path.join(directory, filename), bucket_path))
+            if len(page) == S3_MAX_OBJECTS_REQ:
+                yield page
+                page = []
+
+    yield page
+
+
+# this function creates an object of the local storage, with an atomic rename so that it is never seen partially written
+def put_local_object(storage, bucket_name, key, body):
+
+    path     = os.path.join(storage['root'], bucket_name, key)
+    tmp_path = os.path.join(storage['tmp_dir'], uuid.uuid4().hex)
+
+    try:
+        with open(tmp_path, 'wb') as tmp_file:
+            tmp_file.write(body)
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+# this function deletes objects of the local storage
+# as on S3, deleting a key that does not exist is not an error
+def delete_local_objects(storage, bucket_name, keys):
+
+    errors = []
+    for key in keys:
+        try:
+            os.remove(os.path.join(storage['root'], bucket_name, key))
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            errors.append((key, str(e)))
+
+    return errors
+
+
+# the operations of each backend
+STORAGE_BACKENDS = { 's3':    { 'connect': connect_s3_storage,    'list_pages': list_s3_pages,    'put': put_s3_object,    'delete': delete_s3_objects },
+                     'local': { 'connect': connect_local_storage, 'list_pages': list_local_pages, 'put': put_local_object, 'delete': delete_local_objects } }
+
+
+# this function obtains a storage of the backend of the configuration
+# the storage is thread safe and the S3 backend can keep up to max_pool_connections connections open at once
+def get_storage(max_pool_connections):
+
+    if STORAGE_BACKEND not in STORAGE_BACKENDS:
+        raise ValueError(f"unknown storage backend {STORAGE_BACKEND}")
+
+    storage = { 'backend': STORAGE_BACKEND, 'operations': STORAGE_BACKENDS[STORAGE_BACKEND] }
+    storage['operations']['connect'](storage, max_pool_connections)
+
+    return storage
+
+
+# this function yields the keys of a bucket, one page at a time
+# deleting the keys of a page does not affect the rest of the listing
+def list_storage_pages(storage, bucket_name):
+
+    return storage['operations']['list_pages'](storage, bucket_name)
+
+
+# this function creates an object, overwriting it if it exists
+def put_storage_object(storage, bucket_name, key, body):
+
+    storage['operations']['put'](storage, bucket_name, key, body)
+
+
+# this function deletes up to S3_MAX_OBJECTS_REQ objects of a bucket
+# it returns the keys that could not be deleted together with the reason
+def delete_storage_objects(storage, bucket_name, keys):
+
+    return storage['operations']['delete'](storage, bucket_name, keys)
@@ -5,13 +5,18 @@ import os
 import logging
 import argparse
 import psycopg2
-import boto3
-import botocore
 import random
+import itertools
+import io
+import queue
+import threading
+import concurrent.futures
+import time
 
 # yes, I know,  but we are importing "constants" from a custom module
 # all constants are in use and are UPPER_CASE, no danger in sight
 from config import *
+from libstorage import get_storage, list_storage_pages, put_storage_object, delete_storage_objects
 
 
 # this function generates a random string with a certain lengh using a given charset
@@ -31,6 +36,10 @@ def check_environment():
         logging.error('the SKETCH_DB_PASS environment variable is not defined')
         exit(E_ERR)
 
+    # the local storage needs no credentials
+    if STORAGE_BACKEND == 'local':
+        return
+
     if AWS_ACCESS_KEY_ID is None:
         logging.error('the AWS_ACCESS_KEY_ID environment variable is not defined')
         exit(E_ERR)
@@ -65,10 +74,15 @@ def create_db(connection):
 
 
 # creates the database table
-def init_db(connection):
+# with production_schema the table leaves free space in each page, so that the updated version
+# of a row can be stored on the same page as the original one during the migration
+def init_db(connection, production_schema=False):
     try:
         cur = connection.cursor()
-        cur.execute("CREATE TABLE IF NOT EXISTS avatars ( id SERIAL PRIMARY KEY, path VARCHAR );")
+        if production_schema:
+            cur.execute(f"CREATE TABLE IF NOT EXISTS avatars ( id SERIAL PRIMARY KEY, path VARCHAR ) WITH (fillfactor = {DB_FILLFACTOR});")
+        else:
+            cur.execute("CREATE TABLE IF NOT EXISTS avatars ( id SERIAL PRIMARY KEY, path VARCHAR );")
         password = get_random_string(12, CHARSET_TMP)
         cur.execute(f"CREATE USER migration WITH PASSWORD '{password}';;")
         cur.execute(f"GRANT SELECT ON TABLE avatars TO {DB_MIGRATION_USER};")
@@ -82,76 +96,137 @@ def init_db(connection):
         exit(E_ERR)
 
 
-# inserts the reference to an avatar in a table row
-def insert_db_row(connection, path):
+# creates the indexes that the production database should have for the migration
+# the partial index only holds the ids of the legacy rows, so the scans of the migration script, whose
+# condition is the same as the index predicate, cost proportionally to the remaining legacy rows
+# and the index shrinks as the migration progresses
+# the index on the paths in byte order lets the verification of the migration script stream the rows of each range
+# of paths in the order of the bucket listings, instead of scanning and sorting the whole table for each range
+# note that an index whose key or predicate covers path rules out HOT updates of path, so every update also adds
+# index entries; the fillfactor only keeps the new row version on the same page when that page still has room
+def create_db_indexes(connection):
     try:
         cur = connection.cursor()
-        cur.execute("INSERT INTO avatars (path) VALUES (%s)", (path,))
+        cur.execute("CREATE INDEX IF NOT EXISTS avatars_legacy_id_idx ON avatars (id) WHERE path LIKE('image/%');")
+        cur.execute('CREATE INDEX IF NOT EXISTS avatars_path_c_idx ON avatars (path COLLATE "C");')
+        cur.execute("ANALYZE avatars;")
         connection.commit()
     except Exception as e:
-        logging.error(f"Error inserting to the database: {e}")
+        logging.error(f"Error creating the database indexes: {e}")
         exit(E_ERR)
 
 
-# deletes every object inside the bucket
-def init_bucket(s3_conn, bucket_name, verbose=False):
+# splits a stream of paths into lists of up to chunk_size paths, so that only one chunk is in memory at a time
+def generate_chunks(paths, chunk_size):
+    while True:
+        chunk = list(itertools.islice(paths, chunk_size))
+        if len(chunk) == 0:
+            return
+        yield chunk
 
-    response = s3_conn.list_objects_v2(Bucket=bucket_name, MaxKeys=S3_MAX_OBJECTS_REQ)
 
+# inserts the references to a chunk of avatars in the table
+# COPY sends all the rows in a single stream, which is much faster than one INSERT per row,
+# and the chunk is committed as a single transaction
+def insert_db_rows(connection, paths):
     try:
-        objects = response['Contents']
+        cur = connection.cursor()
+        # the generated paths never contain tabs, newlines or backslashes, so they need no escaping
+        cur.copy_from(io.StringIO(''.join(f"{path}\n" for path in paths)), 'avatars', columns=('path',))
+        connection.commit()
     except Exception as e:
-        if verbose:
-            print(f"  * bucket {bucket_name} was already empty")
-        return
+        logging.error(f"Error inserting to the database: {e}")
+        exit(E_ERR)
 
-    # we need to loop because the list_objects_v2 functions never returns more than 1000
-    # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/s3/client/list_objects_v2.html#list-objects-v2
 
-    nr_deleted_objects_total   = 0
+# deletes a page of up to 1000 objects with a single request and returns the number of deleted objects
+def delete_s3_objects(storage, bucket_name, keys, verbose=False):
 
-    nr_found_objects_partial = len(objects)
-    nr_found_objects_total   = len(objects)
+    if verbose:
+        for key in keys:
+            print('  * deleting', key)
 
-    while nr_found_objects_partial > 0:
-        nr_deleted_objects_partial = 0
-        for obj in objects:
-            key = obj['Key']
-            if verbose:
-                print('  * deleting', key)
-            s3_conn.delete_object(Bucket=bucket_name, Key=key)
-            nr_deleted_objects_partial += 1
+    errors = delete_storage_objects(storage, bucket_name, keys)
+    for key, message in errors:
+        logging.error(f"Error deleting {key}: {message}")
 
-        print(f"  * partial count: found {nr_found_objects_partial} objects, deleted {nr_deleted_objects_partial} objects")
-        nr_deleted_objects_total += nr_deleted_objects_partial
+    return len(keys) - len(errors)
 
-        if not response.get('IsTruncated'):
-            break
-        else:
-            continuation_token = response.get('NextContinuationToken')
 
-        response = s3_conn.list_objects_v2(Bucket=bucket_name, MaxKeys=S3_MAX_OBJECTS_REQ, ContinuationToken=continuation_token)
-        try:
-            objects = response['Contents']
-            nr_found_objects_partial = len(objects)
-            nr_found_objects_total += nr_found_objects_partial
-            if verbose:
-                print(f"  * bucket {bucket_name} has more objects")
-        except Exception as e:
-            if verbose:
-                print(f"  * bucket {bucket_name} has been emptied")
-            nr_found_objects_partial = 0
+# deletes every object inside the bucket
+# each page of the listing is deleted by one of several workers while the next pages are being listed
+def init_bucket(storage, bucket_name, verbose=False, nr_workers=S3_PARALLEL_DELETES):
 
-    print(f"  * final count: found {nr_found_objects_total} objects, deleted {nr_deleted_objects_total} objects")
+    start_time = time.time()
+
+    # the keys are listed one page of up to 1000 keys at a time
+    # deleting the objects of a page does not affect the rest of the listing
+
+    nr_found_objects_total   = 0
+    nr_deleted_objects_total = 0
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=nr_workers) as executor:
+        pending_deletes = set()
+        for keys in list_storage_pages(storage, bucket_name):
+
+            if len(keys) > 0:
+                nr_found_objects_total += len(keys)
+                pending_deletes.add(executor.submit(delete_s3_objects, storage, bucket_name, keys, verbose))
+
+            # the listing does not get too far ahead of the deletions
+            if len(pending_deletes) >= 2 * nr_workers:
+                done_deletes, pending_deletes = concurrent.futures.wait(pending_deletes, return_when=concurrent.futures.FIRST_COMPLETED)
+
+                nr_deleted_objects_total += sum(delete.result() for delete in done_deletes)
+
+                print(f"  * partial count: found {nr_found_objects_total} objects, deleted {nr_deleted_objects_total} objects")
+
+        nr_deleted_objects_total += sum(delete.result() for delete in pending_deletes)
+
+        print(f"  * partial count: found {nr_found_objects_total} objects, deleted {nr_deleted_objects_total} objects")
+
+    if nr_found_objects_total == 0:
+        if verbose:
+            print(f"  * bucket {bucket_name} was already empty")
+        return
+
+    elapsed_time = time.time() - start_time
+    deletion_rate = round(nr_deleted_objects_total / max(elapsed_time, 0.001))
+
+    print(f"  * final count: found {nr_found_objects_total} objects, deleted {nr_deleted_objects_total} objects, {deletion_rate} objects per second")
+
+    if nr_deleted_objects_total != nr_found_objects_total:
+        raise Exception(f"{nr_found_objects_total - nr_deleted_objects_total} objects could not be deleted from bucket {bucket_name}")
 
 
 # creates the avatar file in the S3 bucket
-def create_s3_object(s3_conn, bucket, path):
+# transient errors and throttling are retried by the S3 client itself, see S3_MAX_ATTEMPTS
+def create_s3_object(storage, bucket, path):
     try:
-        s3_conn.put_object(Bucket=bucket, Key=f"{path}", Body=DUMMY_AVATAR)
+        put_storage_object(storage, bucket, path, DUMMY_AVATAR)
     except Exception as e:
         logging.error(f"Error while creating an s3 object: {e}")
-        exit(E_ERR)
+        return False
+
+    return True
+
+
+# creates the avatar files whose paths are taken from the queue, until it gets None
+# several of these run at the same time, sharing the storage and the connection pool of its S3 client
+def upload_s3_objects(storage, upload_queue, failed_paths):
+    while True:
+        path = upload_queue.get()
+        if path is None:
+            return
+
+        # only the legacy ones (image/) go to the legacy bucket
+        if 'image/' in path:
+            bucket = S3_BUCKET_NAME_LEG
+        else:
+            bucket = S3_BUCKET_NAME
+
+        if not create_s3_object(storage, bucket, path):
+            failed_paths.append(path)
 
 
 # checks if the user really wants to move forward
@@ -181,6 +256,8 @@ if __name__ == "__main__":
     parser.add_argument('number_of_avatars', type=int, help='Number of legacy avatars to create')
 
     parser.add_argument('-c', '--clean-production', help='Clean also the production bucket',         default=False, action='store_true')
+    parser.add_argument('-s', '--production-schema', help='Create the table with the indexes and fillfactor recommended for production', default=False, action='store_true')
+    parser.add_argument('-p', '--parallel-uploads', help='Number of concurrent S3 uploads',          default=S3_PARALLEL_UPLOADS, type=int)
     parser.add_argument('-v', '--verbose',          help='Print extra messages',                     default=False, action='store_true')
     parser.add_argument('-t', '--technical-status', help='print a line with the numbers at the end', default=False, action='store_true')
     parser.add_argument('-y', '--say-yes',          help='skip confirmation prompts',                default=False, action='store_true')
@@ -193,6 +270,10 @@ if __name__ == "__main__":
         logging.error('the number of avatars must be a positive integer')
         exit(E_ERR)
 
+    if args.parallel_uploads < 1:
+        logging.error('the number of parallel uploads must be a positive integer')
+        exit(E_ERR)
+
     # Check if we have the necessary environment variables defined and fail early otherwise
     check_environment()
 
@@ -228,54 +309,37 @@ if __name__ == "__main__":
     # Initialize our database
     try:
         print('Initializing the database')
-        init_db(conn)
+        init_db(conn, args.production_schema)
     except Exception as e:
         logging.error(f"Error while initializing creating the database: {e}")
         conn.close()
         exit(E_ERR)
 
-    # Initialize s3 connection
+    # Initialize the storage of the buckets, an S3 connection or a local directory
     try:
-        # we are using the traditional cient API instead of the newer resource API because
-        # the enumeration of objects using the resource API was not working on Digital Ocean
-        # the traditional API seems to be the recommended practice at this point
-        #
-        # https://docs.digitalocean.com/products/spaces/reference/s3-sdk-examples/
-        #
-        # and it probably maximizes compatibility with other vendors as well
-        #
-        # see also:
-        # https://stackoverflow.com/questions/65687417/list-all-objects-in-digitalocean-bucket
-
-        # furthermore, enumerating objects might turn out to be too slow in a real world case
+        # enumerating objects might turn out to be too slow in a real world case
         # but deleting + recreating a bucket also opens the window for race conditions related
         # to a bucket name being or note available directly after deletion (I've seen this on AWS...)
 
         # bottom line: this is good enough for a demo, production use would require further examination
 
-        session = boto3.session.Session()
-        s3 = session.client('s3',
-                            config=botocore.config.Config(s3={'addressing_style': 'virtual'}),
-                            region_name=AWS_DEFAULT_REGION,
-                            endpoint_url=S3_ENDPOINT_URL_LEG,
-                            aws_access_key_id=AWS_ACCESS_KEY_ID,
-                            aws_secret_access_key=AWS_SECRET_ACCESS_KEY)
+        storage = get_storage(args.parallel_uploads)
 
     except Exception as e:
-        logging.error(f"Error while connecting to S3: {e}")
+        logging.error(f"Error while connecting to the {STORAGE_BACKEND} storage: {e}")
         exit(E_ERR)
 
     # Clean the bucket
     try:
         print('Cleaning the legacy bucket')
-        init_bucket(s3, S3_BUCKET_NAME_LEG, args.verbose)
+        init_bucket(storage, S3_BUCKET_NAME_LEG, args.verbose)
 
         if args.clean_production:
             print('Cleaning the production bucket')
-            init_bucket(s3, S3_BUCKET_NAME, args.verbose)
+            init_bucket(storage, S3_BUCKET_NAME, args.verbose)
 
     except Exception as e:
-        logging.error(f"Error while cleaning the S3 buckets {S3_BUCKET_NAME_LEG} and {S3_BUCKET_NAME} in {S3_BUCKET_DOMAIN}")
+        logging.error(f"Error while cleaning the buckets {S3_BUCKET_NAME_LEG} and {S3_BUCKET_NAME} in {storage['location']}")
         logging.error('  * check domain name, bucket name, key/secret pair and bucket write permissions')
         exit(E_ERR)
 
@@ -285,25 +349,53 @@ if __name__ == "__main__":
     legacy_avatars = 0
     production_avatars = 0
 
-    for path in generate_path(args.number_of_avatars):
-        if args.verbose:
-            print('  * creating', path)
+    # the S3 objects are created by their own stage of concurrent uploaders, fed through a bounded queue
+    # so that the number of uploads in flight does not depend on the latency of each one
+    upload_queue = queue.Queue(maxsize=args.parallel_uploads * S3_UPLOAD_QUEUE_FACTOR)
+    failed_paths = []
+
+    uploaders = [ threading.Thread(target=upload_s3_objects, args=(storage, upload_queue, failed_paths), daemon=True) for i in range(args.parallel_uploads) ]
+    for uploader in uploaders:
+        uploader.start()
+
+    for chunk in generate_chunks(generate_path(args.number_of_avatars), DB_COPY_CHUNK_SIZE):
 
         # all the generated paths are added to the database but only
         # the legacy ones (image/) are added to the legacy bucket
 
-        insert_db_row(conn, path)
+        insert_db_rows(conn, chunk)
 
-        if 'image/' in path:
+        for path in chunk:
             if args.verbose:
-                print('    - added to the legacy bucket')
-            create_s3_object(s3, S3_BUCKET_NAME_LEG, path)
-            legacy_avatars += 1
-        else:
-            if args.verbose:
-                print('    - added to the production bucket')
-            create_s3_object(s3, S3_BUCKET_NAME, path)
-            production_avatars += 1
+                print('  * creating', path)
+
+            if 'image/' in path:
+                if args.verbose:
+                    print('    - added to the legacy bucket')
+                legacy_avatars += 1
+            else:
+                if args.verbose:
+                    print('    - added to the production bucket')
+                production_avatars += 1
+
+            upload_queue.put(path)
+
+    # one stop signal per uploader, which finishes the uploads queued before it
+    for uploader in uploaders:
+        upload_queue.put(None)
+
+    for uploader in uploaders:
+        uploader.join()
+
+    if len(failed_paths) > 0:
+        logging.error(f"Error while creating {len(failed_paths)} s3 objects, the environment is incomplete")
+        conn.close()
+        exit(E_ERR)
+
+    # the indexes are created after the rows are inserted, which is faster than maintaining them on each insert
+    if args.production_schema:
+        print('Creating the database indexes')
+        create_db_indexes(conn)
 
     conn.close()
 
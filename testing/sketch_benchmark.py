@@ -0,0 +1,314 @@
+#!/usr/bin/env python
+
+import argparse
+import os
+import csv
+import json
+import time
+import shlex
+import socket
+import tempfile
+import itertools
+import subprocess
+
+
+E_OK  = 0
+E_ERR = 1
+
+PYTHON_CMD = '/usr/bin/python3'
+
+# the environment that points the preparation and migration scripts to local stand-ins, a PostgreSQL server
+# and a MinIO server, unless the variables are already defined (see the README)
+LOCAL_ENVIRONMENT = { 'SKETCH_DB_HOST':             'localhost',
+                      'SKETCH_DB_PORT':             '5432',
+                      'SKETCH_DB_SSLMODE':          'disable',
+                      'SKETCH_DB_DEFAULT_NAME':     'postgres',
+                      'SKETCH_S3_DOMAIN':           'localhost:9000',
+                      'SKETCH_S3_ENDPOINT_URL':     'http://localhost:9000',
+                      'SKETCH_S3_ADDRESSING_STYLE': 'path' }
+
+# time given to the fake S3 server to start listening
+FAKE_S3_START_TIMEOUT = 10
+
+# a result is a regression if its throughput is below, or its p99 batch latency above, the baseline by more than the tolerance
+DEFAULT_TOLERANCE_PCT = 10
+
+# the fields of each result, in the order of the CSV columns
+RESULT_FIELDS = [ 'dataset_size', 'batch_size', 'parallelization_level', 'engine',
+                  'rows_updated', 'elapsed_time', 'rows_per_sec',
+                  'batch_p50', 'batch_p99', 'copy_p50', 'copy_p99', 'db_update_p50', 'db_update_p99',
+                  'status', 'regression' ]
+
+
+# this function transforms a comma separated list of values given on the command line into a list
+def get_list_argument(value, value_type=int):
+
+    return [ value_type(v) for v in value.split(',') if v != '' ]
+
+
+# this function runs a command and returns its stdout lines, or None if it fails
+def run_command(command, environment):
+
+    result = subprocess.run(command, stdout=subprocess.PIPE, env=environment, text=True)
+
+    if result.returncode != E_OK:
+        print(f"ERROR: {' '.join(command)} exited with code {result.returncode}")
+        return None
+
+    return result.stdout.splitlines()
+
+
+# this function transforms the tech status line from stdout into a list of integers
+def get_tech_status(output_lines):
+
+    for line in reversed(output_lines):
+        if line.startswith('tech_status '):
+            return [ int(v) for v in line.split(' ')[1].split(',') ]
+
+    return None
+
+
+# this function finds the summary of the metrics written by the migration script, whose path it prints on stdout
+def get_metrics_summary(output_lines):
+
+    for line in output_lines:
+        if line.startswith('less ') and line.endswith('.metrics.json'):
+            with open(line[len('less '):], 'r') as summary_file:
+                return json.load(summary_file)
+
+    return None
+
+
+# this function returns the last line of the progress stream written by the migration script
+def get_final_progress(progress_filename):
+
+    final_progress = None
+    with open(progress_filename, 'r') as progress_file:
+        for line in progress_file:
+            final_progress = json.loads(line)
+
+    return final_progress
+
+
+# this function prepares a fresh environment with dataset_size avatars and migrates it with the given options
+# it returns the result of the migration, with the status 'failed' if anything went wrong
+def run_benchmark(base_path, environment, dataset_size, batch_size, parallelization_level, engine, overwrite):
+
+    prep_cmd = f"{base_path}/../preparation/sketch_prepare.py"
+    mig_cmd  = f"{base_path}/../migration/sketch_migrate.py"
+
+    result = { 'dataset_size': dataset_size, 'batch_size': batch_size, 'parallelization_level': parallelization_level, 'engine': engine,
+               'status': 'failed', 'regression': '' }
+
+    print(f"\nBenchmarking {dataset_size} avatars with batch size {batch_size}, parallelization level {parallelization_level} and the {engine} engine")
+
+    # every combination starts from the same data, as the migration changes it
+    prep_output_lines = run_command([PYTHON_CMD, prep_cmd, str(dataset_size), '-cyt'], environment)
+    if prep_output_lines is None:
+        return result
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        progress_filename = f"{tmp_dir}/progress.jsonl"
+
+        mig_args = [ '-ty', '-b', str(batch_size), '-p', str(parallelization_level), '-e', engine, '--progress-stream', progress_filename ]
+        if overwrite:
+            mig_args.append('-w')
+
+        mig_output_lines = run_command([PYTHON_CMD, mig_cmd] + mig_args, environment)
+        if mig_output_lines is None:
+            return result
+
+        final_progress  = get_final_progress(progress_filename)
+        metrics_summary = get_metrics_summary(mig_output_lines)
+        tech_status     = get_tech_status(mig_output_lines)
+
+    if final_progress is None or metrics_summary is None or tech_status is None:
+        print('ERROR: the migration did not report its progress, metrics or status')
+        return result
+
+    # as in the integration test, there must be no legacy rows left
+    if tech_status[2] != 0:
+        print(f"ERROR: {tech_status[2]} legacy rows were left after the migration")
+        return result
+
+    latencies = metrics_summary['latencies']
+
+    result['rows_updated'] = final_progress['rows_updated']
+    result['elapsed_time'] = final_progress['elapsed_time']
+    result['rows_per_sec'] = round(final_progress['rows_updated'] / max(final_progress['elapsed_time'], 0.001), 2)
+
+    for field, latency in [ ('batch', 'batch_seconds'), ('copy', 's3_copy_object_seconds'), ('db_update', 'db_update_seconds') ]:
+        result[f"{field}_p50"] = latencies.get(latency, {}).get('p50')
+        result[f"{field}_p99"] = latencies.get(latency, {}).get('p99')
+
+    result['status'] = 'ok'
+
+    print(f"  * {result['rows_updated']} rows in {result['elapsed_time']} seconds, {result['rows_per_sec']} rows/sec, "
+          f"batch latency p50 {result['batch_p50']} p99 {result['batch_p99']}")
+
+    return result
+
+
+# this function starts the fake S3 server on a free local port with the given options
+# it returns the process and the environment that points the scripts to it
+def start_fake_s3(base_path, fake_s3_options):
+
+    # the port is chosen by the system, and released right before the server binds it
+    with socket.socket() as probe_socket:
+        probe_socket.bind(('127.0.0.1', 0))
+        port = probe_socket.getsockname()[1]
+
+    fake_s3_cmd = f"{base_path}/sketch_fake_s3.py"
+    fake_s3 = subprocess.Popen([PYTHON_CMD, fake_s3_cmd, '-l', f"127.0.0.1:{port}"] + shlex.split(fake_s3_options))
+
+    start_time = time.time()
+    while time.time() - start_time < FAKE_S3_START_TIMEOUT and fake_s3.poll() is None:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            break
+        except OSError:
+            time.sleep(0.1)
+    else:
+        fake_s3.kill()
+        return None, None
+
+    # the fake server accepts any key/secret pair
+    fake_s3_environment = { 'SKETCH_STORAGE':             's3',
+                            'SKETCH_S3_DOMAIN':           f"127.0.0.1:{port}",
+                            'SKETCH_S3_ENDPOINT_URL':     f"http://127.0.0.1:{port}",
+                            'SKETCH_S3_ADDRESSING_STYLE': 'path',
+                            'AWS_ACCESS_KEY_ID':          os.environ.get('AWS_ACCESS_KEY_ID', 'fake'),
+                            'AWS_SECRET_ACCESS_KEY':      os.environ.get('AWS_SECRET_ACCESS_KEY', 'fake') }
+
+    return fake_s3, fake_s3_environment
+
+
+# this function returns the key that identifies a combination of the matrix
+def get_result_key(result):
+
+    return (result['dataset_size'], result['batch_size'], result['parallelization_level'], result['engine'])
+
+
+# this function compares a result to the baseline and records the regressions found
+def check_regression(result, baseline_results, tolerance_pct):
+
+    baseline = baseline_results.get(get_result_key(result))
+    if baseline is None or baseline['status'] != 'ok' or result['status'] != 'ok':
+        return False
+
+    regressions = []
+
+    if result['rows_per_sec'] < baseline['rows_per_sec'] * (1 - tolerance_pct / 100):
+        regressions.append(f"throughput {result['rows_per_sec']} vs {baseline['rows_per_sec']} rows/sec")
+
+    if result['batch_p99'] is not None and baseline['batch_p99'] is not None and result['batch_p99'] > baseline['batch_p99'] * (1 + tolerance_pct / 100):
+        regressions.append(f"p99 batch latency {round(result['batch_p99'], 4)} vs {round(baseline['batch_p99'], 4)} seconds")
+
+    result['regression'] = '; '.join(regressions)
+
+    return len(regressions) > 0
+
+
+# main script
+def main():
+
+    parser = argparse.ArgumentParser(description='This script benchmarks the migration over a matrix of dataset sizes, batch sizes, parallelization levels and engines')
+
+    # optional arguments
+    parser.add_argument('-n', '--dataset-sizes',          help='comma separated numbers of avatars to generate',  type=str, default='1000')
+    parser.add_argument('-b', '--batch-sizes',            help='comma separated batch sizes',                     type=str, default='20,100')
+    parser.add_argument('-p', '--parallelization-levels', help='comma separated parallelization levels',          type=str, default='1,4')
+    parser.add_argument('-e', '--engines',                help='comma separated S3 copy engines (sync, async)',   type=str, default='sync,async')
+    parser.add_argument('-c', '--csv',                    help='file to which the results are written as CSV',    type=str, default=None)
+    parser.add_argument('-j', '--json',                   help='file to which the results are written as JSON',   type=str, default=None)
+    parser.add_argument('-B', '--baseline',               help='JSON results of a previous execution to compare against', type=str, default=None)
+    parser.add_argument('-T', '--tolerance',              help='percentage of degradation tolerated before flagging a regression', type=float, default=DEFAULT_TOLERANCE_PCT)
+    parser.add_argument('-F', '--fake-s3-options',        help='options of the fake S3 server, such as "-L copy=lognormal:0.02:1 -t copy=0.01"', type=str, default='')
+
+    # flags
+    parser.add_argument('-l', '--local',     help='use local stand-ins for PostgreSQL and S3 unless configured otherwise', default=False, action='store_true')
+    parser.add_argument('-w', '--overwrite', help='migrate with -w, skipping the existence checks',                          default=False, action='store_true')
+    parser.add_argument('-f', '--fake-s3',   help='start the fake S3 server and use it instead of the S3 service',            default=False, action='store_true')
+
+    args = parser.parse_args()
+
+    dataset_sizes          = get_list_argument(args.dataset_sizes)
+    batch_sizes            = get_list_argument(args.batch_sizes)
+    parallelization_levels = get_list_argument(args.parallelization_levels)
+    engines                = get_list_argument(args.engines, str)
+
+    if any(v < 1 for v in dataset_sizes + batch_sizes + parallelization_levels) or any(e not in ['sync', 'async'] for e in engines):
+        print('ERROR: the sizes and levels must be positive integers and the engines sync or async')
+        exit(E_ERR)
+
+    baseline_results = {}
+    if args.baseline is not None:
+        try:
+            with open(args.baseline, 'r') as baseline_file:
+                baseline_results = { get_result_key(r): r for r in json.load(baseline_file) }
+        except (OSError, ValueError) as e:
+            print(f"ERROR: the baseline {args.baseline} could not be read: {e}")
+            exit(E_ERR)
+
+    environment = dict(os.environ)
+    if args.local:
+        for name, value in LOCAL_ENVIRONMENT.items():
+            environment.setdefault(name, value)
+
+    # establish the path of the preparation and migration executables
+    base_path = os.path.dirname(os.path.abspath(__file__))
+
+    fake_s3 = None
+    if args.fake_s3:
+        fake_s3, fake_s3_environment = start_fake_s3(base_path, args.fake_s3_options)
+        if fake_s3 is None:
+            print('ERROR: the fake S3 server could not be started')
+            exit(E_ERR)
+        environment.update(fake_s3_environment)
+
+    start_time = time.time()
+
+    results = []
+    nr_failures    = 0
+    nr_regressions = 0
+    for dataset_size, batch_size, parallelization_level, engine in itertools.product(dataset_sizes, batch_sizes, parallelization_levels, engines):
+        result = run_benchmark(base_path, environment, dataset_size, batch_size, parallelization_level, engine, args.overwrite)
+
+        if result['status'] != 'ok':
+            nr_failures += 1
+        elif check_regression(result, baseline_results, args.tolerance):
+            nr_regressions += 1
+            print(f"  * REGRESSION: {result['regression']}")
+
+        results.append(result)
+
+    # the fake S3 server prints its statistics when it stops
+    if fake_s3 is not None:
+        fake_s3.terminate()
+        fake_s3.wait()
+
+    if args.csv is not None:
+        with open(args.csv, 'w', newline='') as csv_file:
+            writer = csv.DictWriter(csv_file, fieldnames=RESULT_FIELDS, restval='')
+            writer.writeheader()
+            writer.writerows(results)
+
+    # the JSON results can be used as the baseline of later executions
+    if args.json is not None:
+        with open(args.json, 'w') as json_file:
+            json.dump(results, json_file, indent=2)
+            json_file.write('\n')
+
+    elapsed_time = round(time.time() - start_time, 2)
+
+    print(f"\nBenchmark of {len(results)} combinations finished after {elapsed_time} seconds, {nr_failures} failures, {nr_regressions} regressions")
+
+    if nr_failures > 0 or nr_regressions > 0:
+        exit(E_ERR)
+
+    exit(E_OK)
+
+
+# main script
+if __name__ == "__main__":
+    main()
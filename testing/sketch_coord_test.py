@@ -0,0 +1,249 @@
+#!/usr/bin/env python
+
+import re
+import os
+import time
+import signal
+import socket
+import argparse
+import tempfile
+import subprocess
+
+
+E_OK  = 0
+E_ERR = 1
+
+PYTHON_CMD = '/usr/bin/python3'
+
+# seconds given to the coordinator to check the status and start listening, and to the whole migration
+COORD_START_TIMEOUT     = 120
+COORD_MIGRATION_TIMEOUT = 600
+
+# copies per second of the worker node that is killed, slow enough for it to be killed in the middle of its range
+VICTIM_COPY_RATE = 1
+
+
+# this function runs the preparation script and returns its tech status values, or None if it fails
+def prepare_environment(prep_cmd, number_of_avatars):
+
+    result = subprocess.run([PYTHON_CMD, prep_cmd, str(number_of_avatars), '-cyt'], stdout=subprocess.PIPE, text=True)
+
+    if result.returncode != E_OK:
+        return None
+
+    return get_list_of_values_from_execution(result.stdout.splitlines())
+
+
+# this function transforms the tech status line from stdout into a clean list
+def get_list_of_values_from_execution(output_lines):
+
+    tech_status_lines = [ line for line in output_lines if line.startswith('tech_status ') ]
+
+    if len(tech_status_lines) == 0:
+        return None
+
+    return tech_status_lines[-1].split(' ')[1].strip().split(',')
+
+
+# this function waits until the coordinator listens on its port, and returns False if it exits or times out first
+def wait_for_coordinator(coordinator, port):
+
+    start_time = time.time()
+
+    while time.time() - start_time < COORD_START_TIMEOUT and coordinator.poll() is None:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return True
+        except OSError:
+            time.sleep(0.1)
+
+    return False
+
+
+# this function starts a worker node of the coordinator, in its own process group so that it can be killed with its workers
+def start_worker_node(mig_cmd, coordinator_url, extra_args, stdout):
+
+    return subprocess.Popen([PYTHON_CMD, mig_cmd, '-y', '--coordinator-url', coordinator_url] + extra_args,
+                            stdout=stdout, text=True, start_new_session=True)
+
+
+# this function starts a slow worker node and kills it, with its workers, as soon as it got a lease
+# it returns False if the node ends before getting one
+def kill_worker_node_with_lease(mig_cmd, coordinator_url):
+
+    victim = start_worker_node(mig_cmd, coordinator_url, ['-p', '1', '-b', '1', '--copy-rate', str(VICTIM_COPY_RATE)], subprocess.PIPE)
+
+    for line in victim.stdout:
+        if line.startswith('Got lease'):
+            # let it copy a few files of the range, which are copied again by the node that gets the range next
+            time.sleep(2 / VICTIM_COPY_RATE)
+            os.killpg(victim.pid, signal.SIGKILL)
+            victim.wait()
+            print(f"Killed the worker node {victim.pid} after: {line.strip()}")
+            return True
+
+    victim.wait()
+
+    return False
+
+
+# this function checks the leases logged by the coordinator
+# the ranges must not overlap, a range must only be leased again after its lease expired or was released,
+# and at least one expired range must have been leased again to another node
+def check_coordinator_leases(output_lines):
+
+    rc = True
+
+    granted_re  = re.compile(r'lease (\S+) for range \((\d+), (\d+)\] granted to node (\S+)')
+    expired_re  = re.compile(r'lease (\S+) of node (\S+) expired, range \((\d+), (\d+)\) will be leased again')
+    released_re = re.compile(r'range \((\d+), (\d+)\] had \d+ errors, it will be leased again')
+
+    # the node of the current lease of each range, and the ranges whose lease ended without completing them
+    leased_ranges  = {}
+    ended_ranges   = {}
+    reissued_count = 0
+
+    for line in output_lines:
+        match = granted_re.search(line)
+        if match is not None:
+            lease_range = (int(match.group(2)), int(match.group(3)))
+            node        = match.group(4)
+            if lease_range in leased_ranges and lease_range not in ended_ranges:
+                rc = False
+                print(f"ERROR: range {lease_range} leased to node {node} while still leased to node {leased_ranges[lease_range]}")
+            if lease_range in ended_ranges and ended_ranges.pop(lease_range) != node:
+                reissued_count += 1
+            leased_ranges[lease_range] = node
+            continue
+
+        match = expired_re.search(line)
+        if match is not None:
+            ended_ranges[(int(match.group(3)), int(match.group(4)))] = match.group(2)
+            continue
+
+        match = released_re.search(line)
+        if match is not None:
+            lease_range = (int(match.group(1)), int(match.group(2)))
+            ended_ranges[lease_range] = leased_ranges.get(lease_range)
+
+    if len(leased_ranges) == 0:
+        rc = False
+        print('ERROR: no lease granted by the coordinator was found in its output, it must run with -v')
+
+    # distinct ranges are disjoint when each one starts after the end of the previous one
+    sorted_ranges = sorted(leased_ranges)
+    for previous_range, next_range in zip(sorted_ranges, sorted_ranges[1:]):
+        if next_range[0] < previous_range[1]:
+            rc = False
+            print(f"ERROR: the leased ranges {previous_range} and {next_range} overlap")
+
+    if reissued_count == 0:
+        rc = False
+        print('ERROR: no expired lease was leased again to another node')
+
+    print(f"Leased ranges: {len(sorted_ranges)}, leased again to another node after expiring: {reissued_count}")
+
+    return rc
+
+
+# main script
+def main():
+
+    parser = argparse.ArgumentParser(description='This script tests a coordinator and several worker nodes of the migration on a single machine')
+
+    # mandatory arguments
+    parser.add_argument('number_of_avatars',        type=int, help='Number of legacy avatars to create')
+    parser.add_argument('number_of_nodes',          type=int, help='number of worker nodes besides the one that is killed')
+
+    # optional arguments
+    parser.add_argument('-r', '--range-size',       type=int, help='number of ids per range leased by the coordinator', default=50)
+    parser.add_argument('-l', '--lease-duration',   type=int, help='seconds after which a lease that is not renewed expires', default=5)
+    parser.add_argument('-P', '--port',             type=int, help='local port of the coordinator', default=8765)
+
+    args = parser.parse_args()
+
+    # establish the path of the preparation and migration executables
+    base_path = os.path.dirname(os.path.abspath(__file__))
+    prep_cmd = f"{base_path}/../preparation/sketch_prepare.py"
+    mig_cmd  = f"{base_path}/../migration/sketch_migrate.py"
+
+    tech_status_values = prepare_environment(prep_cmd, args.number_of_avatars)
+    if tech_status_values is None:
+        print('Error executing the preparation command')
+        exit(E_ERR)
+
+    print('Pre-migration requested values:', tech_status_values)
+
+    coordinator_url = f"http://127.0.0.1:{args.port}"
+
+    # the output of the coordinator is kept in a file, as it is only read once the migration is over
+    coordinator_output = tempfile.TemporaryFile(mode='w+')
+    coordinator = subprocess.Popen([PYTHON_CMD, mig_cmd, '-yvt', '--coordinator-listen', f"127.0.0.1:{args.port}",
+                                    '--range-size', str(args.range_size), '--lease-duration', str(args.lease_duration)],
+                                   stdout=coordinator_output, text=True)
+
+    if not wait_for_coordinator(coordinator, args.port):
+        coordinator.kill()
+        print('Error starting the coordinator')
+        exit(E_ERR)
+
+    rc = True
+
+    # a dry run worker node must be refused by a coordinator that is not a dry run
+    dry_run_node = start_worker_node(mig_cmd, coordinator_url, ['-d'], subprocess.DEVNULL)
+    if dry_run_node.wait() == E_OK:
+        rc = False
+        print('ERROR: a dry run worker node was accepted by a coordinator that is not a dry run')
+
+    # the range of the killed node is leased again once its lease expires
+    if not kill_worker_node_with_lease(mig_cmd, coordinator_url):
+        rc = False
+        print('ERROR: the worker node to be killed ended without getting a lease')
+
+    start_time = time.time()
+
+    nodes = [ start_worker_node(mig_cmd, coordinator_url, [], subprocess.DEVNULL) for _ in range(args.number_of_nodes) ]
+
+    try:
+        coordinator.wait(timeout=COORD_MIGRATION_TIMEOUT)
+    except subprocess.TimeoutExpired:
+        coordinator.kill()
+        rc = False
+        print(f"ERROR: the coordinator did not finish within {COORD_MIGRATION_TIMEOUT} seconds")
+
+    for node in nodes:
+        if node.wait() != E_OK:
+            rc = False
+            print(f"ERROR: the worker node {node.pid} exited with code {node.returncode}")
+
+    end_time = time.time()
+
+    coordinator_output.seek(0)
+    output_lines = coordinator_output.read().splitlines()
+
+    if not check_coordinator_leases(output_lines):
+        rc = False
+
+    tech_status_values = get_list_of_values_from_execution(output_lines)
+    print('Post-migration detected values:', tech_status_values)
+
+    if tech_status_values is None or int(tech_status_values[2]) != 0:
+        rc = False
+        print('ERROR: the final number of legacy database rows is not zero, which means the migration had problems')
+
+    if not rc:
+        exit(E_ERR)
+
+    # if we survived so far it means there were no problems
+    print('No problems detected!')
+
+    elapsed_time = round(end_time - start_time, 2)
+
+    print(f"\nMigration of {args.number_of_avatars} avatars by {args.number_of_nodes} worker nodes finished after {elapsed_time} seconds")
+
+    exit(E_OK)
+
+
+# main script
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,642 @@
+#!/usr/bin/env python
+
+import argparse
+import base64
+import bisect
+import datetime
+import hashlib
+import math
+import random
+import signal
+import threading
+import time
+import urllib.parse
+import xml.etree.ElementTree as ElementTree
+
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from xml.sax.saxutils import escape
+
+
+E_OK  = 0
+E_ERR = 1
+
+# The fake S3 server is a stand-in for the S3 compatible service, with injected latencies, errors and throttling.
+#
+# It keeps the buckets in memory and answers the requests made by the preparation and migration scripts:
+# ListObjectsV2, PutObject, CopyObject, GetObject, HeadObject, DeleteObject, DeleteObjects and CreateBucket.
+# The signatures of the requests are not checked, so any key/secret pair is accepted.
+#
+# Each request belongs to an operation (list, put, copy, get or delete) which can be given:
+#   * a latency distribution, that is slept before answering
+#   * an error rate, the probability of answering with a 500 InternalError
+#   * a throttle rate, the probability of answering with a 503 SlowDown
+# and the requests on the keys under a bucket/prefix can be capped to a number per second, as S3 does per prefix,
+# the requests above the cap being answered with a 503 SlowDown.
+#
+# The latency, the error and the throttling of a request are drawn from a generator of its own, seeded with a hash
+# of the seed of the server, of the request and of the number of times the same request was received before. With
+# the same seed a given attempt of a given request is thus always answered in the same way, whatever the order in
+# which the concurrent requests of the worker processes arrive. The rate caps depend on the time and are not.
+
+DEFAULT_LISTEN  = '127.0.0.1:9000'
+DEFAULT_BUCKETS = 'sketch-legacy-s3,sketch-production-s3'
+
+OPERATIONS = [ 'list', 'put', 'copy', 'get', 'delete' ]
+
+# maximum number of keys of each sorted block of a bucket, a block is split in two when it grows beyond twice this
+BLOCK_SIZE = 1000
+
+S3_XMLNS = 'http://s3.amazonaws.com/doc/2006-03-01/'
+
+
+# this function returns a latency distribution from its description, DISTRIBUTION:PARAMETERS with the times in seconds:
+#   * fixed:SECONDS
+#   * uniform:MIN:MAX
+#   * exponential:MEAN
+#   * lognormal:MEDIAN:SIGMA, a long tail that grows with SIGMA
+#   * pareto:MIN:ALPHA, a heavy tail that grows as ALPHA approaches 1
+def parse_latency(description):
+
+    name, *parameters = description.split(':')
+    parameters = [ float(parameter) for parameter in parameters ]
+
+    nr_parameters = { 'fixed': 1, 'uniform': 2, 'exponential': 1, 'lognormal': 2, 'pareto': 2 }
+    if name not in nr_parameters or len(parameters) != nr_parameters[name] or any(parameter < 0 for parameter in parameters):
+        raise ValueError(f"invalid latency distribution {description}")
+
+    if name == 'lognormal' and parameters[0] == 0:
+        raise ValueError(f"the median of {description} must be positive")
+
+    if name == 'pareto' and parameters[1] == 0:
+        raise ValueError(f"the alpha of {description} must be positive")
+
+    return (name, parameters)
+
+
+# this function draws a latency in seconds from a distribution
+def draw_latency(generator, distribution):
+
+    name, parameters = distribution
+
+    if name == 'fixed':
+        return parameters[0]
+    elif name == 'uniform':
+        return generator.uniform(parameters[0], parameters[1])
+    elif name == 'exponential':
+        return generator.expovariate(1 / parameters[0]) if parameters[0] > 0 else 0
+    elif name == 'lognormal':
+        return generator.lognormvariate(math.log(parameters[0]), parameters[1])
+    else:
+        return parameters[0] * generator.paretovariate(parameters[1])
+
+
+# this function parses the OPERATION=VALUE options, where OPERATION can also be all
+# it returns the value of each operation that has one
+def parse_operation_options(options, parse_value):
+
+    values = {}
+    for option in options:
+        operation, value = option.split('=', 1)
+        if operation == 'all':
+            operations = OPERATIONS
+        elif operation in OPERATIONS:
+            operations = [ operation ]
+        else:
+            raise ValueError(f"unknown operation {operation}, it must be one of {', '.join(OPERATIONS)} or all")
+
+        for operation in operations:
+            values[operation] = parse_value(value)
+
+    return values
+
+
+# this function parses a probability
+def parse_rate(value):
+
+    rate = float(value)
+    if rate < 0 or rate > 1:
+        raise ValueError(f"the rate {value} must be between 0 and 1")
+
+    return rate
+
+
+# this function parses the BUCKET/PREFIX=RATE options into token buckets, which start full
+def parse_rate_caps(options):
+
+    rate_caps = []
+    for option in options:
+        prefix, rate = option.rsplit('=', 1)
+        rate = float(rate)
+        if '/' not in prefix or rate <= 0:
+            raise ValueError(f"invalid rate cap {option}, it must be BUCKET/PREFIX=RATE with a positive rate")
+        rate_caps.append({ 'prefix': prefix, 'rate': rate, 'tokens': rate, 'last_time': time.monotonic() })
+
+    # the most specific cap applies to a key
+    rate_caps.sort(key=lambda rate_cap: len(rate_cap['prefix']), reverse=True)
+
+    return rate_caps
+
+
+# this function creates an empty bucket
+# the keys are kept in sorted blocks, so that a key is inserted in a small block instead of a huge list,
+# together with the last key of each block to find the block of a key
+def create_bucket():
+
+    return { 'objects': {}, 'blocks': [], 'block_ends': [] }
+
+
+# this function adds a key to the sorted blocks of a bucket
+def add_bucket_key(bucket, key):
+
+    blocks     = bucket['blocks']
+    block_ends = bucket['block_ends']
+
+    if len(blocks) == 0:
+        blocks.append([ key ])
+        block_ends.append(key)
+        return
+
+    # the key goes to the first block that ends after it, or to the last one
+    block_index = min(bisect.bisect_left(block_ends, key), len(blocks) - 1)
+    block = blocks[block_index]
+    bisect.insort(block, key)
+    block_ends[block_index] = block[-1]
+
+    if len(block) > 2 * BLOCK_SIZE:
+        blocks[block_index:block_index + 1] = [ block[:BLOCK_SIZE], block[BLOCK_SIZE:] ]
+        block_ends[block_index:block_index + 1] = [ block[BLOCK_SIZE - 1], block[-1] ]
+
+
+# this function removes a key from the sorted blocks of a bucket
+def remove_bucket_key(bucket, key):
+
+    blocks     = bucket['blocks']
+    block_ends = bucket['block_ends']
+
+    block_index = bisect.bisect_left(block_ends, key)
+    block = blocks[block_index]
+    del block[bisect.bisect_left(block, key)]
+
+    if len(block) == 0:
+        del blocks[block_index]
+        del block_ends[block_index]
+    else:
+        block_ends[block_index] = block[-1]
+
+
+# this function returns up to max_keys keys of a bucket that start with prefix and come after start_after
+# together with whether there are more of them
+def list_bucket_keys(bucket, prefix, start_after, max_keys):
+
+    blocks     = bucket['blocks']
+    block_ends = bucket['block_ends']
+
+    keys = []
+
+    # the first candidate is the first key after start_after that is not before the prefix
+    block_index = bisect.bisect_right(block_ends, start_after) if start_after > prefix else bisect.bisect_left(block_ends, prefix)
+    while block_index < len(blocks):
+        block = blocks[block_index]
+        if start_after > prefix:
+            key_index = bisect.bisect_right(block, start_after)
+        else:
+            key_index = bisect.bisect_left(block, prefix)
+
+        for key in block[key_index:]:
+            if not key.startswith(prefix):
+                return keys, False
+            if len(keys) == max_keys:
+                return keys, True
+            keys.append(key)
+
+        block_index += 1
+        start_after = ''
+
+    return keys, False
+
+
+# this function decodes a body sent with the aws-chunked content encoding, which botocore uses to send checksums
+# each chunk is its size in hexadecimal, optionally followed by a signature, and its data, and the last one is empty
+def decode_aws_chunked(body):
+
+    decoded = []
+    position = 0
+    while True:
+        line_end = body.index(b'\r\n', position)
+        chunk_size = int(body[position:line_end].split(b';')[0], 16)
+        if chunk_size == 0:
+            return b''.join(decoded)
+        decoded.append(body[line_end + 2:line_end + 2 + chunk_size])
+        position = line_end + 2 + chunk_size + 2
+
+
+# this function returns the current time in the format of the S3 API
+def get_timestamp():
+
+    return datetime.datetime.now(datetime.timezone.utc).strftime('%Y-%m-%dT%H:%M:%S.000Z')
+
+
+# the state of the server, set up by main
+server_state = { 'buckets': {}, 'lock': threading.Lock(), 'latencies': {}, 'error_rates': {}, 'throttle_rates': {},
+                 'rate_caps': [], 'seed': 0, 'attempts': {}, 'stats': {}, 'verbose': False }
+
+
+# this function counts a request and its outcome
+def count_request(operation, outcome):
+
+    with server_state['lock']:
+        operation_stats = server_state['stats'].setdefault(operation, {})
+        operation_stats[outcome] = operation_stats.get(outcome, 0) + 1
+
+
+# this function returns the random generator of a request, identified by a string
+# the attempts of every request are counted, which takes some memory for each distinct request, as the objects do
+def get_request_generator(request_id):
+
+    with server_state['lock']:
+        attempt = server_state['attempts'].get(request_id, 0)
+        server_state['attempts'][request_id] = attempt + 1
+
+    digest = hashlib.sha256(f"{server_state['seed']} {attempt} {request_id}".encode()).digest()
+
+    return random.Random(int.from_bytes(digest[:8], 'big'))
+
+
+# this function takes a token of the rate cap of a key, if it has one
+# it returns False if the cap has been reached
+def take_rate_cap_token(bucket_name, key):
+
+    full_key = f"{bucket_name}/{key}"
+
+    for rate_cap in server_state['rate_caps']:
+        if full_key.startswith(rate_cap['prefix']):
+            with server_state['lock']:
+                now = time.monotonic()
+                rate_cap['tokens'] = min(rate_cap['rate'], rate_cap['tokens'] + (now - rate_cap['last_time']) * rate_cap['rate'])
+                rate_cap['last_time'] = now
+                if rate_cap['tokens'] < 1:
+                    return False
+                rate_cap['tokens'] -= 1
+            return True
+
+    return True
+
+
+# the HTTP server of the fake S3 API, with path style or virtual host style addressing
+class FakeS3RequestHandler(BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+
+    # the headers and the body are written separately, which would otherwise wait for the delayed ACK of the client
+    disable_nagle_algorithm = True
+
+    # this function sends a response with an optional XML document
+    def send_s3_response(self, status, document=None, headers={}):
+
+        body = b''
+        if document is not None:
+            body = ('<?xml version="1.0" encoding="UTF-8"?>\n' + document).encode()
+
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        if document is not None:
+            self.send_header('Content-Type', 'application/xml')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+
+    # this function sends an error response
+    def send_s3_error(self, status, code, message):
+
+        self.send_s3_response(status, f"<Error><Code>{code}</Code><Message>{escape(message)}</Message><RequestId>fake</RequestId></Error>")
+
+    # this function reads the body of the request, which may be encoded in aws-chunked
+    def read_body(self):
+
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+
+        if 'aws-chunked' in self.headers.get('Content-Encoding', '') or self.headers.get('x-amz-content-sha256', '').startswith('STREAMING-'):
+            body = decode_aws_chunked(body)
+
+        return body
+
+    # this function returns the bucket name, the key and the query parameters of the request
+    def parse_request_path(self):
+
+        url = urllib.parse.urlsplit(self.path)
+        query = dict(urllib.parse.parse_qsl(url.query, keep_blank_values=True))
+        path = urllib.parse.unquote(url.path)
+
+        # with the virtual host style the bucket is the first label of the host name
+        host = self.headers.get('Host', '').split(':')[0]
+        for bucket_name in server_state['buckets']:
+            if host.startswith(f"{bucket_name}."):
+                return bucket_name, path[1:], query
+
+        bucket_name, _, key = path[1:].partition('/')
+
+        return bucket_name, key, query
+
+    # this function returns the operation of the request
+    def get_operation(self, key, query):
+
+        if self.command == 'GET' and key == '':
+            return 'list'
+        if self.command in [ 'GET', 'HEAD' ]:
+            return 'get'
+        if self.command == 'PUT' and 'x-amz-copy-source' in self.headers:
+            return 'copy'
+        if self.command == 'PUT':
+            return 'put'
+        return 'delete'
+
+    # this function handles every request: it injects the latency, errors and throttling and then answers it
+    def handle_s3_request(self):
+
+        bucket_name, key, query = self.parse_request_path()
+        operation = self.get_operation(key, query)
+
+        # the body is always read, so that the connection can be reused whatever the answer
+        body = self.read_body()
+
+        # the copy source tells the copies to the same key apart, and the path holds the parameters of a listing
+        generator = get_request_generator(f"{operation} {bucket_name} {self.path} {self.headers.get('x-amz-copy-source', '')}")
+
+        latency = server_state['latencies'].get(operation)
+        if latency is not None:
+            time.sleep(draw_latency(generator, latency))
+
+        if generator.random() < server_state['throttle_rates'].get(operation, 0):
+            count_request(operation, 'throttled')
+            self.send_s3_error(503, 'SlowDown', 'Please reduce your request rate.')
+            return
+
+        if not take_rate_cap_token(bucket_name, query.get('prefix', key)):
+            count_request(operation, 'capped')
+            self.send_s3_error(503, 'SlowDown', 'Please reduce your request rate.')
+            return
+
+        if generator.random() < server_state['error_rates'].get(operation, 0):
+            count_request(operation, 'failed')
+            self.send_s3_error(500, 'InternalError', 'We encountered an internal error. Please try again.')
+            return
+
+        if self.command == 'PUT' and key == '':
+            with server_state['lock']:
+                server_state['buckets'].setdefault(bucket_name, create_bucket())
+            count_request('put', 'ok')
+            self.send_s3_response(200)
+            return
+
+        bucket = server_state['buckets'].get(bucket_name)
+        if bucket is None:
+            count_request(operation, 'not_found')
+            self.send_s3_error(404, 'NoSuchBucket', f"The bucket {bucket_name} does not exist")
+            return
+
+        if operation == 'list':
+            self.list_objects(bucket_name, bucket, query)
+        elif operation == 'get' and key == '':
+            count_request('get', 'ok')
+            self.send_s3_response(200)
+        elif operation == 'get':
+            self.get_object(bucket, key)
+        elif operation == 'copy':
+            self.copy_object(bucket, key)
+        elif operation == 'put':
+            self.put_object(bucket, key, body)
+        elif self.command == 'POST' and 'delete' in query:
+            self.delete_objects(bucket, body)
+        elif self.command == 'DELETE':
+            self.delete_object(bucket, key)
+        else:
+            count_request(operation, 'not_implemented')
+            self.send_s3_error(501, 'NotImplemented', f"{self.command} {self.path} is not implemented")
+
+    # this function answers a ListObjectsV2 request
+    # the continuation token is the last key of the previous page
+    def list_objects(self, bucket_name, bucket, query):
+
+        prefix    = query.get('prefix', '')
+        max_keys  = min(int(query.get('max-keys', 1000)), 1000)
+        url_encoded = query.get('encoding-type') == 'url'
+
+        start_after = query.get('start-after', '')
+        if 'continuation-token' in query:
+            start_after = base64.urlsafe_b64decode(query['continuation-token'].encode()).decode()
+
+        with server_state['lock']:
+            keys, is_truncated = list_bucket_keys(bucket, prefix, start_after, max_keys)
+            objects = [ (key, bucket['objects'][key]) for key in keys ]
+
+        # with the url encoding type, which botocore requests by default, the keys are url encoded
+        def encode(value):
+            return escape(urllib.parse.quote(value, safe='/') if url_encoded else value)
+
+        elements = [ f"<ListBucketResult xmlns=\"{S3_XMLNS}\">",
+                     f"<Name>{escape(bucket_name)}</Name><Prefix>{encode(prefix)}</Prefix><KeyCount>{len(objects)}</KeyCount>",
+                     f"<MaxKeys>{max_keys}</MaxKeys><IsTruncated>{str(is_truncated).lower()}</IsTruncated>" ]
+        if url_encoded:
+            elements.append('<EncodingType>url</EncodingType>')
+        if 'start-after' in query:
+            elements.append(f"<StartAfter>{encode(query['start-after'])}</StartAfter>")
+        if 'continuation-token' in query:
+            elements.append(f"<ContinuationToken>{escape(query['continuation-token'])}</ContinuationToken>")
+        if is_truncated:
+            elements.append(f"<NextContinuationToken>{base64.urlsafe_b64encode(keys[-1].encode()).decode()}</NextContinuationToken>")
+        for key, (body, etag, last_modified) in objects:
+            elements.append(f"<Contents><Key>{encode(key)}</Key><LastModified>{last_modified}</LastModified><ETag>&quot;{etag}&quot;</ETag>"
+                            f"<Size>{len(body)}</Size><StorageClass>STANDARD</StorageClass></Contents>")
+        elements.append('</ListBucketResult>')
+
+        count_request('list', 'ok')
+        self.send_s3_response(200, ''.join(elements))
+
+    # this function answers a GetObject or HeadObject request
+    def get_object(self, bucket, key):
+
+        stored_object = bucket['objects'].get(key)
+        if stored_object is None:
+            count_request('get', 'not_found')
+            self.send_s3_error(404, 'NoSuchKey', f"The key {key} does not exist")
+            return
+
+        body, etag, last_modified = stored_object
+
+        count_request('get', 'ok')
+        self.send_response(200)
+        self.send_header('ETag', f"\"{etag}\"")
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+
+    # this function stores an object
+    def store_object(self, bucket, key, body, etag):
+
+        with server_state['lock']:
+            if key not in bucket['objects']:
+                add_bucket_key(bucket, key)
+            bucket['objects'][key] = (body, etag, get_timestamp())
+
+    # this function answers a PutObject request
+    def put_object(self, bucket, key, body):
+
+        etag = hashlib.md5(body).hexdigest()
+        self.store_object(bucket, key, body, etag)
+
+        count_request('put', 'ok')
+        self.send_s3_response(200, None, { 'ETag': f"\"{etag}\"" })
+
+    # this function answers a CopyObject request, the copy shares the body of the source object
+    def copy_object(self, bucket, key):
+
+        source_bucket_name, _, source_key = urllib.parse.unquote(self.headers['x-amz-copy-source']).lstrip('/').partition('/')
+
+        source_bucket = server_state['buckets'].get(source_bucket_name)
+        source_object = source_bucket['objects'].get(source_key) if source_bucket is not None else None
+        if source_object is None:
+            count_request('copy', 'not_found')
+            self.send_s3_error(404, 'NoSuchKey', f"The key {source_key} does not exist")
+            return
+
+        body, etag, last_modified = source_object
+        self.store_object(bucket, key, body, etag)
+
+        count_request('copy', 'ok')
+        self.send_s3_response(200, f"<CopyObjectResult><LastModified>{get_timestamp()}</LastModified><ETag>&quot;{etag}&quot;</ETag></CopyObjectResult>")
+
+    # this function removes an object, deleting a key that does not exist is not an error
+    def remove_object(self, bucket, key):
+
+        with server_state['lock']:
+            if bucket['objects'].pop(key, None) is not None:
+                remove_bucket_key(bucket, key)
+
+    # this function answers a DeleteObject request
+    def delete_object(self, bucket, key):
+
+        self.remove_object(bucket, key)
+
+        count_request('delete', 'ok')
+        self.send_s3_response(204)
+
+    # this function answers a DeleteObjects request
+    def delete_objects(self, bucket, body):
+
+        root = ElementTree.fromstring(body)
+        namespace = root.tag[:root.tag.index('}') + 1] if root.tag.startswith('{') else ''
+
+        quiet = root.findtext(f"{namespace}Quiet", 'false').lower() == 'true'
+
+        elements = [ f"<DeleteResult xmlns=\"{S3_XMLNS}\">" ]
+        for object_element in root.findall(f"{namespace}Object"):
+            key = object_element.findtext(f"{namespace}Key")
+            self.remove_object(bucket, key)
+            if not quiet:
+                elements.append(f"<Deleted><Key>{escape(key)}</Key></Deleted>")
+        elements.append('</DeleteResult>')
+
+        count_request('delete', 'ok')
+        self.send_s3_response(200, ''.join(elements))
+
+    def do_GET(self):
+        self.handle_s3_request()
+
+    def do_HEAD(self):
+        self.handle_s3_request()
+
+    def do_PUT(self):
+        self.handle_s3_request()
+
+    def do_POST(self):
+        self.handle_s3_request()
+
+    def do_DELETE(self):
+        self.handle_s3_request()
+
+    # the requests are only printed in verbose mode
+    def log_message(self, format, *args):
+
+        if server_state['verbose']:
+            print(f"  * {self.address_string()}: {format % args}")
+
+
+# this function prints the number of requests of each operation by outcome
+def print_stats():
+
+    print('Requests by operation and outcome:')
+    for operation in OPERATIONS:
+        operation_stats = server_state['stats'].get(operation, {})
+        outcomes = ', '.join(f"{outcome} {count}" for outcome, count in sorted(operation_stats.items()))
+        print(f"  * {operation:<7} {sum(operation_stats.values()):>10} ({outcomes})")
+
+
+# main script
+def main():
+
+    parser = argparse.ArgumentParser(description='This script serves a fake S3 API from memory, with injected latencies, errors and throttling')
+
+    # optional arguments
+    parser.add_argument('-l', '--listen',        help='HOST:PORT on which the API is served',                           type=str, default=DEFAULT_LISTEN)
+    parser.add_argument('-b', '--buckets',       help='comma separated names of the buckets that exist from the start', type=str, default=DEFAULT_BUCKETS)
+    parser.add_argument('-L', '--latency',       help='latency of an operation, as OPERATION=DISTRIBUTION:PARAMETERS',  type=str, action='append', default=[])
+    parser.add_argument('-e', '--error-rate',    help='rate of InternalError answers of an operation, as OPERATION=RATE', type=str, action='append', default=[])
+    parser.add_argument('-t', '--throttle-rate', help='rate of SlowDown answers of an operation, as OPERATION=RATE',     type=str, action='append', default=[])
+    parser.add_argument('-r', '--rate-cap',      help='requests per second on the keys of a prefix, as BUCKET/PREFIX=RATE', type=str, action='append', default=[])
+    parser.add_argument('-s', '--seed',          help='seed of the random draws, for reproducible executions',          type=int, default=None)
+
+    # flags
+    parser.add_argument('-v', '--verbose',       help='print every request', default=False, action='store_true')
+
+    args = parser.parse_args()
+
+    try:
+        server_state['latencies']      = parse_operation_options(args.latency, parse_latency)
+        server_state['error_rates']    = parse_operation_options(args.error_rate, parse_rate)
+        server_state['throttle_rates'] = parse_operation_options(args.throttle_rate, parse_rate)
+        server_state['rate_caps']      = parse_rate_caps(args.rate_cap)
+        host, port = args.listen.rsplit(':', 1)
+        port = int(port)
+    except ValueError as e:
+        print(f"ERROR: {e}")
+        exit(E_ERR)
+
+    # without a seed every execution draws differently
+    if args.seed is not None:
+        server_state['seed'] = args.seed
+    else:
+        server_state['seed'] = random.getrandbits(64)
+
+    server_state['verbose'] = args.verbose
+    server_state['buckets'] = { bucket_name: create_bucket() for bucket_name in args.buckets.split(',') if bucket_name != '' }
+
+    server = ThreadingHTTPServer((host, port), FakeS3RequestHandler)
+    server.daemon_threads = True
+
+    # SIGTERM stops the server as Ctrl-C does, so that the statistics are printed in both cases
+    def request_stop(signum, frame):
+        raise KeyboardInterrupt()
+
+    signal.signal(signal.SIGTERM, request_stop)
+
+    print(f"Serving a fake S3 API on http://{host}:{port} with the buckets {', '.join(server_state['buckets'])}", flush=True)
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+    server.server_close()
+
+    print_stats()
+
+    exit(E_OK)
+
+
+# main script
+if __name__ == "__main__":
+    main()